@@ -1,8 +1,10 @@
 # importa l'API de Telegram
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
+import concurrent.futures
 import igo
+import io
 import os
-from datetime import date, datetime, timedelta
+from datetime import datetime
 from urllib import request
 import xml.etree.ElementTree as ET
 
@@ -11,40 +13,132 @@ print('Debugging started at', str(datetime.now()))
 
 PLACE = 'Barcelona, Catalonia'
 GRAPH_FILENAME = 'barcelona.graph'
+ASSIGNMENT_FILENAME = 'barcelona.assignment'
+# The graph ready to route with the last traffic snapshot, to restart from
+WARM_START_FILENAME = 'barcelona.warm'
+# Every congestion feed is logged here, to build traffic profiles from
+CONGESTION_LOG_DIRECTORY = 'congestion-log'
+GEOCODING_FILENAME = 'geocoding.sqlite'
+# Directory of the map tile cache and the space it may take
+TILES_DIRECTORY = 'tiles'
+TILES_MAX_BYTES = 256*2**20
+# Contraction order of the graph, independent of the traffic
+CCH_FILENAME = 'barcelona.cch'
+# Directory where the traffic snapshots are shared with the workers
+SNAPSHOT_DIRECTORY = 'snapshots'
+# Worker processes that search and render routes, requests that may wait
+# for them, and seconds a user waits for a route before giving up
+WORKERS = 2
+QUEUE_SIZE = 16
+REQUEST_TIMEOUT = 30
 SIZE = 800
+# Opt-in instrumentation: a localhost port to serve the metrics on, in the
+# Prometheus text format, and a file to log every measure to as JSON lines
+METRICS_PORT = None
+METRICS_LOG = None
+# Seconds between two downloads of the congestion data
+REFRESH_INTERVAL = 5*60
 HIGHWAYS_URL = 'https://opendata-ajuntament.barcelona.cat/data/dataset/1090983a-1c40-4609-8620-14ad49aae3ab/resource/1d6c814c-70ef-4147-aa16-a49ddb952f72/download/transit_relacio_trams.csv'
 CONGESTIONS_URL = 'https://opendata-ajuntament.barcelona.cat/data/dataset/8319c2b1-4c21-4962-9acd-6db4c5ff1148/resource/2d456eb5-4ea6-4f68-9794-2f3f1a58a933/download'
 
 
-# Check if the graph exists already, else download it
-if not igo.exists_graph(GRAPH_FILENAME):
-    graph = igo.download_graph(PLACE)
-else:
-    graph = igo.load_graph(GRAPH_FILENAME)
+if METRICS_PORT is not None or METRICS_LOG is not None:
+    igo.metrics.enable(*([igo.JsonLinesSink(METRICS_LOG)]
+                         if METRICS_LOG is not None else []))
 
-highways = igo.download_highways(HIGHWAYS_URL)
-congestions = igo.download_congestions(CONGESTIONS_URL)
-complete_data = igo.build_complete_traffic_data(highways, congestions)
-igo.build_igraph(graph, complete_data)
+congestion_log = igo.CongestionLog(CONGESTION_LOG_DIRECTORY)
 
+# Geocoded places are kept on disk, since users ask for the same ones
+igo.geocoder = igo.Geocoder(filename=GEOCODING_FILENAME)
+# and so are the map tiles, which every map of the bot is rendered on
+igo.tile_cache = igo.TileCache(TILES_DIRECTORY, max_bytes=TILES_MAX_BYTES)
 
-def get_last_known_time(traffic_data: igo.Traffic_data):
-    time = datetime.strptime(traffic_data.timestamp, '%Y%m%d%H%M%S')
-    return time
+# If the last run left a warm start, we route with its traffic snapshot
+# right away, and the feeds are downloaded again in the background. A warm
+# start saved for another version of the graph file is not used, since the
+# workers route over that file.
+warm_start = (igo.exists_graph(GRAPH_FILENAME) and
+              os.path.exists(WARM_START_FILENAME))
+if warm_start:
+    try:
+        graph = igo.load_warm_start(WARM_START_FILENAME, GRAPH_FILENAME)
+    except ValueError as error:
+        print('Cold start:', error)
+        warm_start = False
+if warm_start:
+    # The snapshot keeps the highways it was built for
+    highways = igo.current_snapshot(graph).traffic_data
+    congestions = None
+else:
+    # Check if the graph exists already, else download and save it. Either
+    # way we route over the memory-mapped version of the file.
+    if not igo.exists_graph(GRAPH_FILENAME):
+        igo.save_graph(igo.download_graph(PLACE), GRAPH_FILENAME)
+    graph = igo.load_graph(GRAPH_FILENAME)
+    highways = igo.download_highways(HIGHWAYS_URL)
+    congestions = igo.download_congestions(CONGESTIONS_URL)
+
+# Routes and isochrones are searched and rendered by worker processes, so
+# that a slow request does not stall the others. They search paths on a
+# customizable hierarchy, re-weighted for every traffic snapshot, instead
+# of on the whole graph.
+pool = igo.RoutePool(GRAPH_FILENAME, SNAPSHOT_DIRECTORY, processes=WORKERS,
+                     queue_size=QUEUE_SIZE, algorithm='ch',
+                     cch_filename=CCH_FILENAME,
+                     geocoding_filename=GEOCODING_FILENAME,
+                     tiles_directory=TILES_DIRECTORY)
+if METRICS_PORT is not None:
+    igo.serve_metrics(METRICS_PORT)
+
+
+def prefetch_tiles(context):
+    '''Job that fills the tile cache with the tiles of Barcelona, so that
+    the first maps do not wait for them.
+    '''
+    failed = igo.prefetch_tiles(igo.tile_cache)
+    print(failed, 'map tiles could not be prefetched')
 
 
-def time_to_update(traffic_data: igo.Traffic_data):
-    last_known_time = get_last_known_time(traffic_data)
-    if last_known_time-datetime.now() >= timedelta(minutes=5):
-        return True
-    else:
-        return False
+def update_data():
+    '''Builds a new traffic snapshot of the graph from the last congestion
+    data. igo.build_igraph swaps it in when it is complete, so the requests
+    that are being answered meanwhile keep using the previous one.
+    '''
+    missing = list()
+    complete_data = igo.build_complete_traffic_data(highways, congestions,
+                                                    missing)
+    print(len(missing), 'highways have no congestion data')
+    congestion_log.append(complete_data)
+    # The workers get the file of the snapshot before it is swapped in, so
+    # that the requests for it always find it.
+    igo.build_igraph(graph, complete_data,
+                     assignment_filename=ASSIGNMENT_FILENAME,
+                     publish=pool.publish)
+    igo.save_warm_start(graph, WARM_START_FILENAME)
+
+
+def refresh_data(context):
+    '''Job that downloads the traffic data in the background and updates
+    the traffic snapshot if it has changed.
+    '''
+    global highways, congestions
+    try:
+        new_highways = igo.download_highways(HIGHWAYS_URL)
+        new_congestions = igo.download_congestions(CONGESTIONS_URL)
+        # An unchanged feed is returned as the very same object
+        if new_highways is not highways or new_congestions is not congestions:
+            highways, congestions = new_highways, new_congestions
+            update_data()
+            # Renders the new congestion map before anyone asks for it
+            igo.congestion_map(graph, size=SIZE)
+    except Exception as e:
+        print('Could not refresh the traffic data:', e)
 
 
-def update_data(dataset: igo.traffic_data_list):
-    congestions = igo.download_congestions(CONGESTIONS_URL)
-    dataset.clear()
-    dataset = igo.build_complete_traffic_data(highways, congestions)
+if warm_start:
+    pool.publish(igo.current_snapshot(graph))
+else:
+    update_data()
 
 
 def get_location_name(lat, lon):
@@ -74,6 +168,8 @@ def help(update, context):
 - /author: Returns information from the project authors.
 - /go: Requires a location from the city of Barcelona and returns \
 the shortest path from the user's current location.
+- /reach: Requires a number of minutes and shows the area that can \
+be reached from the user's current location within them.
 - /where: Returns the users current location. This can only be called \
 once a location has been set. If it has not been set, an message will \
 appear asking you to send your location.
@@ -92,9 +188,33 @@ def author(update, context):
         chat_id=update.effective_chat.id, text=authors_msg)
 
 
+def wait_for(update, context, future):
+    '''Waits for the result of a request sent to the worker pool. If the
+    pool is too busy to take it (the future is None), it takes too long or
+    it fails, the user is told so and None is returned.
+    '''
+    if future is None:
+        context.bot.send_message(chat_id=update.effective_chat.id,
+                                 text='iGo is very busy right now, please \
+try again in a minute.')
+        return None
+    try:
+        return future.result(timeout=REQUEST_TIMEOUT)
+    except concurrent.futures.TimeoutError:
+        # The request leaves the queue, as nobody waits for it any more
+        future.cancel()
+        context.bot.send_message(chat_id=update.effective_chat.id,
+                                 text='iGo is taking too long to answer, \
+please try again in a minute.')
+    except Exception as e:
+        print('Request failed:', e)
+        context.bot.send_message(chat_id=update.effective_chat.id,
+                                 text='💣: something went wrong while \
+answering your request')
+    return None
+
+
 def go(update, context):
-    if time_to_update(complete_data[0]):
-        update_data(complete_data)
     destination = ''
     first = True
     for word in context.args:
@@ -103,17 +223,47 @@ def go(update, context):
             first = False
         else:
             destination = destination + ' ' + word
-    path = igo.build_ipath(
-        graph, context.user_data['current_position'], destination)
-    filename = 'path_'+update.effective_chat.username+'.png'
-    igo.plot_path(graph, path, filename=filename)
+    # The same snapshot is used for the whole request, even if a new one
+    # is swapped in meanwhile.
+    snapshot = igo.current_snapshot(graph)
+    route = wait_for(update, context, pool.route(
+        context.user_data['current_position'], destination, snapshot.version,
+        SIZE))
+    if route is None:
+        return
     context.bot.send_message(chat_id=update.effective_chat.id,
                              text='iGo calculated the following minimal \
 path taking into account public congestion data.')
     context.bot.send_photo(
         chat_id=update.effective_chat.id,
-        photo=open(filename, 'rb'))
-    os.remove(filename)
+        photo=io.BytesIO(route.image))
+
+
+def reach(update, context):
+    if 'current_coordinates' not in context.user_data:
+        context.bot.send_message(chat_id=update.effective_chat.id,
+                                 text='Please send your location \
+before asking for the area you can reach.')
+        return
+    try:
+        minutes = float(context.args[0])
+    except (IndexError, ValueError):
+        context.bot.send_message(chat_id=update.effective_chat.id,
+                                 text='Usage: /reach <minutes>')
+        return
+    coordinates = context.user_data['current_coordinates']
+    result = wait_for(update, context, pool.isochrone(
+        (coordinates['lon'], coordinates['lat']), minutes*60,
+        igo.current_snapshot(graph).version, SIZE))
+    if result is None:
+        return
+    iso, image = result
+    context.bot.send_message(chat_id=update.effective_chat.id,
+                             text='In {m:g} minutes you can reach {n} \
+crossings with the current traffic.'.format(m=minutes, n=len(iso.nodes)))
+    context.bot.send_photo(
+        chat_id=update.effective_chat.id,
+        photo=io.BytesIO(image))
 
 
 def location_received(update, context):
@@ -122,15 +272,10 @@ def location_received(update, context):
         lon = update.message.location.longitude
         context.user_data['current_position'] = get_location_name(lat, lon)
         context.user_data['current_coordinates'] = {'lat': lat, 'lon': lon}
-        filename = 'position_' + update.effective_chat.username + '.png'
-        map = igo.StaticMap(SIZE, SIZE)
-        map.add_marker(igo.CircleMarker((lon, lat), 'blue', 10))
-        image = map.render()
-        image.save(filename)
+        image = igo.plot_position(lon, lat, filename=None, size=SIZE)
         context.bot.send_photo(
             chat_id=update.effective_chat.id,
-            photo=open(filename, 'rb'))
-        os.remove(filename)
+            photo=io.BytesIO(image))
     except Exception as e:
         context.bot.send_message(
             chat_id=update.effective_chat.id,
@@ -151,15 +296,10 @@ before asking for your position.')
     context.bot.send_message(chat_id=update.effective_chat.id,
                              text=where_msg+position)
     try:
-        filename = 'position_' + update.effective_chat.username + '.png'
-        map = igo.StaticMap(SIZE, SIZE)
-        map.add_marker(igo.CircleMarker((lon, lat), 'blue', 10))
-        image = map.render()
-        image.save(filename)
+        image = igo.plot_position(lon, lat, filename=None, size=SIZE)
         context.bot.send_photo(
             chat_id=update.effective_chat.id,
-            photo=open(filename, 'rb'))
-        os.remove(filename)
+            photo=io.BytesIO(image))
     except Exception as e:
         context.bot.send_message(
             chat_id=update.effective_chat.id,
@@ -182,17 +322,17 @@ def pos(update, context):
             place = place + ' ' + word
     place = place + ', Barcelona'
     context.user_data['current_position'] = place
-    context.user_data['current_coordinates'] = {
-        'lat': igo.ox.geocode(place)[0], 'lon': igo.ox.geocode(place)[1]}
+    lat, lon = igo.geocoder.geocode(place)
+    context.user_data['current_coordinates'] = {'lat': lat, 'lon': lon}
 
 
 def show_map(update, context):
-    filename = 'map_'+update.effective_chat.username + '.png'
-    igo.plot_congestions(complete_data, filename=filename, size=SIZE)
+    # The map is rendered once per traffic snapshot. While a new one is
+    # rendered, users get the previous one.
+    image = igo.congestion_map(graph, size=SIZE, stale=True)
     context.bot.send_photo(
         chat_id=update.effective_chat.id,
-        photo=open(filename, 'rb'))
-    os.remove(filename)
+        photo=io.BytesIO(image))
     map_legend = '''The color legend is the following:
     - Grey: no information about the driveway
     - Green: very fluid traffic
@@ -218,11 +358,18 @@ dispatcher = updater.dispatcher
 dispatcher.add_handler(CommandHandler('start', start))
 dispatcher.add_handler(CommandHandler('help', help))
 dispatcher.add_handler(CommandHandler('author', author))
-dispatcher.add_handler(CommandHandler('go', go))
+# the ones that wait for the worker pool run in their own threads
+dispatcher.add_handler(CommandHandler('go', go, run_async=True))
+dispatcher.add_handler(CommandHandler('reach', reach, run_async=True))
 dispatcher.add_handler(CommandHandler('where', where))
 dispatcher.add_handler(CommandHandler('pos', pos))
 dispatcher.add_handler(CommandHandler('map', show_map))
 dispatcher.add_handler(MessageHandler(Filters.location, location_received))
 
+# prefetches the map tiles and refreshes the traffic data in the background
+updater.job_queue.run_once(prefetch_tiles, 0)
+updater.job_queue.run_repeating(refresh_data, interval=REFRESH_INTERVAL,
+                                first=0 if warm_start else REFRESH_INTERVAL)
+
 # starts the bot
 updater.start_polling()
@@ -0,0 +1,324 @@
+'''Benchmarks for the iGo module.
+
+The benchmarks run fully offline: on synthetic grid cities, with the
+recorded highway and congestion feeds of the 'bench-fixtures' directory,
+a geocoder that reads the coordinates of the crossings from their names
+and map tiles rendered from a blank local tile. They need neither the
+Barcelona graph file nor internet access. Run them with
+
+    python igo-bench.py [--sizes 30 60 100] [--queries 50] [--routing]
+                        [--output results.json] [--compare baseline.json]
+
+The results are written as JSON, so that those of two commits can be
+compared with --compare.
+'''
+
+from time import perf_counter
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from PIL import Image
+import networkx as nx
+
+import igo
+
+# Centre of the synthetic city and distance in degrees between two
+# consecutive crossings of the grid (roughly 100 metres).
+ORIGIN = (2.1734, 41.3851)
+STEP = 0.001
+# Recorded feeds, which cover the crossings of the smallest grid of the
+# default sizes.
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'bench-fixtures')
+HIGHWAYS_FIXTURE = os.path.join(FIXTURES, 'highways.csv')
+CONGESTIONS_FIXTURE = os.path.join(FIXTURES, 'congestions.csv')
+FIXTURE_SIDE = 30
+SIZE = 800
+
+
+def grid_city(side: int, seed: int = 0) -> nx.MultiDiGraph:
+    '''Builds a side x side grid of two-way streets with the attributes
+    that OSMnx graphs have and iGo uses: node coordinates and edge length
+    and maxspeed.
+    '''
+    rng = random.Random(seed)
+    graph = nx.MultiDiGraph(crs='epsg:4326')
+    for i in range(side):
+        for j in range(side):
+            graph.add_node(i*side + j, x=ORIGIN[0] + j*STEP,
+                           y=ORIGIN[1] + i*STEP)
+    for i in range(side):
+        for j in range(side):
+            for di, dj in ((0, 1), (1, 0)):
+                if i + di < side and j + dj < side:
+                    u, v = i*side + j, (i + di)*side + j + dj
+                    length = rng.uniform(70, 130)
+                    maxspeed = rng.choice(['30', '50', ['30', '50']])
+                    graph.add_edge(u, v, length=length, maxspeed=maxspeed)
+                    graph.add_edge(v, u, length=length, maxspeed=maxspeed)
+    return graph
+
+
+def record_fixtures(side: int = FIXTURE_SIDE, highways: int = 200,
+                    seed: int = 0) -> None:
+    '''Writes the feeds of the fixtures directory, in the formats of the
+    Barcelona open data: highways along the streets of a side x side grid,
+    and the state of most of them, some of them repeated.
+    '''
+    rng = random.Random(seed)
+    os.makedirs(FIXTURES, exist_ok=True)
+    with open(HIGHWAYS_FIXTURE, 'w', newline='') as file:
+        writer = csv.writer(file, delimiter=',', quotechar='"')
+        writer.writerow(['Tram', 'Descripció', 'Coordenades'])
+        for way_id in range(1, highways + 1):
+            i, j = rng.randrange(side), rng.randrange(side)
+            di, dj = rng.choice(((0, 1), (1, 0), (0, -1), (-1, 0)))
+            coordinates = list()
+            for _ in range(rng.randint(2, 5)):
+                # Points are a few metres off the crossings, as the real
+                # ones are.
+                coordinates.append(round(ORIGIN[0] + j*STEP +
+                                         rng.uniform(-1e-4, 1e-4), 6))
+                coordinates.append(round(ORIGIN[1] + i*STEP +
+                                         rng.uniform(-1e-4, 1e-4), 6))
+                i = min(max(i + di, 0), side - 1)
+                j = min(max(j + dj, 0), side - 1)
+            writer.writerow([way_id, 'Tram {n}'.format(n=way_id),
+                             ','.join(map(str, coordinates))])
+    with open(CONGESTIONS_FIXTURE, 'w', newline='') as file:
+        writer = csv.writer(file, delimiter='#', quotechar='"')
+        for way_id in range(1, highways + 1):
+            for _ in range(2 if rng.random() < 0.05 else 1):
+                if rng.random() < 0.9:
+                    state = rng.randint(0, 6)
+                    writer.writerow([way_id, '20210601120000', state,
+                                     min(state + rng.randint(0, 1), 6)])
+
+
+def crossing(side: int, node: int) -> str:
+    '''Returns the name the stub geocoder gives to a crossing.'''
+    return 'Crossing {i} {j}'.format(i=node // side, j=node % side)
+
+
+def geocode_crossing(query: str) -> tuple:
+    '''Stub geocoding backend that returns the (latitude, longitude)
+    coordinates of a crossing from its name.
+    '''
+    i, j = map(int, re.match(r'Crossing (\d+) (\d+)', query).groups())
+    return ORIGIN[1] + i*STEP, ORIGIN[0] + j*STEP
+
+
+def go_offline(directory: str) -> None:
+    '''Replaces the geocoder of igo by the stub one, and makes maps render
+    on a blank local tile.
+    '''
+    tile = os.path.join(directory, 'blank.png')
+    Image.new('RGB', (256, 256), '#f2efe9').save(tile)
+    igo.tile_cache = igo.TileCache(os.path.join(directory, 'tiles'), tile)
+    igo.geocoder = igo.Geocoder(backend=geocode_crossing)
+
+
+def timed(function, *args) -> float:
+    '''Returns the seconds it takes to call function(*args).'''
+    start = perf_counter()
+    function(*args)
+    return perf_counter() - start
+
+
+def median_time(repeat: int, function, *args) -> float:
+    '''Returns the median of the seconds of repeat calls of
+    function(*args).
+    '''
+    return statistics.median(timed(function, *args) for _ in range(repeat))
+
+
+def bench_pipeline(side: int, queries: int, repeat: int,
+                   directory: str, seed: int = 0) -> dict:
+    '''Times every stage of the pipeline on a side x side grid, from
+    loading the graph to drawing paths. Returns the seconds of each one,
+    or per query for the searches.
+    '''
+    rng = random.Random(seed)
+    results = dict()
+    filename = os.path.join(directory, 'grid{s}.graph'.format(s=side))
+    igo.save_graph(grid_city(side, seed), filename)
+    results['load_graph'] = median_time(repeat, igo.load_graph, filename)
+    highways_url = 'file://' + HIGHWAYS_FIXTURE
+    congestions_url = 'file://' + CONGESTIONS_FIXTURE
+    results['download_highways'] = median_time(
+        repeat, igo.download_highways, highways_url)
+    results['download_congestions'] = median_time(
+        repeat, igo.download_congestions, congestions_url)
+    highways = igo.download_highways(highways_url)
+    congestions = igo.download_congestions(congestions_url)
+    results['build_complete_traffic_data'] = median_time(
+        repeat, igo.build_complete_traffic_data, highways, congestions)
+    complete_data = igo.build_complete_traffic_data(highways, congestions)
+
+    graph = igo.load_graph(filename)
+    # The first call also assigns the highways to the edges.
+    results['build_igraph/first'] = timed(igo.build_igraph, graph,
+                                          complete_data)
+    results['build_igraph'] = median_time(repeat, igo.build_igraph, graph,
+                                          complete_data)
+
+    nodes = side * side
+    pairs = [(crossing(side, rng.randrange(nodes)),
+              crossing(side, rng.randrange(nodes))) for _ in range(queries)]
+    for algorithm in ('dijkstra', 'alt', 'ch'):
+        if algorithm == 'alt':
+            results['landmarks'] = timed(igo.landmarks, graph)
+        elif algorithm == 'ch':
+            results['customizable_hierarchy'] = timed(
+                igo.customizable_hierarchy, graph)
+            results['build_igraph/customize'] = median_time(
+                repeat, igo.build_igraph, graph, complete_data)
+        # A new snapshot, so that no path comes from the route cache
+        igo.build_igraph(graph, complete_data)
+        results['build_ipath/' + algorithm] = sum(
+            timed(igo.build_ipath, graph, origin, destiny, None, algorithm)
+            for origin, destiny in pairs) / queries
+    path = igo.build_ipath(graph, *pairs[0])
+    origin = rng.randrange(nodes)
+    results['isochrone'] = median_time(repeat, igo.isochrone, graph, origin,
+                                       300)
+    iso = igo.isochrone(graph, origin, 300)
+
+    results['plot_highways'] = median_time(
+        repeat, igo.plot_highways, highways, None, SIZE)
+    results['plot_congestions'] = median_time(
+        repeat, igo.plot_congestions, complete_data, None, SIZE)
+    results['plot_path'] = median_time(repeat, igo.plot_path, graph, path,
+                                       None, SIZE)
+    results['plot_isochrone'] = median_time(
+        repeat, igo.plot_isochrone, graph, iso, None, SIZE)
+    return results
+
+
+def bench_routing(graph: nx.MultiDiGraph, queries: int,
+                  seed: int = 0) -> dict:
+    '''Compares the networkx shortest path search, which is what
+    ox.shortest_path runs, with the searches of iGo over the same pairs.
+    Returns the seconds per query of each one, and the seconds it takes
+    to build what they need.
+    '''
+    rng = random.Random(seed)
+    nodes = list(graph.nodes)
+    pairs = [(rng.choice(nodes), rng.choice(nodes)) for _ in range(queries)]
+    igo.build_igraph(graph, [])
+    # networkx reads the itime from the edge attributes.
+    igo.to_networkx(graph)
+    results = dict()
+    # The first query also builds the CSR arrays of the graph.
+    results['csr'] = timed(igo._shortest_path, graph, *pairs[0])
+    results['query/networkx'] = sum(
+        timed(nx.shortest_path, graph, s, t, 'itime')
+        for s, t in pairs) / queries
+    results['query/dijkstra'] = sum(
+        timed(igo._shortest_path, graph, s, t) for s, t in pairs) / queries
+    results['contraction_hierarchy'] = timed(igo.contraction_hierarchy,
+                                             graph)
+    results['query/ch'] = sum(
+        timed(igo._shortest_path, graph, s, t, None, 'ch')
+        for s, t in pairs) / queries
+    results['landmarks'] = timed(igo.landmarks, graph)
+    results['query/alt'] = sum(
+        timed(igo._shortest_path, graph, s, t, None, 'alt')
+        for s, t in pairs) / queries
+    results['customizable_hierarchy'] = timed(igo.customizable_hierarchy,
+                                              graph)
+    results['customize'] = timed(igo.build_igraph, graph, [])
+    results['query/cch'] = sum(
+        timed(igo._shortest_path, graph, s, t, None, 'ch')
+        for s, t in pairs) / queries
+    return results
+
+
+def commit() -> str:
+    '''Returns the git commit of the working tree, or None if it is not
+    in a git repository.
+    '''
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+            check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: list, baseline: dict) -> None:
+    '''Prints the ratio of every result to the same one of a baseline,
+    marking those more than 20% slower.
+    '''
+    old = {(r['size'], r['name']): r['seconds']
+           for r in baseline['results']}
+    print('compared with {c}:'.format(c=baseline.get('commit')))
+    for r in results:
+        before = old.get((r['size'], r['name']))
+        if before:
+            ratio = r['seconds'] / before
+            print('  {s:4d} {n:32s} {r:6.2f}x{m}'.format(
+                s=r['size'], n=r['name'], r=ratio,
+                m='  slower' if ratio > 1.2 else ''))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmarks for iGo.')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[FIXTURE_SIDE, 60, 100],
+                        help='sides of the grid cities')
+    parser.add_argument('--queries', type=int, default=50,
+                        help='paths searched per grid and algorithm')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='calls of a stage whose median is taken')
+    parser.add_argument('--routing', action='store_true',
+                        help='also compare the searches with networkx')
+    parser.add_argument('--output', help='JSON file for the results')
+    parser.add_argument('--compare', help='JSON results to compare with')
+    parser.add_argument('--record-fixtures', action='store_true',
+                        help='write the recorded feeds again and exit')
+    args = parser.parse_args()
+    if args.record_fixtures:
+        record_fixtures()
+        return
+
+    results = list()
+    with tempfile.TemporaryDirectory() as directory:
+        go_offline(directory)
+        for side in args.sizes:
+            timings = bench_pipeline(side, args.queries, args.repeat,
+                                     directory)
+            if args.routing:
+                routing = bench_routing(grid_city(side), args.queries)
+                timings.update(('routing/' + name, seconds)
+                               for name, seconds in routing.items())
+            print('grid {s}x{s}:'.format(s=side))
+            for name, seconds in timings.items():
+                print('  {n:32s} {t:10.2f} ms'.format(n=name,
+                                                      t=seconds*1000))
+                results.append({'size': side, 'name': name,
+                                'seconds': seconds})
+            sys.stdout.flush()
+    report = {'commit': commit(), 'python': platform.python_version(),
+              'queries': args.queries, 'repeat': args.repeat,
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            compare(results, json.load(file))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,25 @@
 # %%
 import xml.etree.ElementTree as ET
+from datetime import datetime
 from html.entities import name2codepoint
 from html.parser import HTMLParser
 from urllib import request
 from time import sleep
+import functools
+import http.server
+import importlib.util
+import os
+import random
+import socket
+import tempfile
+import threading
+import numpy as np
+from PIL import Image
+import osmnx as ox
+from staticmap import CircleMarker, Line, StaticMap
 
 from igo import *
+import igo
 PLACE = 'Barcelona, Catalonia'
 GRAPH_FILENAME = 'barcelona.graph'
 SIZE = 800
@@ -214,3 +228,539 @@ res = get_location_name(41.607083814675924, 2.5447618961334233)
 root = ET.fromstring(res)
 
 # %%
+
+
+# %%
+# Building the igraph without traffic data snaps no points at all, which
+# must give no nodes instead of failing in the spatial index.
+
+
+def test_no_traffic_data():
+    square = nx.MultiDiGraph(crs='epsg:4326')
+    corners = [(2.15, 41.38), (2.16, 41.38), (2.16, 41.39), (2.15, 41.39)]
+    for node, (x, y) in enumerate(corners):
+        square.add_node(node, x=x, y=y)
+    for node in range(4):
+        square.add_edge(node, (node + 1) % 4, length=800.0)
+        square.add_edge((node + 1) % 4, node, length=800.0)
+    assert len(nearest_nodes(square, [], [])) == 0
+    assert build_igraph(square, [], _debug_nodes=True) == []
+
+
+test_no_traffic_data()
+
+
+# %%
+# The feeds are downloaded conditionally: the second download of a feed
+# that has not changed gets a 304 answer from the server and returns the
+# very same objects as the first one.
+
+
+def test_conditional_feeds():
+    statuses = list()
+
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def send_response(self, code, message=None):
+            statuses.append(code)
+            super().send_response(code, message)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', 0), functools.partial(Handler,
+                                            directory='bench-fixtures'))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = 'http://127.0.0.1:{p}/highways.csv'.format(
+            p=server.server_port)
+        first = download_highways(url)
+        second = download_highways(url)
+        assert statuses == [200, 304]
+        assert second is first
+        assert len(first) > 0
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+test_conditional_feeds()
+
+
+# %%
+# The geocoder asks its backend only once for every place: it answers
+# again from memory, from its sqlite file when the place has left the
+# memory or the geocoder is created again, and asks again when the
+# answer is older than its ttl.
+
+
+def test_geocoder_cache():
+    calls = list()
+
+    def backend(query):
+        calls.append(query)
+        return 41.4 + len(calls)/100, 2.17
+
+    filename = os.path.join(tempfile.mkdtemp(), 'geocoding.sqlite')
+    places = Geocoder(filename, backend, size=2)
+    point = places.geocode('Sagrada Família')
+    assert places.geocode('sagrada  familia') == point
+    assert len(calls) == 1 and places.stats().hits == 1
+    # The least recently used place leaves the memory, but not the disk.
+    places.geocode('Campus Nord')
+    places.geocode('Vallvidrera')
+    assert places.geocode('Sagrada Família') == point
+    assert len(calls) == 3 and places.stats().disk_hits == 1
+    places.close()
+    # Another geocoder finds the places in the file.
+    places = Geocoder(filename, backend)
+    assert places.geocode('Sagrada Família') == point
+    assert len(calls) == 3 and places.stats().disk_hits == 1
+    places.close()
+    # Expired answers are asked again, in memory and on disk.
+    places = Geocoder(filename, backend, ttl=0.2)
+    sleep(0.3)
+    places.geocode('Campus Nord')
+    places.geocode('Campus Nord')
+    assert len(calls) == 4
+    sleep(0.3)
+    places.geocode('Campus Nord')
+    assert len(calls) == 5
+    places.close()
+
+
+test_geocoder_cache()
+
+
+# %%
+# Maps can be rendered offline from a local tile directory, through the
+# tile cache, which fetches every tile once and reuses the base layer of
+# a view it has already rendered.
+
+
+def test_offline_tiles():
+    directory = tempfile.mkdtemp()
+    source = os.path.join(directory, 'source', '{z}', '{x}', '{y}.png')
+    center, zoom = (2.17, 41.39), 15
+    x, y = igo._tile(*center, zoom)
+    for i in range(x - 2, x + 3):
+        for j in range(y - 2, y + 3):
+            tile = source.format(z=zoom, x=i, y=j)
+            os.makedirs(os.path.dirname(tile), exist_ok=True)
+            Image.new('RGB', (256, 256), '#f2efe9').save(tile)
+
+    connections = list()
+
+    def connect(self, address):
+        connections.append(address)
+        raise OSError('no network in this test')
+
+    connect_before, tile_cache_before = socket.socket.connect, igo.tile_cache
+    socket.socket.connect = connect
+    try:
+        igo.tile_cache = igo.TileCache(os.path.join(directory, 'cache'),
+                                       source)
+        first = new_map(256)
+        first.add_marker(CircleMarker(center, 'blue', 10))
+        first.render(zoom=zoom, center=center)
+        fetched = igo.tile_cache.stats()
+        assert fetched.misses > 0 and fetched.tiles == fetched.misses
+        second = new_map(256)
+        second.add_marker(CircleMarker(center, 'red', 10))
+        second.render(zoom=zoom, center=center)
+        # The second map takes the whole base layer from the cache.
+        assert igo.tile_cache.stats() == fetched
+        assert connections == []
+    finally:
+        socket.socket.connect = connect_before
+        igo.tile_cache = tile_cache_before
+
+
+test_offline_tiles()
+
+
+# %%
+# The cells below route over the synthetic grid cities of igo-bench.py,
+# with the traffic of its recorded feeds, so they need no network.
+_spec = importlib.util.spec_from_file_location('bench', 'igo-bench.py')
+bench = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(bench)
+
+
+def traffic_grid(side, seed=0):
+    graph = bench.grid_city(side, seed)
+    highways = download_highways('file://' + bench.HIGHWAYS_FIXTURE)
+    congestions = download_congestions('file://' +
+                                       bench.CONGESTIONS_FIXTURE)
+    build_igraph(graph, build_complete_traffic_data(highways, congestions))
+    return graph
+
+
+# %%
+# The route cache keeps the maps of a route by their size, and its paths
+# cannot be changed through the routes it returns.
+
+
+def test_route_cache():
+    graph = traffic_grid(10)
+    first = route(graph, 0, 99)
+    path = list(first.path)
+    first.path.append(-1)
+    assert route(graph, 0, 99).path == path
+    cache_image(graph, first._replace(path=path), b'small', 100)
+    assert route(graph, 0, 99, size=100).image == b'small'
+    assert route(graph, 0, 99, size=200).image is None
+    cache_image(graph, first._replace(path=path), b'large', 200)
+    assert route(graph, 0, 99, size=100).image == b'small'
+    assert route(graph, 0, 99, size=200).image == b'large'
+    cached = route(graph, 0, 99, size=200)
+    cached.path.clear()
+    assert route(graph, 0, 99).path == path
+
+
+test_route_cache()
+
+
+# %%
+# Every graph renders its own congestion maps, so a render of one city
+# does not wait for the renders of another one.
+
+
+def test_congestion_render_locks():
+    bench.go_offline(tempfile.mkdtemp())
+    busy, other = traffic_grid(5), traffic_grid(5, seed=1)
+    rendered = list()
+    render = threading.Thread(
+        target=lambda: rendered.append(congestion_map(other, size=64)))
+    with busy.graph.setdefault('congestion_render_lock', threading.Lock()):
+        render.start()
+        render.join(timeout=60)
+        assert not render.is_alive() and len(rendered) == 1
+    assert congestion_map(busy, size=64)[:4] == b'\x89PNG'
+
+
+test_congestion_render_locks()
+
+
+# %%
+# The landmark bounds are scaled by the smallest congestion factor of the
+# snapshot: with no information on any street, ALT settles far fewer
+# nodes than Dijkstra and finds paths of the same itime.
+
+
+def test_alt_bounds():
+    graph = bench.grid_city(40)
+    build_igraph(graph, [])
+    landmarks(graph)
+    weights = current_snapshot(graph).weights
+    rng = random.Random(0)
+    settled, costs = dict(), dict()
+    was_enabled = igo.metrics.enabled
+    igo.metrics.enable()
+    try:
+        for algorithm in ('dijkstra', 'alt'):
+            before = igo.metrics.stats()['counters'].get('nodes_settled', 0)
+            rng.seed(0)
+            for _ in range(20):
+                s, t = rng.randrange(1600), rng.randrange(1600)
+                path = igo._shortest_path(graph, s, t, None, algorithm)
+                cost = igo._path_itime(graph, path, weights)
+                if algorithm == 'dijkstra':
+                    costs[s, t] = cost
+                else:
+                    assert abs(cost - costs[s, t]) < 1e-6
+            settled[algorithm] = igo.metrics.stats()['counters'][
+                'nodes_settled'] - before
+    finally:
+        if not was_enabled:
+            igo.metrics.disable()
+    assert settled['alt'] < settled['dijkstra'] / 3
+
+
+test_alt_bounds()
+
+
+# %%
+# The 'ch' mode finds paths of the same itime as Dijkstra with the static
+# contraction hierarchy and with the customizable one, also after it is
+# customized again for new itimes, and so does 'alt', with streets that
+# cannot be crossed (infinite itime) among them.
+
+
+def test_hierarchies():
+    graph = traffic_grid(20)
+    landmarks(graph)
+    rng = random.Random(0)
+    pairs = [(rng.randrange(400), rng.randrange(400)) for _ in range(60)]
+
+    def check(algorithm):
+        snapshot = current_snapshot(graph)
+        if algorithm == 'ch':
+            assert graph.graph['ch'].version == metric_version(graph)
+        for s, t in pairs:
+            expected = igo._shortest_path(graph, s, t, None, 'dijkstra')
+            path = igo._shortest_path(graph, s, t, None, algorithm)
+            if expected is None:
+                assert path is None
+                continue
+            assert path[0] == s and path[-1] == t
+            assert abs(igo._path_itime(graph, path, snapshot.weights) -
+                       igo._path_itime(graph, expected,
+                                       snapshot.weights)) < 1e-6
+
+    assert np.isinf(current_snapshot(graph).itime).any()
+    check('alt')
+    contraction_hierarchy(graph)
+    check('ch')
+    customizable_hierarchy(graph)
+    check('ch')
+    assert np.isfinite(graph.graph['ch'].up_weights).all()
+    assert np.isfinite(graph.graph['ch'].down_weights).all()
+    build_igraph(graph, [])
+    check('ch')
+    check('alt')
+
+
+test_hierarchies()
+
+
+# %%
+# The travel time matrix has the itime of the shortest paths networkx
+# finds, searching forwards or backwards and with or without processes,
+# and inf for the destinations that cannot be reached.
+
+
+def test_travel_time_matrix():
+    graph = traffic_grid(10)
+    G = to_networkx(graph)
+    rng = random.Random(0)
+    origins = [rng.randrange(100) for _ in range(6)] + [0, 0]
+    destinations = [rng.randrange(100) for _ in range(3)] + [0]
+
+    def expected(sources, targets):
+        return np.array([[
+            nx.single_source_dijkstra_path_length(G, s, weight='itime')
+            .get(t, float('inf')) for t in targets] for s in sources])
+
+    forward = expected(origins, destinations)
+    backward = expected(destinations, origins)
+    for processes in (None, 2):
+        matrix = travel_time_matrix(graph, origins, destinations,
+                                    processes=processes)
+        assert matrix.shape == (8, 4) and np.allclose(matrix, forward)
+        matrix = travel_time_matrix(graph, destinations, origins,
+                                    processes=processes)
+        assert matrix.shape == (4, 8) and np.allclose(matrix, backward)
+    points = [(G.nodes[s]['x'], G.nodes[s]['y']) for s in origins]
+    assert np.allclose(travel_time_matrix(graph, points, destinations),
+                       forward)
+
+
+test_travel_time_matrix()
+
+
+# %%
+# An isochrone has the nodes networkx reaches with the same cutoff, and
+# their itime, whether its location is a node or its coordinates.
+
+
+def test_isochrone():
+    graph = traffic_grid(10)
+    G = to_networkx(graph)
+    origin = 44
+    lengths = nx.single_source_dijkstra_path_length(G, origin,
+                                                    weight='itime')
+    seconds = float(np.median(list(lengths.values())))
+    expected = nx.single_source_dijkstra_path_length(G, origin,
+                                                     cutoff=seconds,
+                                                     weight='itime')
+    assert 1 < len(expected) < len(lengths)
+    for location in (origin, (G.nodes[origin]['x'], G.nodes[origin]['y'])):
+        iso = isochrone(graph, location, seconds)
+        assert iso.origin == origin and iso.seconds == seconds
+        assert set(iso.nodes.tolist()) == set(expected)
+        assert all(abs(itime - expected[node]) < 1e-9
+                   for node, itime in zip(iso.nodes.tolist(),
+                                          iso.itime.tolist()))
+        assert iso.polygon.area > 0
+
+
+test_isochrone()
+
+
+# %%
+# Traffic data built from congestions given as a dictionary or as a list
+# is the same, behaves as a list of Traffic_data, and the stores of a
+# highway list share its columns.
+
+
+def test_traffic_store():
+    highways = download_highways('file://' + bench.HIGHWAYS_FIXTURE)
+    congestions = download_congestions('file://' +
+                                       bench.CONGESTIONS_FIXTURE)
+    missing = list()
+    store = build_complete_traffic_data(highways, congestions, missing)
+    listed = build_complete_traffic_data(highways,
+                                         list(congestions.values()))
+    assert isinstance(store, TrafficStore) and len(store) == len(highways)
+    assert listed.ids is store.ids and listed.coordinates is store.coordinates
+    assert np.array_equal(listed.states, store.states)
+    assert np.array_equal(listed.timestamps, store.timestamps)
+    assert missing == [highway.id for highway in highways
+                       if highway.id not in congestions]
+    for data, highway in zip(store, highways):
+        assert data.id == highway.id and data.name == highway.name
+        assert np.array_equal(data.coordinates, highway.coordinates)
+        congestion = congestions.get(highway.id)
+        if congestion is None:
+            assert data.state is None and data.timestamp is None
+        else:
+            assert data.state == congestion.state
+            assert data.timestamp == congestion.timestamp
+    assert store[-1].id == highways[-1].id
+    # A repeated highway keeps its first congestion, as the dictionary does
+    first = next(iter(congestions.values()))
+    repeated = [first._replace(state=(first.state + 1) % 7)]
+    repeated = build_complete_traffic_data(
+        highways, list(congestions.values()) + repeated)
+    assert np.array_equal(repeated.states, store.states)
+    # The snapshots of a store and of its list of Traffic_data agree
+    graph = bench.grid_city(10)
+    build_igraph(graph, store)
+    congestion = current_snapshot(graph).congestion
+    build_igraph(graph, list(store))
+    assert np.array_equal(current_snapshot(graph).congestion, congestion)
+
+
+test_traffic_store()
+
+
+# %%
+# A warm start restores the graph with its assignment and its traffic
+# snapshot, and is only accepted for the graph it was saved for.
+
+
+def test_warm_start():
+    directory = tempfile.mkdtemp()
+    graph_filename = os.path.join(directory, 'graph')
+    other_filename = os.path.join(directory, 'other')
+    filename = os.path.join(directory, 'warm')
+    save_graph(bench.grid_city(10), graph_filename)
+    save_graph(bench.grid_city(10, seed=1), other_filename)
+    graph = load_graph(graph_filename)
+    try:
+        save_warm_start(graph, filename)
+        assert False, 'a graph without snapshot was saved'
+    except ValueError:
+        pass
+    highways = download_highways('file://' + bench.HIGHWAYS_FIXTURE)
+    congestions = download_congestions('file://' +
+                                       bench.CONGESTIONS_FIXTURE)
+    build_igraph(graph, build_complete_traffic_data(highways, congestions))
+    save_warm_start(graph, filename)
+    snapshot = current_snapshot(graph)
+    restored = load_warm_start(filename, graph_filename)
+    restored_snapshot = current_snapshot(restored)
+    assert restored_snapshot.version == snapshot.version
+    assert np.array_equal(restored_snapshot.itime, snapshot.itime)
+    assert np.array_equal(restored_snapshot.congestion, snapshot.congestion)
+    assert np.array_equal(restored_snapshot.traffic_data.states,
+                          snapshot.traffic_data.states)
+    assert restored.graph['assignment'].edges == \
+        graph.graph['assignment'].edges
+    assert route(restored, 0, 99).itime == route(graph, 0, 99).itime
+    build_igraph(restored, restored_snapshot.traffic_data)
+    assert current_snapshot(restored).version > snapshot.version
+    for arguments in ((filename, other_filename), (graph_filename,)):
+        try:
+            load_warm_start(*arguments)
+            assert False, 'a wrong warm start was loaded'
+        except ValueError:
+            pass
+
+
+test_warm_start()
+
+
+# %%
+# The congestion log keeps one row per feed time across reopenings, and
+# a traffic profile of feeds with the same states routes as the snapshot
+# of those states at any departure time.
+
+
+def test_traffic_profile():
+    directory = tempfile.mkdtemp()
+    graph = traffic_grid(10)
+    try:
+        route_at(graph, 0, 99, datetime(2021, 6, 1, 12))
+        assert False, 'a route was searched without a profile'
+    except ValueError:
+        pass
+    store = current_snapshot(graph).traffic_data
+    log = CongestionLog(os.path.join(directory, 'log'))
+    assert not log.append(TrafficStore.from_highways(store))
+    assert log.append(store) and not log.append(store)
+    # The next day at the same time, with the same states
+    assert log.append(TrafficStore(store.ids, store.names, store.offsets,
+                                   store.coordinates,
+                                   store.timestamps + 1000000, store.states))
+    log = CongestionLog(os.path.join(directory, 'log'))
+    times, states = log.rows()
+    assert len(log) == 2 and times[1] - times[0] == 24*3600
+    assert np.array_equal(log.ids, store.ids)
+    assert np.array_equal(states[0], store.states)
+    filename = os.path.join(directory, 'profile')
+    profile = traffic_profile(graph, log, filename)
+    assert profile.samples.sum() == 2
+    assert profile.factors.shape == (PROFILE_SLOTS, len(store) + 1)
+    assert traffic_profile(graph, log, filename).version == profile.version
+    expected = route(graph, 0, 99).itime
+    for departure in (datetime(2021, 6, 1, 12), datetime(2021, 6, 6, 3)):
+        result = route_at(graph, 0, 99, departure)
+        assert result.version is None and result.path[0] == 0
+        assert abs(result.itime - expected) < 1e-6
+
+
+test_traffic_profile()
+
+
+# %%
+# A city registry evicts the least recently used graphs when they take
+# more than its memory budget, keeps the last one used even alone over
+# it, and loads evicted graphs again when they are asked for.
+
+
+def test_city_registry():
+    directory = tempfile.mkdtemp()
+    registry = CityRegistry()
+    places = ['A, Test', 'B, Test', 'C, Test']
+    for seed, place in enumerate(places):
+        filename = os.path.join(directory, str(seed))
+        save_graph(bench.grid_city(10, seed), filename)
+        registry.register(place, filename)
+    first = registry.get(places[0])
+    assert registry.get(places[0]) is first
+    assert first.graph['city'] == 'A'
+    size = registry.memory()
+    assert size > 0
+    # Room for two of the graphs, which take the same bytes
+    registry.memory_budget = 2.5*size
+    registry.get(places[1])
+    registry.get(places[2])
+    stats = {stats.place: stats for stats in registry.stats()}
+    assert not stats[places[0]].loaded and stats[places[0]].evictions == 1
+    assert stats[places[1]].loaded and stats[places[2]].loaded
+    assert registry.memory() == 2*size
+    registry.get(places[1])
+    assert registry.get(places[0]) is not first
+    stats = {stats.place: stats for stats in registry.stats()}
+    assert [stats[place].loaded for place in places] == [True, True, False]
+    assert stats[places[0]].loads == 2 and stats[places[1]].hits == 1
+    registry.memory_budget = size / 2
+    registry.get(places[2])
+    stats = {stats.place: stats for stats in registry.stats()}
+    assert [stats[place].loaded for place in places] == [False, False, True]
+    assert registry.memory() == size
+
+
+test_city_registry()
@@ -12,14 +12,40 @@ Catalonia, but can be (roughly) extended if one is keen on tinkering with
 the module to work with other data formats.
 '''
 
-from collections import namedtuple
-from typing import List, Optional, Union
-from staticmap import StaticMap, Line, CircleMarker
+from collections import OrderedDict, namedtuple
+from concurrent.futures import (Future, ProcessPoolExecutor,
+                                ThreadPoolExecutor)
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import chain, count
+from typing import (Any, BinaryIO, Callable, Dict, Iterable, List, Optional,
+                    Sequence, Tuple, Union)
 from urllib import request
+from urllib.error import HTTPError
+import bisect
 import csv
-import osmnx as ox
+import functools
+import hashlib
+import heapq
+import io
+import json
+import math
 import networkx as nx
+import numpy as np
+import os
 import pickle
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import unicodedata
+import warnings
+
+# osmnx, staticmap, sklearn and shapely are slow to import, so they are
+# only imported by the functions that need them. A bot that starts from a
+# warm start file (see 'load_warm_start') can answer before they are loaded.
 
 # We create the following types as named tuples from the collections
 # standard module.
@@ -37,12 +63,160 @@ Traffic_data = namedtuple(
 # code cleaner and easier to understand.
 highway_list = List[Highway]
 congestion_list = List[Congestion]
+congestion_index = Dict[int, Congestion]
 traffic_data_list = List[Traffic_data]
 
+# The routing core does not walk the networkx dictionaries, but a compact
+# copy of the graph in Compressed Sparse Row (CSR) form. Nodes are mapped
+# to the contiguous integers 0..n-1 (their position in the sorted
+# 'node_ids' array) and the edges leaving node i are the positions
+# offsets[i]..offsets[i+1]-1 of the 'targets', 'keys', 'length' and
+# 'maxspeed' arrays. The geometry of edge e, if it has one, is given by
+# the points geometry_offsets[e]..geometry_offsets[e+1]-1 of the
+# 'geometry_coords' array. The 'r_' arrays are the same structure for the
+# reversed graph, where 'r_edges' gives the position of each reversed edge
+# in the forward arrays so that both directions can share a single weight
+# array. Finally, like networkx graphs, it has a 'graph' dictionary with
+# its attributes (such as 'crs') and everything that is computed for it.
+Csr_graph = namedtuple(
+    'Csr_graph', ['node_ids', 'x', 'y', 'offsets', 'targets', 'keys',
+                  'length', 'maxspeed', 'geometry_offsets',
+                  'geometry_coords', 'r_offsets', 'r_sources', 'r_edges',
+                  'graph'])
+
 # This last one is used to annotate type even if we are not sure of what
 # is going to come as a parameter, but are quite sure that will be one
-# of the two types listed in the Union.
-graph_type = Union[nx.MultiDiGraph, nx.DiGraph]
+# of the types listed in the Union.
+graph_type = Union[nx.MultiDiGraph, nx.DiGraph, Csr_graph]
+
+# Where the plot_* functions put the maps they render: a file name, a
+# binary buffer they write PNG data to, or None to return the PNG bytes.
+image_target = Union[str, BinaryIO, None]
+
+# The traffic state build_igraph computes for a graph: the traffic data
+# it was computed from and the congestion code and itime of every edge in
+# CSR order, as read-only arrays (see _PONDERATION_FACTORS for the codes).
+# 'weights' is the itime as a tuple, which is faster to index one element
+# at a time in the searches. Snapshots are never modified, but replaced by
+# a new one with a greater version, so a search that takes one at its
+# start sees a consistent state of the traffic until it finishes.
+Traffic_snapshot = namedtuple(
+    'Traffic_snapshot', ['version', 'traffic_data', 'congestion', 'itime',
+                         'weights'])
+_snapshot_versions = count(1)
+
+# The typical traffic of a graph at every time of the week, built from a
+# CongestionLog (see 'build_traffic_profile'). 'factors' has a row for
+# every slot of the week and a column for every highway of the log, with
+# the median ponderation of the congestion states logged for it in that
+# slot, and a last column with the ponderation of the edges of no highway.
+# 'edge_columns' is the column of every edge in CSR order, so the itime
+# of edge e in slot s is its free flow itime times factors[s,
+# edge_columns[e]]. 'samples' is the number of logged feeds of every slot.
+Traffic_profile = namedtuple(
+    'Traffic_profile', ['version', 'factors', 'edge_columns', 'samples'])
+
+# A Contraction Hierarchy of a graph for the itime of a traffic snapshot.
+# Nodes are contracted in the order given by 'rank', adding shortcut edges
+# that keep the distances between the remaining nodes. The upward graph
+# has, for every node, its edges (original or shortcut) to higher-ranked
+# nodes, and the downward graph its edges from higher-ranked nodes, both
+# in CSR form. 'middle' is the node a shortcut skips, or -1 for original
+# edges. The version identifies the graph and itime it was built for.
+Contraction_hierarchy = namedtuple(
+    'Contraction_hierarchy', ['version', 'rank', 'up_offsets', 'up_targets',
+                              'up_weights', 'up_middle', 'down_offsets',
+                              'down_sources', 'down_weights', 'down_middle'])
+
+# A Customizable Contraction Hierarchy of a graph, which does not depend
+# on the itime. Nodes are ranked by a nested dissection of the graph, and
+# every node is joined (in both directions) to the higher-ranked nodes
+# given by 'offsets' and 'neighbours', a CSR graph that contains the
+# original edges plus all the shortcuts any itime could need. 'edge_map'
+# gives for every edge of the graph its edge in the hierarchy, and
+# 'edge_direction' whether it goes up (0) or down (1) the ranks, or -1 for
+# loops. Finally, for every triangle v < a < b of the hierarchy, 'tri_low',
+# 'tri_high' and 'tri_top' are its edges v-a, v-b and a-b and 'tri_middle'
+# its node v. Triangles are sorted by the level of v in the elimination
+# tree, and those of level i are the ones in level_offsets[i] ..
+# level_offsets[i+1]-1. The version identifies the graph it was built for.
+Customizable_hierarchy = namedtuple(
+    'Customizable_hierarchy', ['version', 'rank', 'offsets', 'neighbours',
+                               'edge_map', 'edge_direction', 'tri_middle',
+                               'tri_low', 'tri_high', 'tri_top',
+                               'level_offsets'])
+
+# Landmarks of a graph for the A* searches of the 'alt' mode: their
+# positions in the CSR arrays ('nodes') and, as one float32 row for each of
+# them, the free-flow itime from the landmark to every node ('forward') and
+# from every node to the landmark ('backward'), or inf if there is no path.
+# The version identifies the graph they were computed for.
+Landmarks = namedtuple('Landmarks', ['version', 'nodes', 'forward',
+                                     'backward'])
+
+# The last response of every feed downloaded with 'fetch_feed': the
+# validators the server sent with it and the result of parsing it.
+Feed = namedtuple('Feed', ['etag', 'last_modified', 'data'])
+_feeds: Dict[str, Feed] = dict()
+
+# Hit and miss counters of a Geocoder. A hit is a query answered from
+# memory, a disk hit one answered from the on-disk store, and a miss one
+# that had to be sent to the geocoding backend.
+Geocoding_stats = namedtuple(
+    'Geocoding_stats', ['hits', 'disk_hits', 'misses'])
+
+# A route between two nodes of a graph for the itime of the traffic
+# snapshot with the given version: its list of OSM nodes (None if there is
+# no path), its total itime, and the map of the path rendered as PNG
+# bytes of some size, or None if it has not been rendered.
+Route = namedtuple('Route', ['origin', 'destination', 'version', 'path',
+                             'itime', 'image'])
+
+# The nodes of a graph that can be reached within 'seconds' of itime from
+# the origin node, as an array of OSM ids, the itime to each of them, and
+# the polygon that covers them (the convex hull of their coordinates).
+Isochrone = namedtuple('Isochrone', ['origin', 'seconds', 'nodes', 'itime',
+                                     'polygon'])
+
+# A map rendered for the traffic snapshot with the given version, at the
+# given size, as PNG bytes.
+Rendered_map = namedtuple('Rendered_map', ['version', 'size', 'image'])
+
+# Counters of a TileCache: tiles read from disk (hits) or fetched from
+# the tile source (misses), and the tiles and bytes it holds.
+Tile_cache_stats = namedtuple(
+    'Tile_cache_stats', ['hits', 'misses', 'tiles', 'bytes'])
+
+# Counters of a RouteCache: lookups answered from it (hits) or not
+# (misses), times it was emptied for a new snapshot, the routes it holds,
+# and the ratio of hits over all lookups.
+Route_cache_stats = namedtuple(
+    'Route_cache_stats', ['hits', 'misses', 'invalidations', 'size',
+                          'hit_rate'])
+
+# A city of a CityRegistry: the place OSMnx downloads its graph for, the
+# name appended to the queries geocoded in it, the file of its graph, the
+# URLs of its traffic feeds, and the files its highway assignment and its
+# warm start are kept in, if any.
+City = namedtuple(
+    'City', ['place', 'name', 'graph_filename', 'highways_url',
+             'congestions_url', 'assignment_filename',
+             'warm_start_filename'])
+
+# Counters of a city of a CityRegistry: whether its graph is loaded and
+# the bytes it takes (estimated, see '_memory_size'), how many times and
+# for how many seconds in total it was loaded, the lookups that found it
+# loaded (hits), and the times it was evicted.
+City_stats = namedtuple(
+    'City_stats', ['place', 'loaded', 'bytes', 'loads', 'load_seconds',
+                   'hits', 'evictions'])
+
+# The edges of the graph every highway goes through, as positions in the
+# CSR arrays, together with the nodes that could not be joined by a path.
+# Both are dictionaries indexed by highway id. The version identifies the
+# highway geometry and graph the assignment was computed for.
+Highway_assignment = namedtuple(
+    'Highway_assignment', ['version', 'edges', 'unreachable'])
 
 
 # The following constant is used to ponderate the time it takes to drive
@@ -50,6 +224,18 @@ graph_type = Union[nx.MultiDiGraph, nx.DiGraph]
 CONGESTION_PONDERATIONS = {None: 1.75, 0: 1.75, 1: 1, 2: 1.25,
                            3: 1.5, 4: 2, 5: 3, 6: float('inf')}
 
+# The congestion of the edges is kept as an array of codes, which are the
+# congestion states except for None, that is coded as -1. This is the
+# array of ponderations indexed by code + 1.
+_PONDERATION_FACTORS = np.array(
+    [CONGESTION_PONDERATIONS[None]] +
+    [CONGESTION_PONDERATIONS[state] for state in range(7)])
+
+# Time-dependent traffic profiles have a slot for every quarter of an hour
+# of the week, starting on Monday at 00:00.
+PROFILE_SLOT_SECONDS = 15*60
+PROFILE_SLOTS = 7*24*3600 // PROFILE_SLOT_SECONDS
+
 # The following constant is used to decide the color of a certain
 # congestion state. Here is the color legend:
 # - If state is 'no information': grey
@@ -62,6 +248,213 @@ CONGESTION_PONDERATIONS = {None: 1.75, 0: 1.75, 1: 1, 2: 1.25,
 COLORS = {0: '#8f8f8f', 1: '#03fc2c', 2: '#c2fc03', 3: '#fc8f00',
           4: '#ff8000', 5: '#fc0000', 6: '#1c008a', None: '#1c008a'}
 
+# Tile server maps are rendered with unless another source is configured
+OSM_TILES = 'https://a.tile.openstreetmap.org/{z}/{x}/{y}.png'
+# Bounding box (west, south, east, north) of Barcelona, whose tiles can be
+# prefetched, and the zooms of the maps of the city and of its routes
+BARCELONA_BBOX = (2.05, 41.32, 2.23, 41.47)
+PREFETCH_ZOOMS = range(12, 16)
+# City whose name is appended to the geocoded queries, unless the graph
+# has another one in its 'city' attribute
+DEFAULT_CITY = 'Barcelona'
+
+# Graph files written by save_graph start with this magic string and the
+# version of their format, followed by the length of a JSON header that
+# describes where every array of the Csr_graph is stored in the file.
+GRAPH_MAGIC = b'IGOGRAPH'
+GRAPH_FORMAT_VERSION = 1
+_GRAPH_ARRAYS = Csr_graph._fields[:-1]
+_GRAPH_ALIGNMENT = 64
+
+
+# Upper bounds, in seconds, of the buckets of the span histograms
+SPAN_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                0.5, 1, 2.5, 5, 10, 30)
+
+
+class Metrics:
+    '''Opt-in instrumentation of the module. While it is enabled, the
+    functions marked as 'instrumented' time their calls as spans, which
+    are aggregated into one histogram per name, and the hot paths add to
+    counters (nodes settled, cache hits and misses, feed sizes). Every
+    span and count is also passed to the sinks, objects with 'span(name,
+    seconds)' and 'count(name, value)' methods such as JsonLinesSink.
+    While it is disabled, which is the default, all this costs a check of
+    a flag per call.
+    '''
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.sinks = list()
+        self._lock = threading.Lock()
+        # Span name -> counts of its buckets (and the +Inf one), total
+        # seconds and number of spans
+        self._histograms = dict()
+        self._counters = dict()
+        self._events = None
+
+    def enable(self, *sinks) -> None:
+        '''Starts measuring, passing the measures to the received sinks
+        too.
+        '''
+        self.sinks.extend(sinks)
+        self.enabled = True
+
+    def disable(self) -> None:
+        '''Stops measuring.'''
+        self.enabled = False
+
+    def observe(self, name: str, seconds: float) -> None:
+        '''Adds a span to the histogram of its name.'''
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = [0] * (len(SPAN_BUCKETS) + 3)
+                self._histograms[name] = histogram
+            histogram[bisect.bisect_left(SPAN_BUCKETS, seconds)] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+            if self._events is not None:
+                self._events.append(('span', name, seconds))
+        for sink in self.sinks:
+            sink.span(name, seconds)
+
+    def count(self, name: str, value: float = 1) -> None:
+        '''Adds a value to a counter.'''
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+            if self._events is not None:
+                self._events.append(('count', name, value))
+        for sink in self.sinks:
+            sink.count(name, value)
+
+    def record_events(self) -> None:
+        '''Keeps every measure from now on in a list of events instead of
+        passing it to the sinks, so that a worker process can send them to
+        its parent process, which replays them.
+        '''
+        self.sinks = list()
+        self._events = list()
+
+    def take_events(self) -> list:
+        '''Returns the events recorded since the last call.'''
+        with self._lock:
+            events, self._events = self._events, list()
+        return events
+
+    def replay(self, events: Iterable[tuple]) -> None:
+        '''Measures the events recorded by another process.'''
+        for kind, name, value in events:
+            if kind == 'span':
+                self.observe(name, value)
+            else:
+                self.count(name, value)
+
+    def stats(self) -> dict:
+        '''Returns the number and total seconds of the spans of every
+        name, and the value of every counter.
+        '''
+        with self._lock:
+            return {'spans': {name: {'count': h[-1], 'seconds': h[-2]}
+                              for name, h in self._histograms.items()},
+                    'counters': dict(self._counters)}
+
+    def prometheus(self) -> str:
+        '''Returns the measures in the Prometheus text format.'''
+        lines = ['# TYPE igo_span_seconds histogram']
+        with self._lock:
+            for name, histogram in sorted(self._histograms.items()):
+                total = 0
+                for bound, n in zip(SPAN_BUCKETS + ('+Inf',), histogram):
+                    total += n
+                    lines.append('igo_span_seconds_bucket{{span="{s}",'
+                                 'le="{b}"}} {n}'.format(s=name, b=bound,
+                                                         n=total))
+                lines.append('igo_span_seconds_sum{{span="{s}"}} {t}'
+                             .format(s=name, t=histogram[-2]))
+                lines.append('igo_span_seconds_count{{span="{s}"}} {n}'
+                             .format(s=name, n=histogram[-1]))
+            lines.append('# TYPE igo_events_total counter')
+            for name, value in sorted(self._counters.items()):
+                lines.append('igo_events_total{{name="{c}"}} {v}'
+                             .format(c=name, v=value))
+        return '\n'.join(lines) + '\n'
+
+
+# Instrumentation of the module, disabled until 'metrics.enable()'
+metrics = Metrics()
+
+
+def instrumented(name: str) -> Callable:
+    '''Decorator that times the calls of a function as spans of the given
+    name while the metrics of the module are enabled.
+    '''
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not metrics.enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                metrics.observe(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+class JsonLinesSink:
+    '''Metrics sink that appends every span and count to a file as a line
+    of JSON.
+    '''
+
+    def __init__(self, filename: str) -> None:
+        self._file = open(filename, 'a', buffering=1)
+        self._lock = threading.Lock()
+
+    def _write(self, record: dict) -> None:
+        line = json.dumps(record)
+        with self._lock:
+            self._file.write(line + '\n')
+
+    def span(self, name: str, seconds: float) -> None:
+        self._write({'time': time.time(), 'span': name, 'seconds': seconds})
+
+    def count(self, name: str, value: float) -> None:
+        self._write({'time': time.time(), 'counter': name, 'value': value})
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    '''Serves the metrics of the module at /metrics.'''
+
+    def do_GET(self) -> None:
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+def serve_metrics(port: int = 9100,
+                  host: str = '127.0.0.1') -> ThreadingHTTPServer:
+    '''Serves the metrics of the module in the Prometheus text format at
+    http://host:port/metrics from a background thread, only on localhost
+    by default. Returns the server, which stops with its 'shutdown'.
+    '''
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
 
 def exists_graph(filename: str) -> bool:
     '''Checks if a certain graph file exists within the current working
@@ -74,33 +467,159 @@ def exists_graph(filename: str) -> bool:
     return True
 
 
-def load_graph(filename: str) -> nx.MultiDiGraph:
+def _is_array_file(filename: str) -> bool:
+    '''Checks if a file was written by '_save_arrays'.'''
+    with open(filename, 'rb') as file:
+        return file.read(len(GRAPH_MAGIC)) == GRAPH_MAGIC
+
+
+def _save_arrays(filename: str, arrays: Dict[str, np.ndarray],
+                 attributes: dict) -> None:
+    '''Saves a set of named arrays as a file in the binary format of graph
+    files: the magic string, the format version and the length of a JSON
+    header, the header itself, which has the received attributes and the
+    place of every array, and then the arrays, aligned in the file.
+    '''
+    table = list()
+    offset = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        table.append((name, array.dtype.str, array.shape, offset))
+        offset = _align(offset + array.nbytes)
+    header = json.dumps(dict(attributes, arrays=table)).encode('utf-8')
+    with open(filename, 'wb') as file:
+        file.write(GRAPH_MAGIC)
+        file.write(struct.pack('<II', GRAPH_FORMAT_VERSION, len(header)))
+        file.write(header)
+        start = _align(file.tell())
+        for name, _, _, offset in table:
+            file.seek(start + offset)
+            file.write(np.ascontiguousarray(arrays[name]).tobytes())
+
+
+def _load_arrays(filename: str) -> tuple:
+    '''Memory-maps the arrays of a file written by '_save_arrays'. Returns
+    a dictionary with the arrays and another one with the attributes of
+    the file.
+    '''
+    with open(filename, 'rb') as file:
+        file.seek(len(GRAPH_MAGIC))
+        version, header_length = struct.unpack('<II', file.read(8))
+        if version != GRAPH_FORMAT_VERSION:
+            raise ValueError('Unsupported graph format version {v} in {f}'
+                             .format(v=version, f=filename))
+        header = json.loads(file.read(header_length).decode('utf-8'))
+    data = np.memmap(filename, dtype=np.uint8, mode='r')
+    start = _align(len(GRAPH_MAGIC) + 8 + header_length)
+    arrays = dict()
+    for name, dtype, shape, offset in header.pop('arrays'):
+        dtype = np.dtype(dtype)
+        size = dtype.itemsize * int(np.prod(shape))
+        arrays[name] = data[start + offset:start + offset + size] \
+            .view(dtype).reshape(shape)
+    return arrays, header
+
+
+def load_graph(filename: str) -> graph_type:
     '''Loads a certain file from the current working directory, assuming
     it exists. This can be checked with the 'exists_graph' function.
+    The arrays of the graph are memory-mapped instead of read, so loading
+    takes the same time whatever the size of the graph, and processes
+    that load the same file share its pages.
     '''
-    with open(filename, 'rb') as file:
-        graph = pickle.load(file)
-    # MultiDiGraph allows plotting using OSMnx built-in functions
-    graph = nx.MultiDiGraph(incoming_graph_data=graph)
-    return graph
+    if not _is_array_file(filename):
+        # Files saved by older versions of this module are pickled
+        # networkx graphs, which we can still read.
+        with open(filename, 'rb') as file:
+            graph = pickle.load(file)
+        if not isinstance(graph, nx.MultiDiGraph):
+            graph = nx.MultiDiGraph(incoming_graph_data=graph)
+        return graph
+    arrays, attributes = _load_arrays(filename)
+    # Warm start files have more arrays after the ones of the graph.
+    return Csr_graph(graph={'crs': attributes['crs']},
+                     **{name: arrays[name] for name in _GRAPH_ARRAYS})
 
 
 def download_graph(place: str) -> nx.MultiDiGraph:
     '''Downloads the street graph from a physical place from the OSM
     database and returns it as a OSMnx graph object.
     '''
+    import osmnx as ox
     graph = ox.graph_from_place(place, network_type='drive',
                                 simplify=True)
     return graph
 
 
+def _align(offset: int) -> int:
+    '''Rounds an offset of a graph file up to the alignment of its
+    arrays.
+    '''
+    return -(-offset // _GRAPH_ALIGNMENT) * _GRAPH_ALIGNMENT
+
+
 def save_graph(G: graph_type, filename: str) -> None:
     '''Saves the received graph G as a file in the current working
-    directory using the pickle library.
+    directory, in the binary format read by 'load_graph': a header followed
+    by the arrays of its CSR representation. Only the attributes iGo uses
+    are kept: node coordinates and edge lengths, maxspeeds and geometries.
     '''
-    G = nx.MultiDiGraph(incoming_graph_data=G)
-    with open(filename, 'wb') as file:
-        pickle.dump(G, file)
+    csr = _csr(G)
+    crs = csr.graph.get('crs')
+    _save_arrays(filename,
+                 {name: getattr(csr, name) for name in _GRAPH_ARRAYS},
+                 {'crs': None if crs is None else str(crs)})
+
+
+def to_networkx(graph: graph_type) -> nx.MultiDiGraph:
+    '''Returns the networkx version of the received graph, which OSMnx
+    functions need. Graphs loaded with 'load_graph' are only converted the
+    first time this is asked, and have only the attributes iGo uses. The
+    edges get the attributes 'congestion' and 'itime' of the current traffic
+    snapshot, if build_igraph has computed one.
+    '''
+    if not isinstance(graph, Csr_graph):
+        G = graph
+        if not isinstance(graph, nx.MultiDiGraph):
+            G = nx.MultiDiGraph(incoming_graph_data=graph)
+        _write_igraph_attributes(graph, G)
+        return G
+    if 'networkx' not in graph.graph:
+        G = nx.MultiDiGraph(crs=graph.graph.get('crs'))
+        node_ids = graph.node_ids.tolist()
+        G.add_nodes_from((node, {'x': x, 'y': y}) for node, x, y in zip(
+            node_ids, graph.x.tolist(), graph.y.tolist()))
+        geometry_offsets = graph.geometry_offsets.tolist()
+        for e, (u, v, k) in enumerate(_edge_keys(graph)):
+            info = {'length': float(graph.length[e])}
+            if not math.isnan(graph.maxspeed[e]):
+                info['maxspeed'] = float(graph.maxspeed[e])
+            start, end = geometry_offsets[e], geometry_offsets[e + 1]
+            if start < end:
+                from shapely.geometry import LineString
+                info['geometry'] = LineString(
+                    graph.geometry_coords[start:end])
+            G.add_edge(u, v, key=k, **info)
+        graph.graph['networkx'] = G
+    _write_igraph_attributes(graph, graph.graph['networkx'])
+    return graph.graph['networkx']
+
+
+def _write_igraph_attributes(graph: graph_type, G: nx.MultiDiGraph) -> None:
+    '''Writes the congestion and itime of the current traffic snapshot of
+    the graph as attributes of the edges of its networkx version G, unless
+    they are already there.
+    '''
+    snapshot = graph.graph.get('snapshot')
+    if snapshot is None or G.graph.get('snapshot_version') == snapshot.version:
+        return
+    for (a, b, k), code, itime in zip(_edge_keys(graph),
+                                      snapshot.congestion.tolist(),
+                                      snapshot.itime.tolist()):
+        info = G.adj[a][b][k]
+        info['congestion'] = None if code < 0 else code
+        info['itime'] = itime
+    G.graph['snapshot_version'] = snapshot.version
 
 
 def plot_graph(G: graph_type, save: bool = False,
@@ -108,81 +627,717 @@ def plot_graph(G: graph_type, save: bool = False,
     '''Plots the received graph using the OSMnx plot function. Can save
     the image if needed through the arguments 'save' and 'filename'.
     '''
-    fig, _ = ox.plot_graph(nx.MultiDiGraph(incoming_graph_data=G))
+    import osmnx as ox
+    fig, _ = ox.plot_graph(to_networkx(G))
     if save:
         fig.savefig(filename)
 
 
-def download_highways(highways_url: str) -> highway_list:
-    '''Downloads the highway data from the received url.'''
+def fetch_feed(url: str, parse: Callable[[Iterable[str]], Any]) -> Any:
+    '''Downloads the text feed in the received url and parses it with
+    'parse', which receives the lines of the feed as they arrive instead of
+    the whole file. The validators the server sends (ETag, Last-Modified)
+    are kept together with the result, so the next time the request is
+    conditional: if the feed has not changed the server answers 304 and the
+    previous result is returned without downloading or parsing anything.
+    '''
+    cached = _feeds.get(url)
+    headers = dict()
+    if cached is not None:
+        if cached.etag is not None:
+            headers['If-None-Match'] = cached.etag
+        if cached.last_modified is not None:
+            headers['If-Modified-Since'] = cached.last_modified
+    try:
+        with request.urlopen(request.Request(url, headers=headers)) \
+                as response:
+            data = parse(io.TextIOWrapper(response, encoding='utf-8',
+                                          newline=''))
+            _feeds[url] = Feed(response.headers.get('ETag'),
+                               response.headers.get('Last-Modified'), data)
+            if metrics.enabled:
+                metrics.count('feed_rows', len(data))
+                length = response.headers.get('Content-Length')
+                if length is not None:
+                    metrics.count('feed_bytes', int(length))
+    except HTTPError as error:
+        if error.code == 304 and cached is not None:
+            if metrics.enabled:
+                metrics.count('feed_not_modified')
+            return cached.data
+        raise
+    return data
+
+
+def _parse_highways(lines: Iterable[str]) -> highway_list:
+    '''Parses the lines of the highway data.'''
     highways = list()
-    with request.urlopen(highways_url) as response:
-        lines = [l.decode('utf-8') for l in response.readlines()]
-        reader = csv.reader(lines, delimiter=',', quotechar='"')
-        next(reader)  # ignore first line with description
-        for line in reader:
-            way_id, description, coordinates = line
-            coord = coordinates.split(',')
-            highways.append(Highway(int(way_id), description,
-                            [float(g) for g in coord]))
+    reader = csv.reader(lines, delimiter=',', quotechar='"')
+    next(reader)  # ignore first line with description
+    for line in reader:
+        way_id, description, coordinates = line
+        coord = coordinates.split(',')
+        highways.append(Highway(int(way_id), description,
+                        [float(g) for g in coord]))
     return highways
 
 
-def download_congestions(congestions_url: str) -> congestion_list:
-    '''Downloads the congestion data from the received url.'''
-    congestions = list()
-    with request.urlopen(congestions_url) as response:
-        lines = [l.decode('utf-8') for l in response.readlines()]
-        reader = csv.reader(lines, delimiter='#', quotechar='"')
-        for line in reader:
-            way_id, timestamp, current_state, _ = line
-            congestions.append(Congestion(
-                int(way_id), timestamp, int(current_state)))
-    return congestions
+@instrumented('download_highways')
+def download_highways(highways_url: str) -> highway_list:
+    '''Downloads the highway data from the received url. If it has not
+    changed since the last download, the same list is returned again.
+    '''
+    return fetch_feed(highways_url, _parse_highways)
 
 
-def _find_corresponding_congestion_data(highway: Highway,
-                                        congestions: congestion_list) -> Congestion:
-    '''Given a Highway and a list of Congestions, finds the congestion
-    corresponding to the Highway data using their ID attributes.
+def _index_congestions(congestions: congestion_list) -> congestion_index:
+    '''Indexes a list of Congestions by their ID attribute. If an ID is
+    repeated, the first Congestion with it is kept.
     '''
+    index = dict()
     for congestion in congestions:
-        if congestion.id == highway.id:
-            return congestion
+        index.setdefault(congestion.id, congestion)
+    return index
 
 
-def _repack(highway: Highway, congestion: Congestion) -> Traffic_data:
-    '''Utility function to convert a corresponding Highway, Congestion
-    pair into a Traffic_data object.
+def _parse_congestions(lines: Iterable[str]) -> congestion_index:
+    '''Parses the lines of the congestion data, indexing them by highway
+    ID as they are read.
     '''
-    id, name, coordinates = highway
-    _, datetime, current_state = congestion
-    return Traffic_data(id, name, coordinates, datetime, current_state)
+    congestions = dict()
+    reader = csv.reader(lines, delimiter='#', quotechar='"')
+    for line in reader:
+        way_id, timestamp, current_state, _ = line
+        congestions.setdefault(int(way_id), Congestion(
+            int(way_id), timestamp, int(current_state)))
+    return congestions
 
 
-def build_complete_traffic_data(highways: highway_list,
-                                congestions: congestion_list) -> traffic_data_list:
-    '''Utility function to construct a list of Traffic_data elements
-    given corresponding Highway and Congestion lists.
+@instrumented('download_congestions')
+def download_congestions(congestions_url: str) -> congestion_index:
+    '''Downloads the congestion data from the received url. The data is
+    returned indexed by highway ID, so that it can be joined with the
+    highway data in a single pass. If it has not changed since the last
+    download, the same dictionary is returned again.
     '''
-    complete_traffic_state_data = list()
-    for highway in highways:
-        congestion = _find_corresponding_congestion_data(highway,
-                                                         congestions)
-        repacked_data = _repack(highway, congestion)
-        complete_traffic_state_data.append(repacked_data)
-    return complete_traffic_state_data
+    return fetch_feed(congestions_url, _parse_congestions)
+
+
+class TrafficStore:
+    '''Traffic data of a list of highways kept as columns instead of as
+    Traffic_data tuples: the 'ids', the 'names', the 'states' (int8, -1
+    for no information) and the 'timestamps' (int64 as yyyymmddHHMMSS, 0
+    for none) of the highways, and all their coordinates in a single
+    float64 buffer, where the ones of highway i are the positions
+    offsets[i]..offsets[i+1]-1.
+
+    The ids, names, offsets and coordinates only depend on the highways,
+    and are shared by all the stores built for the same highway list (see
+    'with_congestions'), so a refresh of the congestion data only allocates
+    the states and timestamps. Indexing or iterating a store gives the
+    Traffic_data tuples of the highways, whose coordinates are views of the
+    shared buffer, so it can be used wherever a traffic_data_list is.
+    '''
+
+    def __init__(self, ids: np.ndarray, names: List[str],
+                 offsets: np.ndarray, coordinates: np.ndarray,
+                 timestamps: Optional[np.ndarray] = None,
+                 states: Optional[np.ndarray] = None) -> None:
+        self.ids = ids
+        self.names = names
+        self.offsets = offsets
+        self.coordinates = coordinates
+        self.timestamps = np.zeros(len(ids), dtype=np.int64) \
+            if timestamps is None else timestamps
+        self.states = np.full(len(ids), -1, dtype=np.int8) \
+            if states is None else states
+
+    @classmethod
+    def from_highways(cls, highways: Union[highway_list, traffic_data_list]
+                      ) -> 'TrafficStore':
+        '''Returns a store of the received highways without congestion
+        data.
+        '''
+        lengths = np.fromiter((len(highway.coordinates)
+                               for highway in highways), dtype=np.int64,
+                              count=len(highways))
+        offsets = np.zeros(len(highways) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        coordinates = np.fromiter(
+            chain.from_iterable(highway.coordinates for highway in highways),
+            dtype=np.float64, count=int(offsets[-1]))
+        ids = np.fromiter((highway.id for highway in highways),
+                          dtype=np.int64, count=len(highways))
+        return cls(ids, [highway.name for highway in highways], offsets,
+                   coordinates)
+
+    def with_congestions(self, congestions: congestion_index,
+                         missing: Optional[list] = None) -> 'TrafficStore':
+        '''Returns a store of the same highways with the received
+        congestion data, sharing every column but the states and timestamps.
+        The IDs of the highways without congestion data are appended to
+        'missing' if a list is given.
+        '''
+        timestamps = np.zeros(len(self), dtype=np.int64)
+        states = np.full(len(self), -1, dtype=np.int8)
+        for i, id in enumerate(self.ids.tolist()):
+            congestion = congestions.get(id)
+            if congestion is None:
+                if missing is not None:
+                    missing.append(id)
+                continue
+            timestamps[i] = int(congestion.timestamp)
+            states[i] = congestion.state
+        return TrafficStore(self.ids, self.names, self.offsets,
+                            self.coordinates, timestamps, states)
+
+    def highway_coordinates(self, i: int) -> np.ndarray:
+        '''Returns the coordinates of the i-th highway, as a view of the
+        coordinate buffer.
+        '''
+        return self.coordinates[self.offsets[i]:self.offsets[i+1]]
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __getitem__(self, i: int) -> Traffic_data:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('traffic store index out of range')
+        state = int(self.states[i])
+        timestamp = int(self.timestamps[i])
+        return Traffic_data(int(self.ids[i]), self.names[i],
+                            self.highway_coordinates(i),
+                            str(timestamp) if state >= 0 else None,
+                            state if state >= 0 else None)
+
+    def __iter__(self) -> Iterable[Traffic_data]:
+        offsets = self.offsets.tolist()
+        for i, (id, name, timestamp, state) in enumerate(zip(
+                self.ids.tolist(), self.names, self.timestamps.tolist(),
+                self.states.tolist())):
+            if state < 0:
+                timestamp = state = None
+            else:
+                timestamp = str(timestamp)
+            yield Traffic_data(id, name,
+                               self.coordinates[offsets[i]:offsets[i+1]],
+                               timestamp, state)
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        '''Returns the columns of the store that are arrays, by name.'''
+        return {'ids': self.ids, 'offsets': self.offsets,
+                'coordinates': self.coordinates,
+                'timestamps': self.timestamps, 'states': self.states}
+
+
+# The highway columns of the last highway list a store was built for. As
+# download_highways returns the same list while the data does not change,
+# every refresh of the congestion data reuses them.
+_last_highways: tuple = (None, None)
+
+
+def _highway_store(highways: Union[highway_list, TrafficStore]
+                   ) -> TrafficStore:
+    '''Utility function that returns a store of the received highways,
+    reusing the columns of the last one built if they are the same list.
+    '''
+    global _last_highways
+    if isinstance(highways, TrafficStore):
+        return highways
+    last, store = _last_highways
+    if last is not highways:
+        store = TrafficStore.from_highways(highways)
+        _last_highways = (highways, store)
+    return store
+
+
+@instrumented('build_complete_traffic_data')
+def build_complete_traffic_data(highways: Union[highway_list, TrafficStore],
+                                congestions: Union[congestion_index,
+                                                   congestion_list],
+                                missing: Optional[list] = None
+                                ) -> TrafficStore:
+    '''Utility function to construct the Traffic_data of every highway,
+    as a TrafficStore, given corresponding Highway and Congestion data, the
+    latter either as returned by 'download_congestions' or as a plain list.
+    The IDs of the highways without congestion data are appended to
+    'missing' if a list is given.
+    '''
+    if not isinstance(congestions, dict):
+        congestions = _index_congestions(congestions)
+    return _highway_store(highways).with_congestions(congestions, missing)
+
+
+class TileCache:
+    '''Disk cache of the map tiles of a tile source, shared by all the
+    maps of the module (see 'new_map'). The source is a URL template with
+    {z}, {x} and {y} fields or, for rendering without network, a template
+    of paths of a local tile directory. When the tiles on disk take more
+    than 'max_bytes', the least recently used ones are deleted.
+
+    The cache also keeps the last base layers (the tiles of a map
+    assembled before drawing anything on them), since a map of the same
+    place and zoom has the same one.
+    '''
+
+    def __init__(self, directory: str, source: str = OSM_TILES,
+                 max_bytes: int = 256*2**20, timeout: float = 10,
+                 base_layers: int = 8) -> None:
+        self.directory = directory
+        self.source = source
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.base_layers = base_layers
+        self._lock = threading.Lock()
+        self._hits = self._misses = 0
+        self._layers = OrderedDict()
+        os.makedirs(directory, exist_ok=True)
+        # Tiles on disk from previous runs, least recently used first.
+        entries = sorted((entry.stat().st_mtime, entry.name,
+                          entry.stat().st_size)
+                         for entry in os.scandir(directory)
+                         if entry.name.endswith('.tile'))
+        self._files = OrderedDict((name, size) for _, name, size in entries)
+        self._bytes = sum(self._files.values())
+
+    def url(self, z: int, x: int, y: int) -> str:
+        '''Returns the URL of a tile in the tile source.'''
+        return self.source.format(z=z, x=x, y=y)
+
+    def get(self, url: str, timeout: Optional[float] = None,
+            headers: Optional[dict] = None) -> Tuple[int, bytes]:
+        '''Returns the HTTP status and the content of a tile, as
+        StaticMap.get does, reading it from disk if it is cached.
+        '''
+        name = hashlib.sha1(url.encode('utf-8')).hexdigest() + '.tile'
+        path = os.path.join(self.directory, name)
+        with self._lock:
+            cached = name in self._files
+            if cached:
+                self._files.move_to_end(name)
+                self._hits += 1
+            else:
+                self._misses += 1
+        if metrics.enabled:
+            metrics.count('tile_cache_hits' if cached else 'tile_cache_misses')
+        if cached:
+            try:
+                with open(path, 'rb') as file:
+                    content = file.read()
+                # The modification time keeps the order across restarts.
+                os.utime(path)
+                return 200, content
+            except FileNotFoundError:
+                # Evicted since it was looked up
+                pass
+        status, content = self._fetch(url, timeout, headers)
+        if status == 200:
+            self._store(name, content)
+        return status, content
+
+    @instrumented('tile_fetch')
+    def _fetch(self, url: str, timeout: Optional[float],
+               headers: Optional[dict]) -> Tuple[int, bytes]:
+        '''Utility function that reads a tile from the tile source.'''
+        if url.startswith('file://') or '://' not in url:
+            try:
+                with open(url[len('file://'):] if url.startswith('file://')
+                          else url, 'rb') as file:
+                    return 200, file.read()
+            except OSError:
+                return 404, b''
+        tile_request = request.Request(
+            url, headers=headers or {'User-Agent': 'iGo'})
+        try:
+            with request.urlopen(tile_request, timeout=timeout or
+                                 self.timeout) as response:
+                return response.status, response.read()
+        except HTTPError as e:
+            return e.code, b''
+
+    def _store(self, name: str, content: bytes) -> None:
+        '''Utility function that writes a tile to disk and evicts the least
+        recently used ones while the cache takes too much space.
+        '''
+        path = os.path.join(self.directory, name)
+        # Written aside and renamed, so a tile is never read half-written.
+        partial = '{p}.{t}'.format(p=path, t=threading.get_ident())
+        with open(partial, 'wb') as file:
+            file.write(content)
+        os.replace(partial, path)
+        with self._lock:
+            self._bytes += len(content) - self._files.pop(name, 0)
+            self._files[name] = len(content)
+            while self._bytes > self.max_bytes and len(self._files) > 1:
+                old, size = self._files.popitem(last=False)
+                self._bytes -= size
+                try:
+                    os.remove(os.path.join(self.directory, old))
+                except FileNotFoundError:
+                    pass
+
+    def base_layer(self, key: tuple) -> Optional[Any]:
+        '''Returns the base layer of a map view, or None if it is not
+        kept.
+        '''
+        with self._lock:
+            layer = self._layers.get(key)
+            if layer is not None:
+                self._layers.move_to_end(key)
+            return layer
+
+    def keep_base_layer(self, key: tuple, layer: Any) -> None:
+        '''Keeps the base layer of a map view, forgetting the least
+        recently used one if there are too many.
+        '''
+        with self._lock:
+            self._layers[key] = layer
+            while len(self._layers) > self.base_layers:
+                self._layers.popitem(last=False)
 
+    def stats(self) -> Tile_cache_stats:
+        '''Returns the counters of the cache.'''
+        return Tile_cache_stats(self._hits, self._misses, len(self._files),
+                                self._bytes)
 
+
+@functools.lru_cache(maxsize=None)
+def _cached_static_map() -> type:
+    '''Utility function that defines the CachedStaticMap class the first
+    time it is needed, since it derives from a class of staticmap.
+    '''
+    from staticmap import StaticMap
+
+    class CachedStaticMap(StaticMap):
+        '''StaticMap that takes its tiles from a TileCache, and its base
+        layer too when the cache has the one of the same view.
+        '''
+
+        def __init__(self, width: int, height: int, cache: TileCache,
+                     **kwargs) -> None:
+            super().__init__(width, height, url_template=cache.source,
+                             **kwargs)
+            self.cache = cache
+
+        def get(self, url: str, **kwargs) -> Tuple[int, bytes]:
+            return self.cache.get(url, kwargs.get('timeout'),
+                                  kwargs.get('headers'))
+
+        def _draw_base_layer(self, image: Any) -> None:
+            key = (self.url_template, self.zoom, self.x_center,
+                   self.y_center, self.width, self.height)
+            layer = self.cache.base_layer(key)
+            if layer is None:
+                super()._draw_base_layer(image)
+                self.cache.keep_base_layer(key, image.copy())
+            else:
+                image.paste(layer)
+
+    CachedStaticMap.__module__ = __name__
+    CachedStaticMap.__qualname__ = 'CachedStaticMap'
+    return CachedStaticMap
+
+
+def __getattr__(name: str) -> Any:
+    '''Gives the attributes of the module that are only defined when they
+    are first asked for.
+    '''
+    if name == 'CachedStaticMap':
+        return _cached_static_map()
+    raise AttributeError('module {m!r} has no attribute {n!r}'
+                         .format(m=__name__, n=name))
+
+
+# Tile cache of the maps rendered by this module. Without one, every map
+# downloads its tiles again.
+tile_cache: Optional[TileCache] = None
+
+
+def new_map(size: int) -> Any:
+    '''Returns an empty StaticMap of size x size pixels, which takes its
+    tiles from the tile cache of the module if one is set.
+    '''
+    if tile_cache is None:
+        from staticmap import StaticMap
+        return StaticMap(size, size)
+    return _cached_static_map()(size, size, tile_cache)
+
+
+def _tile(lon: float, lat: float, zoom: int) -> Tuple[int, int]:
+    '''Returns the x and y numbers of the tile of a point at a zoom.'''
+    n = 2 ** zoom
+    x = int((lon + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def prefetch_tiles(cache: TileCache,
+                   bbox: Tuple[float, float, float, float] = BARCELONA_BBOX,
+                   zooms: Iterable[int] = PREFETCH_ZOOMS,
+                   threads: int = 4) -> int:
+    '''Fetches into the cache all the tiles that cover a (west, south,
+    east, north) bounding box at the given zooms, unless they are cached
+    already. Returns the number of tiles that could not be fetched.
+    '''
+    west, south, east, north = bbox
+    urls = list()
+    for zoom in zooms:
+        x_min, y_min = _tile(west, north, zoom)
+        x_max, y_max = _tile(east, south, zoom)
+        urls.extend(cache.url(zoom, x, y)
+                    for x in range(x_min, x_max + 1)
+                    for y in range(y_min, y_max + 1))
+
+    def fetch(url: str) -> bool:
+        try:
+            return cache.get(url)[0] == 200
+        except OSError:
+            return False
+
+    with ThreadPoolExecutor(threads) as executor:
+        return sum(not fetched for fetched in executor.map(fetch, urls))
+
+
+@instrumented('png_encode')
+def _save_image(image: Any, filename: image_target) -> Optional[bytes]:
+    '''Utility function that saves a rendered map to a file or to a
+    binary buffer, or returns its PNG bytes if no file is given.
+    '''
+    if filename is None:
+        buffer = io.BytesIO()
+        image.save(buffer, 'PNG')
+        return buffer.getvalue()
+    if isinstance(filename, str):
+        image.save(filename)
+    else:
+        image.save(filename, 'PNG')
+    return None
+
+
+class CongestionLog:
+    '''Append-only log of the congestion states of the highways, kept in a
+    directory as columns: 'ids' has the IDs of the highways, 'states' a row
+    of their int8 states (-1 for no information) for every logged feed,
+    and 'times' the time of every row, as int64 seconds since 1970-01-01
+    of the local time of the feed. Both grow by appending to their end, so
+    they are memory-mapped to be read, however long they get.
+    '''
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._ids_filename = os.path.join(directory, 'ids')
+        self._states_filename = os.path.join(directory, 'states')
+        self._times_filename = os.path.join(directory, 'times')
+        self.ids = None
+        if os.path.exists(self._ids_filename):
+            self.ids = np.array(_load_arrays(self._ids_filename)[0]['ids'])
+        self._last_time = None
+        times = self.rows()[0]
+        if len(times):
+            self._last_time = int(times[-1])
+
+    def append(self, traffic_data: TrafficStore) -> bool:
+        '''Appends the states of the received traffic data to the log,
+        unless it has no congestion data or its time is the one of the last
+        row. Highways the log did not have are ignored, and the ones it has
+        but the data does not are logged with no information. Returns
+        whether the row was appended.
+        '''
+        traffic_data = _highway_store(traffic_data)
+        if not traffic_data.timestamps.any():
+            return False
+        feed_time = datetime.strptime(str(traffic_data.timestamps.max()),
+                                      '%Y%m%d%H%M%S')
+        seconds = int((feed_time - datetime(1970, 1, 1)).total_seconds())
+        with self._lock:
+            if seconds == self._last_time:
+                return False
+            if self.ids is None:
+                self.ids = np.array(traffic_data.ids)
+                _save_arrays(self._ids_filename, {'ids': self.ids}, {})
+            if np.array_equal(self.ids, traffic_data.ids):
+                row = traffic_data.states
+            else:
+                row = np.full(len(self.ids), -1, dtype=np.int8)
+                order = np.argsort(self.ids)
+                position = np.minimum(
+                    np.searchsorted(self.ids, traffic_data.ids,
+                                    sorter=order), len(self.ids) - 1)
+                known = self.ids[order[position]] == traffic_data.ids
+                row[order[position[known]]] = traffic_data.states[known]
+            # The states are written first, so that a row is only counted
+            # (see 'rows') once it is complete.
+            with open(self._states_filename, 'ab') as file:
+                file.write(np.ascontiguousarray(row, dtype=np.int8)
+                           .tobytes())
+            with open(self._times_filename, 'ab') as file:
+                file.write(np.array([seconds], dtype=np.int64).tobytes())
+            self._last_time = seconds
+        return True
+
+    def rows(self) -> Tuple[np.ndarray, np.ndarray]:
+        '''Returns the times and the states of the rows of the log, as
+        memory-mapped arrays.
+        '''
+        if self.ids is None or not os.path.exists(self._times_filename):
+            return (np.empty(0, dtype=np.int64),
+                    np.empty((0, 0), dtype=np.int8))
+        rows = min(os.path.getsize(self._times_filename) // 8,
+                   os.path.getsize(self._states_filename) // len(self.ids))
+        if rows == 0:
+            return (np.empty(0, dtype=np.int64),
+                    np.empty((0, len(self.ids)), dtype=np.int8))
+        times = np.memmap(self._times_filename, dtype=np.int64, mode='r',
+                          shape=(rows,))
+        states = np.memmap(self._states_filename, dtype=np.int8, mode='r',
+                           shape=(rows, len(self.ids)))
+        return times, states
+
+    def __len__(self) -> int:
+        return len(self.rows()[0])
+
+
+def _week_seconds(moment: datetime) -> float:
+    '''Returns the seconds from the start of the week (Monday at 00:00)
+    to a moment.
+    '''
+    return (moment.weekday()*24*3600 + moment.hour*3600 + moment.minute*60
+            + moment.second + moment.microsecond/1e6)
+
+
+def _nanmedian(values: np.ndarray) -> np.ndarray:
+    '''Utility function that returns the median of every column of an
+    array ignoring its NaN values, or NaN for the columns that only have
+    NaN values.
+    '''
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmedian(values, axis=0)
+
+
+def _profile_version(assignment: Highway_assignment, rows: int) -> str:
+    '''Returns a hash of what a traffic profile depends on: the
+    assignment of highways to edges and the number of rows of the log.
+    '''
+    return hashlib.sha1('{a}:{r}'.format(a=assignment.version, r=rows)
+                        .encode('utf-8')).hexdigest()
+
+
+@instrumented('build_traffic_profile')
+def build_traffic_profile(graph: graph_type,
+                          log: CongestionLog) -> Traffic_profile:
+    '''Aggregates the rows of a congestion log into the typical traffic of
+    the graph at every slot of the week, taking for every highway the
+    median ponderation of the states logged in the slot. A highway with no
+    information in a slot takes the median over the same time of the other
+    days, or else over the whole week, or else the ponderation of no
+    information. The graph needs the assignment of highways to edges that
+    build_igraph computes.
+    '''
+    assignment = graph.graph.get('assignment')
+    if assignment is None:
+        raise ValueError('The graph has no assignment of highways to '
+                         'edges: build_igraph has not been called for it')
+    times, states = log.rows()
+    columns = 0 if log.ids is None else len(log.ids)
+    no_information = _PONDERATION_FACTORS[0]
+    # 1970-01-01 was a Thursday, the day 3 of the week.
+    slots = (((times // (24*3600) + 3) % 7) * (24*3600)
+             + times % (24*3600)) // PROFILE_SLOT_SECONDS
+    samples = np.bincount(slots, minlength=PROFILE_SLOTS).astype(np.int64)
+    factors = np.full((PROFILE_SLOTS, columns + 1), np.nan)
+    # The rows of every slot are read from the log one slot at a time.
+    order = np.argsort(slots, kind='stable')
+    bounds = np.searchsorted(slots[order], np.arange(PROFILE_SLOTS + 1))
+    for slot in np.flatnonzero(samples).tolist():
+        rows = states[np.sort(order[bounds[slot]:bounds[slot + 1]])]
+        values = _PONDERATION_FACTORS[rows.astype(np.int64) + 1]
+        values[rows < 0] = np.nan
+        factors[slot, :-1] = _nanmedian(values)
+    days = factors[:, :-1].reshape(7, PROFILE_SLOTS // 7, columns)
+    daily = _nanmedian(days)
+    weekly = _nanmedian(daily)
+    days = np.where(np.isnan(days), daily, days)
+    days = np.where(np.isnan(days), weekly, days)
+    factors[:, :-1] = days.reshape(PROFILE_SLOTS, columns)
+    factors[np.isnan(factors)] = no_information
+    edge_columns = np.full(len(_csr(graph).targets), columns,
+                           dtype=np.int32)
+    for column, id in enumerate([] if log.ids is None else log.ids.tolist()):
+        edges = assignment.edges.get(id)
+        if edges:
+            edge_columns[edges] = column
+    return Traffic_profile(_profile_version(assignment, len(times)),
+                           factors, edge_columns, samples)
+
+
+def save_traffic_profile(profile: Traffic_profile, filename: str) -> None:
+    '''Saves a traffic profile in the binary format of graph files.'''
+    _save_arrays(filename, {'factors': profile.factors,
+                            'edge_columns': profile.edge_columns,
+                            'samples': profile.samples},
+                 {'version': profile.version})
+
+
+def load_traffic_profile(filename: str) -> Traffic_profile:
+    '''Memory-maps a traffic profile saved by 'save_traffic_profile'.'''
+    arrays, attributes = _load_arrays(filename)
+    return Traffic_profile(attributes['version'], **arrays)
+
+
+def traffic_profile(graph: graph_type, log: CongestionLog,
+                    filename: Optional[str] = None) -> Traffic_profile:
+    '''Sets and returns the traffic profile of the graph for the rows of
+    the congestion log. It is loaded from the received file if it was
+    built for the same assignment and rows, or otherwise built, and saved
+    to the file if one is given. From then on, build_iroute can route for
+    a departure time.
+    '''
+    assignment = graph.graph.get('assignment')
+    profile = None
+    if assignment is not None and filename is not None and \
+            os.path.exists(filename):
+        profile = load_traffic_profile(filename)
+        if profile.version != _profile_version(assignment, len(log)):
+            profile = None
+    if profile is None:
+        profile = build_traffic_profile(graph, log)
+        if filename is not None:
+            save_traffic_profile(profile, filename)
+    graph.graph['profile'] = profile
+    graph.graph.pop('profile_lists', None)
+    return profile
+
+
+def _profile_lists(graph: graph_type) -> tuple:
+    '''Returns the free flow itime, the edge columns and the factors of
+    the traffic profile of the graph as Python lists, for the searches.
+    '''
+    profile = graph.graph['profile']
+    cached = graph.graph.get('profile_lists')
+    if cached is None or cached[0] is not profile:
+        cached = (profile, _free_flow_itime(graph).tolist(),
+                  profile.edge_columns.tolist(), profile.factors.tolist())
+        graph.graph['profile_lists'] = cached
+    return cached[1:]
+
+
+@instrumented('plot_highways')
 def plot_highways(highways: highway_list,
-                  filename: str = 'highway_plot.png',
-                  size: int = 800) -> None:
+                  filename: image_target = 'highway_plot.png',
+                  size: int = 800) -> Optional[bytes]:
     '''Plots the received Highway list into a map, giving the user
     insight about what streets exactly are documented in the internet
     data they downloaded. The plot is not shown but directly saved
-    in a file, by default called 'highway_plot.png'.
+    in a file, by default called 'highway_plot.png', or written to a
+    binary buffer, or returned as PNG bytes if the filename is None.
     '''
-    city_map = StaticMap(size, size)
+    from staticmap import CircleMarker, Line
+    city_map = new_map(size)
     for highway in highways:
         for i in range(0, len(highway.coordinates), 2):
             marker = CircleMarker(
@@ -195,19 +1350,15 @@ def plot_highways(highways: highway_list,
                         (highway.coordinates[i+2], highway.coordinates[i+3])),
                         color='blue', width=2))
 
-    image = city_map.render()
-    image.save(filename)
+    return _save_image(city_map.render(), filename)
 
 
-def plot_congestions(traffic_data: Traffic_data,
-                     filename: str = 'congestion_plot.png',
-                     size: int = 800) -> None:
-    '''Plots the received Traffic_data list into a map, giving the user
-    insight about what is the state of the streets that are kept track
-    of in the available data. The plot is not shown but directly saved
-    in a file, by default called 'congestion_plot.png'.
+def _congestion_image(traffic_data: Traffic_data, size: int) -> Any:
+    '''Utility function that renders the map of plot_congestions and
+    returns it as a PIL image.
     '''
-    city_map = StaticMap(size, size)
+    from staticmap import CircleMarker, Line
+    city_map = new_map(size)
     for highway in traffic_data:
         for i in range(0, len(highway.coordinates), 2):
             marker = CircleMarker(
@@ -221,135 +1372,2727 @@ def plot_congestions(traffic_data: Traffic_data,
                         (highway.coordinates[i+2], highway.coordinates[i+3])),
                         color=COLORS[highway.state], width=3))
 
-    image = city_map.render()
-    image.save(filename)
+    return city_map.render()
+
+
+@instrumented('plot_congestions')
+def plot_congestions(traffic_data: Traffic_data,
+                     filename: image_target = 'congestion_plot.png',
+                     size: int = 800) -> Optional[bytes]:
+    '''Plots the received Traffic_data list into a map, giving the user
+    insight about what is the state of the streets that are kept track
+    of in the available data. The plot is not shown but directly saved
+    in a file, by default called 'congestion_plot.png', or written to a
+    binary buffer, or returned as PNG bytes if the filename is None.
+    '''
+    return _save_image(_congestion_image(traffic_data, size), filename)
+
 
+# Guards the congestion maps kept in the graphs. Every graph also keeps a
+# 'congestion_render_lock' that makes one thread at a time render its
+# maps, so that users asking at once wait for a single render, but the
+# maps of other graphs are rendered meanwhile.
+_maps_lock = threading.Lock()
 
-def _set_congestion(tdata: Traffic_data, graph: nx.MultiDiGraph,
-                    _debug_nodes: bool = False) -> Optional[list]:
-    '''Utility function that assings a congestion state to some of the edges in
-    the OSMnx graph. For every highway from which we have congestion data we
-    pick the end vertices and find the shortest path in the OSM graph, to every
-    edge in the path we assign the congestion state of the highway. Can return a
-    list of the nodes that could not be reached in any way if needed through the
-    argument '_debug_nodes'.
+
+def _render_congestion_map(graph: graph_type, snapshot: Traffic_snapshot,
+                           size: int) -> bytes:
+    '''Utility function that renders the congestion map of a traffic
+    snapshot, unless it is kept already, and keeps it in the graph if it
+    is newer than the one it has.
     '''
-    coord = tdata.coordinates
-    edge_nodes_latitude = list()
-    edge_nodes_longitude = list()
-    if _debug_nodes:
-        err_nodes = list()
-    for i in range(0, len(coord), 2):
-        edge_nodes_latitude.append(coord[i])
-        edge_nodes_longitude.append(coord[i+1])
-    nn = ox.nearest_nodes(graph, edge_nodes_latitude, edge_nodes_longitude)
-    for i in range(1, len(nn)):
-        origin = nn[i-1]
-        destination = nn[i]
-        # Now we do a try-except block, because sometimes there will be no
-        # directed path between a pair of nodes.
-        try:
-            path = ox.shortest_path(
-                graph, origin, destination, weight='length')
-            for i in range(1, len(path)):
-                a = path[i-1]
-                b = path[i]
-                graph.adj[a][b][0]['congestion'] = tdata.state
-        except nx.NetworkXNoPath:
-            # Now we do another try-except block, because sometimes
-            # there will be no directed path between a pair of nodes
-            # in either direction.
-            try:
-                path = ox.shortest_path(
-                    graph, destination, origin, weight='length')
-                for i in range(1, len(path)):
-                    a = path[i-1]
-                    b = path[i]
-                    graph.adj[a][b][0]['congestion'] = tdata.state
-            except nx.NetworkXNoPath:
-                if _debug_nodes:
-                    err_nodes.append(origin)
-                    err_nodes.append(destination)
-                pass
-    if _debug_nodes:
-        return err_nodes
-    else:
-        return
+    with _maps_lock:
+        render_lock = graph.graph.setdefault('congestion_render_lock',
+                                             threading.Lock())
+    with render_lock:
+        with _maps_lock:
+            kept = graph.graph.get('congestion_maps', dict()).get(size)
+        if kept is not None and kept.version == snapshot.version:
+            return kept.image
+        image = _save_image(_congestion_image(snapshot.traffic_data, size),
+                            None)
+        rendered = Rendered_map(snapshot.version, size, image)
+        with _maps_lock:
+            maps = graph.graph.setdefault('congestion_maps', dict())
+            if size not in maps or maps[size].version < rendered.version:
+                maps[size] = rendered
+        return rendered.image
+
+
+def _revalidate_congestion_map(graph: graph_type,
+                               snapshot: Traffic_snapshot,
+                               size: int) -> None:
+    '''Background job that renders a congestion map.'''
+    try:
+        _render_congestion_map(graph, snapshot, size)
+    except Exception as e:
+        print('Could not render the congestion map:', e)
+    finally:
+        with _maps_lock:
+            graph.graph['congestion_renders'].discard(size)
+
 
+@instrumented('congestion_map')
+def congestion_map(graph: graph_type,
+                   snapshot: Optional[Traffic_snapshot] = None,
+                   size: int = 800, stale: bool = False) -> bytes:
+    '''Returns the map of plot_congestions for the traffic data of the
+    received traffic snapshot, or else the current one, as PNG bytes. The
+    map only changes with the snapshot, so it is rendered once per
+    snapshot and size and kept in the graph.
 
-def build_igraph(graph: nx.MultiDiGraph, traffic_data: traffic_data_list,
-                 _debug_nodes: bool = False) -> Optional[list]:
-    '''Function that adds the attributes 'congestion' and 'itime' to
-    every edge in the OSM graph. itime is calculated dividing the edge
-    length by the speed limit, and then multiplied by a factor given by
-    the edge congestion.
+    If 'stale' is set (stale-while-revalidate) and the map of an older
+    snapshot is kept, it is returned at once while the new one is rendered
+    in a background thread.
     '''
-    nx.set_edge_attributes(graph, name='congestion', values=None)
-    nx.set_edge_attributes(graph, name='itime', values=None)
-    err_nodes = list()
-    # We are doing double work here (in the following 2 for loops) for
-    # the sake of clarity when using the resulting graph of this function.
-    for data in traffic_data:
-        temp_err_nodes = _set_congestion(data, graph, _debug_nodes)
-        if _debug_nodes:
-            for node in temp_err_nodes:
-                err_nodes.append(node)
-    for _, info in graph.edges.items():
-        # Not all highways have a maxspeed value, or if they do, have a
-        # single value for it.
-        try:
-            speed = float(info['maxspeed'])/3.6
-        except KeyError:
-            speed = 30
-        except TypeError:
-            # When multiple values for maxspeed exist, we use their mean
-            speed = sum(list(map(int, info['maxspeed'])))/len(info['maxspeed'])
-        info['itime'] = (info['length']/speed) * \
-            CONGESTION_PONDERATIONS[info['congestion']]
-    if _debug_nodes:
-        return err_nodes
+    if snapshot is None:
+        snapshot = current_snapshot(graph)
+    with _maps_lock:
+        kept = graph.graph.get('congestion_maps', dict()).get(size)
+        fresh = kept is not None and kept.version == snapshot.version
+        if metrics.enabled:
+            metrics.count('congestion_map_hits' if fresh
+                          else 'congestion_map_misses')
+        if fresh:
+            return kept.image
+        if stale and kept is not None and kept.version < snapshot.version:
+            renders = graph.graph.setdefault('congestion_renders', set())
+            if size not in renders:
+                renders.add(size)
+                threading.Thread(target=_revalidate_congestion_map,
+                                 args=(graph, snapshot, size),
+                                 daemon=True).start()
+            return kept.image
+    return _render_congestion_map(graph, snapshot, size)
+
+
+def _parse_maxspeed(maxspeed: Any) -> float:
+    '''Returns the speed limit in km/h given by the maxspeed attribute of
+    an OSMnx edge, or NaN if it has none. When multiple values for maxspeed
+    exist, we use their mean.
+    '''
+    try:
+        if isinstance(maxspeed, list):
+            return sum(float(speed) for speed in maxspeed)/len(maxspeed)
+        return float(maxspeed)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+def build_csr(graph: graph_type) -> Csr_graph:
+    '''Builds the array representation of the received graph used by the
+    routing functions of this module. See the definition of Csr_graph.
+    '''
+    node_ids = np.array(sorted(graph.nodes), dtype=np.int64)
+    index = {node: i for i, node in enumerate(node_ids.tolist())}
+    if graph.is_multigraph():
+        edges = graph.edges(keys=True, data=True)
     else:
-        return
+        edges = ((u, v, 0, info) for u, v, info in graph.edges(data=True))
+    # Sorting by (source, target, key) keeps parallel edges together and
+    # the one with key 0 first, which is the one the rest of the module
+    # reads and writes attributes to.
+    edges = sorted(((index[u], index[v], k, info) for u, v, k, info in edges),
+                   key=lambda edge: edge[:3])
+    n, m = len(node_ids), len(edges)
+    sources = np.fromiter((e[0] for e in edges), dtype=np.int32, count=m)
+    targets = np.fromiter((e[1] for e in edges), dtype=np.int32, count=m)
+    keys = np.fromiter((e[2] for e in edges), dtype=np.int32, count=m)
+    length = np.fromiter((e[3].get('length', 0.0) for e in edges),
+                         dtype=np.float64, count=m)
+    maxspeed = np.fromiter((_parse_maxspeed(e[3].get('maxspeed'))
+                            for e in edges), dtype=np.float64, count=m)
+    geometries = [list(e[3]['geometry'].coords) if 'geometry' in e[3]
+                  else [] for e in edges]
+    geometry_offsets = np.zeros(m + 1, dtype=np.int64)
+    np.cumsum([len(g) for g in geometries], out=geometry_offsets[1:])
+    geometry_coords = np.array(list(chain.from_iterable(geometries)),
+                               dtype=np.float64).reshape(-1, 2)
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=n), out=offsets[1:])
+    r_edges = np.argsort(targets, kind='stable').astype(np.int32)
+    r_offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(targets, minlength=n), out=r_offsets[1:])
+    x = np.array([graph.nodes[node]['x'] for node in node_ids.tolist()],
+                 dtype=np.float64)
+    y = np.array([graph.nodes[node]['y'] for node in node_ids.tolist()],
+                 dtype=np.float64)
+    return Csr_graph(node_ids, x, y, offsets, targets, keys, length,
+                     maxspeed, geometry_offsets, geometry_coords, r_offsets,
+                     sources[r_edges], r_edges,
+                     {'crs': graph.graph.get('crs')})
+
+
+def _csr(graph: graph_type) -> Csr_graph:
+    '''Returns the array representation of the graph, building it the first
+    time it is needed. It is kept in the graph attribute dictionary, so the
+    graph must not change its nodes or edges afterwards.
+    '''
+    if isinstance(graph, Csr_graph):
+        return graph
+    if 'csr' not in graph.graph:
+        graph.graph['csr'] = build_csr(graph)
+    return graph.graph['csr']
 
 
-def build_ipath(igraph: nx.MultiDiGraph, origin: str, destiny: str) -> list:
-    ''' Returns the shortest path between two locations in the city of Barcelona
-    given by their names (street, building name, etc.)
+def _adjacency(graph: graph_type) -> tuple:
+    '''Returns the CSR arrays of the graph as Python lists. Indexing numpy
+    arrays one element at a time is slower than indexing lists, so the
+    searches below use this version of them.
     '''
-    origin = origin + ', Barcelona'
-    destiny = destiny + ', Barcelona'
-    # ox.geocode returns coordinates reversed (longitude, latitude) so
-    # we invert them to be able to use them properly
-    nn_origin = ox.nearest_nodes(
-        igraph, ox.geocode(origin)[1], ox.geocode(origin)[0])
-    nn_destiny = ox.nearest_nodes(
-        igraph, ox.geocode(destiny)[1], ox.geocode(destiny)[0])
+    if 'adjacency' not in graph.graph:
+        csr = _csr(graph)
+        graph.graph['adjacency'] = (
+            csr.offsets.tolist(), csr.targets.tolist(),
+            csr.r_offsets.tolist(), csr.r_sources.tolist(),
+            csr.r_edges.tolist())
+    return graph.graph['adjacency']
 
-    return ox.shortest_path(igraph, nn_origin, nn_destiny, weight="itime")
 
+def _node_index(csr: Csr_graph, node: int) -> int:
+    '''Returns the position of an OSM node id in the CSR arrays.'''
+    i = int(np.searchsorted(csr.node_ids, node))
+    if i == len(csr.node_ids) or csr.node_ids[i] != node:
+        raise KeyError(node)
+    return i
 
-def plot_path(igraph: nx.MultiDiGraph, ipath: list,
-              filename: str = 'path_plot.png',
-              size: int = 800) -> None:
-    ''' Plots the received shortest_path list into a map. The plot is not
-    shown but directly saved in a file, by default called 'path_plot.png'.
+
+def _bidirectional_dijkstra(adjacency: tuple, weights: Sequence[float],
+                            source: int, target: int) -> Optional[list]:
+    '''Runs two Dijkstra searches at the same time, one from the source over
+    the graph and another from the target over the reversed graph, and stops
+    when they can no longer improve the best path found where they meet.
+    Returns the list of node positions of the path, or None if the target
+    cannot be reached.
     '''
-    city_map = StaticMap(size, size)
-    try:
-        origin_marker = CircleMarker((
-            igraph.nodes[ipath[0]]['x'], igraph.nodes[ipath[0]]['y']), 'green', 9)
-        destiny_marker = CircleMarker((
-            igraph.nodes[ipath[-1]]['x'], igraph.nodes[ipath[-1]]['y']), 'red', 9)
-        city_map.add_marker(origin_marker)
-        city_map.add_marker(destiny_marker)
+    offsets, targets, r_offsets, r_sources, r_edges = adjacency
+    inf = float('inf')
+    # Index 0 is the forward search and index 1 the backward one.
+    dist = ({source: 0.0}, {target: 0.0})
+    pred = ({source: -1}, {target: -1})
+    settled = (set(), set())
+    heaps = ([(0.0, source)], [(0.0, target)])
+    best, meeting = (0.0, source) if source == target else (inf, None)
+    while heaps[0] and heaps[1]:
+        if heaps[0][0][0] + heaps[1][0][0] >= best:
+            break
+        side = 0 if heaps[0][0][0] <= heaps[1][0][0] else 1
+        d, u = heapq.heappop(heaps[side])
+        if u in settled[side]:
+            continue
+        settled[side].add(u)
+        if side == 0:
+            neighbours = ((targets[e], weights[e])
+                          for e in range(offsets[u], offsets[u + 1]))
+        else:
+            neighbours = ((r_sources[p], weights[r_edges[p]])
+                          for p in range(r_offsets[u], r_offsets[u + 1]))
+        for v, w in neighbours:
+            nd = d + w
+            if nd < dist[side].get(v, inf):
+                dist[side][v] = nd
+                pred[side][v] = u
+                heapq.heappush(heaps[side], (nd, v))
+                other = dist[1 - side].get(v)
+                if other is not None and nd + other < best:
+                    best, meeting = nd + other, v
+    if metrics.enabled:
+        metrics.count('nodes_settled', len(settled[0]) + len(settled[1]))
+    if meeting is None:
+        return None
+    path = list()
+    node = meeting
+    while node != -1:
+        path.append(node)
+        node = pred[0][node]
+    path.reverse()
+    node = pred[1][meeting]
+    while node != -1:
+        path.append(node)
+        node = pred[1][node]
+    return path
 
-    except:
-        print('There is no path!')
-    for i in range(0, len(ipath)):
-        if (i + 1 < len(ipath)):
-            line = Line(((igraph.nodes[ipath[i]]['x'], igraph.nodes[ipath[i]]['y']), (
-                igraph.nodes[ipath[i+1]]['x'], igraph.nodes[ipath[i+1]]['y'])), '#0884ff', 3)
-            city_map.add_line(line)
 
-    image = city_map.render()
-    image.save(filename)
+def _dijkstra(offsets: List[int], heads: List[int],
+              weights: Sequence[float], source: int,
+              until: Optional[set] = None,
+              limit: float = float('inf')) -> tuple:
+    '''Runs a Dijkstra search from a source over a graph given as CSR
+    lists, with the weights in the order of the heads. Returns the
+    dictionaries of distance and predecessor of the reached nodes: all of
+    them, or, if a set of nodes to stop at is given, those reached until
+    all of these are settled, whose distances are then final. Nodes
+    farther than the limit are not reached, so the search ends as soon as
+    it has settled all the nodes within it.
+    '''
+    inf = float('inf')
+    dist = {source: 0.0}
+    pred = {source: -1}
+    heap = [(0.0, source)]
+    remaining = set(until) if until is not None else None
+    settled = 0
+    while heap:
+        d, u = heapq.heappop(heap)
+        if d > dist[u]:
+            continue
+        settled += 1
+        if remaining is not None:
+            remaining.discard(u)
+            if not remaining:
+                break
+        for e in range(offsets[u], offsets[u + 1]):
+            v = heads[e]
+            nd = d + weights[e]
+            if nd <= limit and nd < dist.get(v, inf):
+                dist[v] = nd
+                pred[v] = u
+                heapq.heappush(heap, (nd, v))
+    if metrics.enabled:
+        metrics.count('nodes_settled', settled)
+    return dist, pred
+
+
+def _td_dijkstra(offsets: List[int], heads: List[int],
+                 free_flow: List[float], edge_columns: List[int],
+                 factors: List[List[float]], source: int, target: int,
+                 departure: float) -> Tuple[Optional[list], float]:
+    '''Runs a time-dependent Dijkstra search from a source to a target,
+    leaving at 'departure' seconds since the start of the week. The label
+    of a node is the time it is reached, and the itime of the edges leaving
+    it is taken from the profile slot of that time, so every relaxation
+    costs a lookup in a row of the factors. Returns the path as a list of
+    nodes and its itime, or None and infinity if there is no path.
+    '''
+    inf = float('inf')
+    dist = {source: 0.0}
+    pred = {source: -1}
+    heap = [(0.0, source)]
+    settled = 0
+    while heap:
+        d, u = heapq.heappop(heap)
+        if d > dist[u]:
+            continue
+        settled += 1
+        if u == target:
+            break
+        row = factors[int((departure + d) // PROFILE_SLOT_SECONDS)
+                      % PROFILE_SLOTS]
+        for e in range(offsets[u], offsets[u + 1]):
+            v = heads[e]
+            nd = d + free_flow[e] * row[edge_columns[e]]
+            if nd < dist.get(v, inf):
+                dist[v] = nd
+                pred[v] = u
+                heapq.heappush(heap, (nd, v))
+    if metrics.enabled:
+        metrics.count('nodes_settled', settled)
+    if target not in dist or dist[target] == inf:
+        return None, inf
+    path = [target]
+    while pred[path[-1]] != -1:
+        path.append(pred[path[-1]])
+    return path[::-1], dist[target]
+
+
+def _node_tree(graph: graph_type) -> Any:
+    '''Returns the spatial index over the nodes of the graph, building it
+    the first time it is needed. Like OSMnx does for unprojected graphs, it
+    is a ball tree with the haversine metric, which works on (latitude,
+    longitude) pairs in radians.
+    '''
+    if 'node_tree' not in graph.graph:
+        from sklearn.neighbors import BallTree
+        csr = _csr(graph)
+        graph.graph['node_tree'] = BallTree(
+            np.radians(np.column_stack((csr.y, csr.x))), metric='haversine')
+    return graph.graph['node_tree']
+
+
+def _snap(graph: graph_type, x: Sequence[float],
+          y: Sequence[float]) -> np.ndarray:
+    '''Returns the positions in the CSR arrays of the nearest nodes to the
+    received longitudes (x) and latitudes (y), all of them in a single
+    query to the spatial index of the graph.
+    '''
+    points = np.radians(np.column_stack((np.asarray(y, dtype=np.float64),
+                                         np.asarray(x, dtype=np.float64))))
+    if len(points) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return _node_tree(graph).query(points, return_distance=False)[:, 0]
+
+
+@instrumented('snap')
+def nearest_nodes(graph: graph_type, x: Sequence[float],
+                  y: Sequence[float]) -> np.ndarray:
+    '''Returns the OSM ids of the nearest nodes to the received
+    longitudes (x) and latitudes (y), like ox.nearest_nodes does but
+    reusing the same spatial index across calls.
+    '''
+    return _csr(graph).node_ids[_snap(graph, x, y)]
+
+
+def current_snapshot(graph: graph_type) -> Traffic_snapshot:
+    '''Returns the last traffic snapshot build_igraph computed for the
+    graph. If it has not been called, the snapshot (with version 0) takes
+    the itime of the edges from their attributes, and edges without one
+    weigh 1, as they would for networkx.
+    '''
+    snapshot = graph.graph.get('snapshot')
+    if snapshot is None:
+        m = len(_csr(graph).targets)
+        if isinstance(graph, Csr_graph):
+            itime = np.ones(m)
+        else:
+            itime = np.array(_edge_attribute(graph, 'itime', 1.0),
+                             dtype=np.float64)
+        snapshot = _snapshot(0, (), np.full(m, -1, dtype=np.int8), itime)
+        graph.graph.setdefault('snapshot', snapshot)
+    return graph.graph['snapshot']
+
+
+def _snapshot(version: int, traffic_data: traffic_data_list,
+              congestion: np.ndarray, itime: np.ndarray) -> Traffic_snapshot:
+    '''Utility function that builds a traffic snapshot, making its arrays
+    read-only.
+    '''
+    congestion.setflags(write=False)
+    itime.setflags(write=False)
+    if not isinstance(traffic_data, TrafficStore):
+        traffic_data = tuple(traffic_data)
+    return Traffic_snapshot(version, traffic_data, congestion, itime,
+                            tuple(itime.tolist()))
+
+
+def save_snapshot(snapshot: Traffic_snapshot, filename: str) -> None:
+    '''Saves a traffic snapshot in the binary format of graph files. It
+    is written aside and renamed, so that other processes never load it
+    half-written.
+    '''
+    partial = filename + '.part'
+    _save_arrays(partial, *_snapshot_arrays(snapshot))
+    os.replace(partial, filename)
+
+
+def load_snapshot(filename: str) -> Traffic_snapshot:
+    '''Memory-maps a traffic snapshot saved by 'save_snapshot'.'''
+    return _snapshot_from_arrays(*_load_arrays(filename))
+
+
+def _snapshot_arrays(snapshot: Traffic_snapshot) -> tuple:
+    '''Utility function that returns the arrays and the attributes a
+    traffic snapshot is saved as.
+    '''
+    store = _highway_store(snapshot.traffic_data)
+    if store is not snapshot.traffic_data:
+        # Built from a list of Traffic_data, whose columns are filled in.
+        store = store.with_congestions(
+            {data.id: data for data in snapshot.traffic_data
+             if data.state is not None})
+    arrays = {'traffic_' + name: array
+              for name, array in store.arrays().items()}
+    arrays.update(congestion=snapshot.congestion, itime=snapshot.itime)
+    return arrays, {'version': snapshot.version, 'names': store.names}
+
+
+def _snapshot_from_arrays(arrays: Dict[str, np.ndarray],
+                          attributes: dict) -> Traffic_snapshot:
+    '''Utility function that builds back a traffic snapshot from the
+    arrays and attributes given by '_snapshot_arrays'.
+    '''
+    store = TrafficStore(arrays['traffic_ids'], attributes['names'],
+                         arrays['traffic_offsets'],
+                         arrays['traffic_coordinates'],
+                         arrays['traffic_timestamps'],
+                         arrays['traffic_states'])
+    return _snapshot(attributes['version'], store, arrays['congestion'],
+                     arrays['itime'])
+
+
+def _free_flow_itime(graph: graph_type) -> np.ndarray:
+    '''Returns the itime of every edge of the graph without congestion:
+    its length divided by its speed limit. It only depends on the graph, so
+    it is computed once.
+    '''
+    if 'free_flow' not in graph.graph:
+        csr = _csr(graph)
+        # Not all highways have a maxspeed value.
+        speed = np.where(np.isnan(csr.maxspeed), 30, csr.maxspeed/3.6)
+        graph.graph['free_flow'] = csr.length/speed
+    return graph.graph['free_flow']
+
+
+def _edge_attribute(graph: graph_type, name: str, default: float) -> list:
+    '''Collects an edge attribute of the graph in CSR order.'''
+    values = list()
+    for u, v, k in _edge_keys(graph):
+        info = graph.adj[u][v]
+        if graph.is_multigraph():
+            info = info[k]
+        value = info.get(name)
+        values.append(default if value is None else float(value))
+    return values
+
+
+def _edge_keys(graph: graph_type) -> list:
+    '''Returns the (u, v, key) triplet of every edge of the graph in CSR
+    order, which is the order of the edge positions used by the routing
+    functions.
+    '''
+    if 'edge_keys' not in graph.graph:
+        csr = _csr(graph)
+        node_ids = csr.node_ids
+        sources = np.repeat(np.arange(len(node_ids)), np.diff(csr.offsets))
+        graph.graph['edge_keys'] = list(zip(
+            node_ids[sources].tolist(), node_ids[csr.targets].tolist(),
+            csr.keys.tolist()))
+    return graph.graph['edge_keys']
+
+
+def _edge_between(adjacency: tuple, a: int, b: int) -> int:
+    '''Returns the position of the edge from node position a to node
+    position b with the lowest key, assuming there is one.
+    '''
+    offsets, targets = adjacency[0], adjacency[1]
+    for e in range(offsets[a], offsets[a + 1]):
+        if targets[e] == b:
+            return e
+    raise KeyError((a, b))
+
+
+def _highway_edges(graph: graph_type, nn: List[int],
+                   length: List[float]) -> tuple:
+    '''Utility function that finds the edges of the OSMnx graph a highway
+    goes through, given the positions of the nearest nodes to its points.
+    We find the shortest path (by length) in the OSM graph between every
+    pair of consecutive nodes, or in the opposite direction if there is
+    none. Returns the list of edge positions of the paths and the list of
+    the nodes that could not be joined in any way.
+    '''
+    node_ids = _csr(graph).node_ids
+    adjacency = _adjacency(graph)
+    edges = list()
+    err_nodes = list()
+    for i in range(1, len(nn)):
+        origin = nn[i-1]
+        destination = nn[i]
+        # Sometimes there will be no directed path between a pair of nodes,
+        # and sometimes there will be none in either direction.
+        path = _bidirectional_dijkstra(adjacency, length, origin, destination)
+        if path is None:
+            path = _bidirectional_dijkstra(adjacency, length,
+                                           destination, origin)
+        if path is None:
+            err_nodes.append(int(node_ids[origin]))
+            err_nodes.append(int(node_ids[destination]))
+            continue
+        for j in range(1, len(path)):
+            edges.append(_edge_between(adjacency, path[j-1], path[j]))
+    return edges, err_nodes
+
+
+def _fingerprint(graph: graph_type) -> bytes:
+    '''Returns a hash of the nodes and edges of the graph, computed once.'''
+    if 'fingerprint' not in graph.graph:
+        csr = _csr(graph)
+        digest = hashlib.sha1()
+        for array in (csr.node_ids, csr.offsets, csr.targets, csr.keys,
+                      csr.length):
+            digest.update(np.ascontiguousarray(array).tobytes())
+        graph.graph['fingerprint'] = digest.digest()
+    return graph.graph['fingerprint']
+
+
+def assignment_version(
+        graph: graph_type,
+        highways: Union[highway_list, traffic_data_list]) -> str:
+    '''Returns a hash of everything the assignment of highways to edges
+    depends on: the geometry of the highways and the nodes and edges of the
+    graph.
+    '''
+    digest = hashlib.sha1(_fingerprint(graph))
+    store = _highway_store(highways)
+    # The ID, the number of coordinates and the coordinates of every
+    # highway, one after the other, as float64.
+    lengths = np.diff(store.offsets)
+    starts = store.offsets[:-1] + 2*np.arange(len(store))
+    buffer = np.empty(len(store.coordinates) + 2*len(store))
+    buffer[starts] = store.ids
+    buffer[starts + 1] = lengths
+    mask = np.ones(len(buffer), dtype=bool)
+    mask[starts] = mask[starts + 1] = False
+    buffer[mask] = store.coordinates
+    digest.update(buffer.tobytes())
+    return digest.hexdigest()
+
+
+def build_highway_assignment(graph: graph_type,
+                             highways: Union[highway_list, traffic_data_list]
+                             ) -> Highway_assignment:
+    '''Finds the edges of the graph every highway goes through. This is
+    the expensive part of building the igraph, and it only needs to be done
+    again when the highways or the graph change.
+    '''
+    length = _csr(graph).length.tolist()
+    # All the points of all the highways are snapped to the graph at once,
+    # and then split back into the points of every highway.
+    store = _highway_store(highways)
+    coordinates = store.coordinates
+    nn = _snap(graph, coordinates[0::2], coordinates[1::2]).tolist()
+    edges = dict()
+    unreachable = dict()
+    offsets = (store.offsets//2).tolist()
+    for i, id in enumerate(store.ids.tolist()):
+        edges[id], unreachable[id] = _highway_edges(
+            graph, nn[offsets[i]:offsets[i+1]], length)
+    return Highway_assignment(assignment_version(graph, highways),
+                              edges, unreachable)
+
+
+def save_highway_assignment(assignment: Highway_assignment,
+                            filename: str) -> None:
+    '''Saves the received assignment as a file in the current working
+    directory using the pickle library.
+    '''
+    with open(filename, 'wb') as file:
+        pickle.dump(tuple(assignment), file)
+
+
+def load_highway_assignment(filename: str) -> Highway_assignment:
+    '''Loads an assignment from a file of the current working directory,
+    assuming it exists.
+    '''
+    with open(filename, 'rb') as file:
+        return Highway_assignment(*pickle.load(file))
+
+
+def highway_assignment(graph: graph_type,
+                       highways: Union[highway_list, traffic_data_list],
+                       filename: Optional[str] = None) -> Highway_assignment:
+    '''Returns the assignment of highways to edges of the graph. It is
+    taken from the graph if it was already computed for it, or else from
+    the received file if its version matches. Otherwise it is computed,
+    and saved to the file if one is given.
+    '''
+    version = assignment_version(graph, highways)
+    assignment = graph.graph.get('assignment')
+    if assignment is not None and assignment.version == version:
+        return assignment
+    assignment = None
+    if filename is not None and os.path.exists(filename):
+        assignment = load_highway_assignment(filename)
+        if assignment.version != version:
+            assignment = None
+    if assignment is None:
+        assignment = build_highway_assignment(graph, highways)
+        if filename is not None:
+            save_highway_assignment(assignment, filename)
+    graph.graph['assignment'] = assignment
+    return assignment
+
+
+@instrumented('set_congestion')
+def _set_congestion(graph: graph_type, traffic_data: traffic_data_list,
+                    assignment: Highway_assignment) -> np.ndarray:
+    '''Utility function that assigns the congestion state of every highway
+    to the edges of the graph it goes through. Returns the congestion code
+    of every edge in CSR order, -1 for the edges of no highway.
+    '''
+    congestion = np.full(len(_csr(graph).targets), -1, dtype=np.int8)
+    if isinstance(traffic_data, TrafficStore):
+        states = zip(traffic_data.ids.tolist(), traffic_data.states.tolist())
+    else:
+        states = ((data.id, -1 if data.state is None else data.state)
+                  for data in traffic_data)
+    for id, state in states:
+        edges = assignment.edges.get(id)
+        if edges:
+            congestion[edges] = state
+    return congestion
+
+
+@instrumented('build_igraph')
+def build_igraph(graph: graph_type, traffic_data: traffic_data_list,
+                 _debug_nodes: bool = False,
+                 assignment_filename: Optional[str] = None,
+                 publish: Optional[Callable[[Traffic_snapshot], None]] = None
+                 ) -> Optional[list]:
+    '''Function that computes the congestion and the itime of every edge in
+    the OSM graph. itime is calculated dividing the edge length by the speed
+    limit, and then multiplied by a factor given by the edge congestion.
+    Both are kept in CSR order in a new traffic snapshot of the graph (see
+    'current_snapshot'), and are written as the edge attributes 'congestion'
+    and 'itime' when a networkx version of the graph is asked for (see
+    'to_networkx'). The edges of every highway are only searched for once
+    and kept in the graph, and also in 'assignment_filename' if given so
+    that they can be reused across executions. If 'publish' is given, it
+    is called with the new snapshot before it is swapped in, so that, for
+    instance, a RoutePool has its file before anyone asks for it. Can
+    return a list of the nodes that could not be reached in any way if
+    needed through the argument '_debug_nodes'.
+    '''
+    assignment = highway_assignment(graph, traffic_data, assignment_filename)
+    err_nodes = list()
+    for data in traffic_data:
+        err_nodes.extend(assignment.unreachable.get(data.id, ()))
+    congestion = _set_congestion(graph, traffic_data, assignment)
+    itime = _free_flow_itime(graph) * _PONDERATION_FACTORS[congestion + 1]
+    snapshot = _snapshot(next(_snapshot_versions), traffic_data, congestion,
+                         itime)
+    if publish is not None:
+        publish(snapshot)
+    if 'cch' in graph.graph:
+        graph.graph['ch'] = customize(graph, graph.graph['cch'], snapshot)
+    # The new snapshot replaces the previous one in a single assignment,
+    # so searches running meanwhile keep the one they started with.
+    graph.graph['snapshot'] = snapshot
+    if 'route_cache' in graph.graph:
+        graph.graph['route_cache'].new_snapshot(snapshot.version)
+    if _debug_nodes:
+        return err_nodes
+    else:
+        return
+
+
+def _flatten_lists(lists: Dict[int, list]) -> Tuple[np.ndarray, ...]:
+    '''Utility function that turns a dictionary of lists of integers into
+    an array of keys, an array with all the lists one after the other, and
+    the offsets of every list in it, like the CSR arrays.
+    '''
+    keys = np.fromiter(lists.keys(), dtype=np.int64, count=len(lists))
+    offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+    np.cumsum([len(values) for values in lists.values()], out=offsets[1:])
+    values = np.fromiter(chain.from_iterable(lists.values()),
+                         dtype=np.int64, count=int(offsets[-1]))
+    return keys, offsets, values
+
+
+def _unflatten_lists(keys: np.ndarray, offsets: np.ndarray,
+                     values: np.ndarray) -> Dict[int, list]:
+    '''Utility function that undoes '_flatten_lists'.'''
+    offsets = offsets.tolist()
+    values = values.tolist()
+    return {key: values[offsets[i]:offsets[i+1]]
+            for i, key in enumerate(keys.tolist())}
+
+
+def save_warm_start(graph: graph_type, filename: str) -> None:
+    '''Saves everything needed to route over the graph with its current
+    traffic snapshot as a single file in the binary format of graph files:
+    the arrays of the graph, the assignment of highways to edges, and the
+    traffic data, congestion and itime of the snapshot. It is written aside
+    and renamed, so that a restart never finds it half-written.
+    '''
+    assignment = graph.graph.get('assignment')
+    if assignment is None:
+        raise ValueError('The graph has no traffic snapshot to save: '
+                         'build_igraph has not been called for it')
+    csr = _csr(graph)
+    arrays, attributes = _snapshot_arrays(current_snapshot(graph))
+    arrays.update((name, getattr(csr, name)) for name in _GRAPH_ARRAYS)
+    for name, lists in (('edges', assignment.edges),
+                        ('unreachable', assignment.unreachable)):
+        keys, offsets, values = _flatten_lists(lists)
+        arrays.update({name + '_ids': keys, name + '_offsets': offsets,
+                       name: values})
+    crs = csr.graph.get('crs')
+    attributes.update(crs=None if crs is None else str(crs),
+                      assignment_version=assignment.version,
+                      graph_version=_fingerprint(graph).hex())
+    partial = filename + '.part'
+    _save_arrays(partial, arrays, attributes)
+    os.replace(partial, filename)
+
+
+def load_warm_start(filename: str,
+                    graph_filename: Optional[str] = None) -> Csr_graph:
+    '''Memory-maps a graph saved by 'save_warm_start', with its assignment
+    of highways to edges and its traffic snapshot, so that it can be routed
+    over right away. If a graph file is given, such as the one the workers
+    of a RoutePool load, the warm start must have been saved for the same
+    graph, or else a ValueError is raised. The traffic snapshots built from
+    then on get greater versions than the restored one.
+    '''
+    global _snapshot_versions
+    arrays, attributes = _load_arrays(filename)
+    if 'assignment_version' not in attributes:
+        raise ValueError('{f} is not a warm start file'.format(f=filename))
+    graph = Csr_graph(graph={'crs': attributes['crs']},
+                      **{name: arrays[name] for name in _GRAPH_ARRAYS})
+    if graph_filename is not None:
+        version = _fingerprint(load_graph(graph_filename)).hex()
+        if attributes.get('graph_version') != version:
+            raise ValueError('{f} was not saved for the graph of {g}'
+                             .format(f=filename, g=graph_filename))
+        graph.graph['fingerprint'] = bytes.fromhex(version)
+    graph.graph['assignment'] = Highway_assignment(
+        attributes['assignment_version'],
+        *(_unflatten_lists(arrays[name + '_ids'], arrays[name + '_offsets'],
+                           arrays[name])
+          for name in ('edges', 'unreachable')))
+    snapshot = _snapshot_from_arrays(arrays, attributes)
+    _snapshot_versions = count(max(next(_snapshot_versions),
+                                   snapshot.version + 1))
+    graph.graph['snapshot'] = snapshot
+    return graph
+
+
+def metric_version(graph: graph_type,
+                   snapshot: Optional[Traffic_snapshot] = None) -> str:
+    '''Returns a hash of the graph and of the itime of the received
+    traffic snapshot, or else the current one. It is computed once per
+    snapshot.
+    '''
+    if snapshot is None:
+        snapshot = current_snapshot(graph)
+    cached = graph.graph.get('metric_version')
+    if cached is None or cached[0] != snapshot.version \
+            or snapshot.version == 0:
+        digest = hashlib.sha1(_fingerprint(graph))
+        digest.update(np.ascontiguousarray(snapshot.itime).tobytes())
+        cached = (snapshot.version, digest.hexdigest())
+        graph.graph['metric_version'] = cached
+    return cached[1]
+
+
+def _witness_search(out_edges: List[dict], source: int, ignore: int,
+                    limit: float, targets: dict,
+                    max_settled: int = 500) -> dict:
+    '''Utility function for the contraction of node 'ignore': a Dijkstra
+    search from 'source' that avoids it and stops when all the targets are
+    settled, when distances exceed 'limit' or after 'max_settled' nodes.
+    Returns the distances it found.
+    '''
+    dist = {source: 0.0}
+    heap = [(0.0, source)]
+    remaining = len(targets)
+    settled = 0
+    while heap:
+        d, u = heapq.heappop(heap)
+        if d > dist[u]:
+            continue
+        if d > limit or settled == max_settled:
+            break
+        settled += 1
+        if u in targets:
+            remaining -= 1
+            if remaining == 0:
+                break
+        for v, (w, _) in out_edges[u].items():
+            nd = d + w
+            if v != ignore and nd < dist.get(v, float('inf')):
+                dist[v] = nd
+                heapq.heappush(heap, (nd, v))
+    return dist
+
+
+def _shortcuts(out_edges: List[dict], in_edges: List[dict],
+               v: int) -> list:
+    '''Returns the shortcuts (u, w, weight) needed to contract node v: one
+    for every pair of neighbours u -> v -> w whose shortest path goes
+    through v.
+    '''
+    shortcuts = list()
+    for u, (w_uv, _) in in_edges[v].items():
+        targets = {w: w_uv + w_vw for w, (w_vw, _) in out_edges[v].items()
+                   if w != u}
+        if not targets:
+            continue
+        dist = _witness_search(out_edges, u, v, max(targets.values()),
+                               targets)
+        for w, weight in targets.items():
+            if dist.get(w, float('inf')) > weight:
+                shortcuts.append((u, w, weight))
+    return shortcuts
+
+
+def _contract(out_edges: List[dict], in_edges: List[dict]) -> list:
+    '''Contracts the nodes of the graph given by out_edges and in_edges
+    (dictionaries neighbour -> (weight, middle) of every node), adding the
+    needed shortcuts, and returns the contraction order. The next node to
+    contract is always the one with the lowest priority: the shortcuts it
+    needs minus the edges it removes, plus how many of its neighbours are
+    already contracted.
+    '''
+    n = len(out_edges)
+    contracted_neighbours = [0] * n
+
+    def priority(v):
+        return len(_shortcuts(out_edges, in_edges, v)) - \
+            len(out_edges[v]) - len(in_edges[v]) + contracted_neighbours[v]
+
+    heap = [(priority(v), v) for v in range(n)]
+    heapq.heapify(heap)
+    order = list()
+    while heap:
+        # Priorities change as nodes are contracted, so they are only
+        # updated when a node gets to the top of the heap.
+        _, v = heapq.heappop(heap)
+        p = priority(v)
+        if heap and p > heap[0][0]:
+            heapq.heappush(heap, (p, v))
+            continue
+        for u, w, weight in _shortcuts(out_edges, in_edges, v):
+            if weight < out_edges[u].get(w, (float('inf'),))[0]:
+                out_edges[u][w] = (weight, v)
+                in_edges[w][u] = (weight, v)
+        # The edges of v are kept as they are, since all its neighbours
+        # are contracted later, but they are removed from its neighbours.
+        for w in out_edges[v]:
+            del in_edges[w][v]
+            contracted_neighbours[w] += 1
+        for u in in_edges[v]:
+            del out_edges[u][v]
+            contracted_neighbours[u] += 1
+        order.append(v)
+    return order
+
+
+def _working_graph(graph: graph_type, weights: Sequence[float]) -> tuple:
+    '''Returns the graph as lists of dictionaries neighbour -> (weight,
+    middle) of the out and in edges of every node, keeping the lightest of
+    parallel edges and leaving out loops and impassable edges.
+    '''
+    csr = _csr(graph)
+    n = len(csr.node_ids)
+    out_edges = [dict() for _ in range(n)]
+    in_edges = [dict() for _ in range(n)]
+    sources = np.repeat(np.arange(n), np.diff(csr.offsets)).tolist()
+    for u, v, w in zip(sources, csr.targets.tolist(), weights):
+        if u != v and w < out_edges[u].get(v, (float('inf'),))[0]:
+            out_edges[u][v] = (w, -1)
+            in_edges[v][u] = (w, -1)
+    return out_edges, in_edges
+
+
+def _hierarchy_arrays(out_edges: List[dict], in_edges: List[dict],
+                      order: List[int]) -> dict:
+    '''Utility function that builds the arrays of a contraction hierarchy
+    from the edges left after contracting all the nodes in 'order'.
+    '''
+    arrays = dict()
+    rank = np.empty(len(order), dtype=np.int32)
+    rank[order] = np.arange(len(order), dtype=np.int32)
+    arrays['rank'] = rank
+    for prefix, edges in (('up', out_edges), ('down', in_edges)):
+        offsets = np.zeros(len(edges) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in edges], out=offsets[1:])
+        arrays[prefix + '_offsets'] = offsets
+        neighbours = 'targets' if prefix == 'up' else 'sources'
+        arrays[prefix + '_' + neighbours] = np.fromiter(
+            chain.from_iterable(e.keys() for e in edges), dtype=np.int32,
+            count=offsets[-1])
+        arrays[prefix + '_weights'] = np.fromiter(
+            (w for e in edges for w, _ in e.values()), dtype=np.float64,
+            count=offsets[-1])
+        arrays[prefix + '_middle'] = np.fromiter(
+            (m for e in edges for _, m in e.values()), dtype=np.int32,
+            count=offsets[-1])
+    return arrays
+
+
+def build_ch(graph: graph_type,
+             snapshot: Optional[Traffic_snapshot] = None
+             ) -> Contraction_hierarchy:
+    '''Builds the contraction hierarchy of the graph for the itime of the
+    received traffic snapshot, or else the current one. This takes a while,
+    and the hierarchy is only valid for that itime.
+    '''
+    if snapshot is None:
+        snapshot = current_snapshot(graph)
+    out_edges, in_edges = _working_graph(graph, snapshot.weights)
+    order = _contract(out_edges, in_edges)
+    return Contraction_hierarchy(
+        version=metric_version(graph, snapshot),
+        **_hierarchy_arrays(out_edges, in_edges, order))
+
+
+def save_ch(ch: Contraction_hierarchy, filename: str) -> None:
+    '''Saves a contraction hierarchy in the binary format of graph files,
+    usually next to the graph file itself.
+    '''
+    arrays = ch._asdict()
+    version = arrays.pop('version')
+    _save_arrays(filename, arrays, {'version': version})
+
+
+def load_ch(filename: str) -> Contraction_hierarchy:
+    '''Memory-maps a contraction hierarchy saved by 'save_ch'.'''
+    arrays, attributes = _load_arrays(filename)
+    return Contraction_hierarchy(version=attributes['version'], **arrays)
+
+
+def contraction_hierarchy(graph: graph_type, filename: Optional[str] = None,
+                          snapshot: Optional[Traffic_snapshot] = None
+                          ) -> Contraction_hierarchy:
+    '''Sets and returns the contraction hierarchy build_ipath uses in its
+    'ch' mode. It is loaded from the received file if it was built for the
+    graph and the itime of the received traffic snapshot (or else the
+    current one), or otherwise built, and saved to the file if one is given.
+    '''
+    version = metric_version(graph, snapshot)
+    ch = None
+    if filename is not None and os.path.exists(filename):
+        ch = load_ch(filename)
+        if ch.version != version:
+            ch = None
+    if ch is None:
+        ch = build_ch(graph, snapshot)
+        if filename is not None:
+            save_ch(ch, filename)
+    graph.graph['ch'] = ch
+    graph.graph.pop('ch_lists', None)
+    return ch
+
+
+def _ch_lists(graph: graph_type) -> tuple:
+    '''Returns the arrays of the contraction hierarchy of the graph as
+    Python lists, which are faster to index one element at a time.
+    '''
+    ch = graph.graph['ch']
+    cached = graph.graph.get('ch_lists')
+    if cached is None or cached[0] is not ch:
+        cached = (ch, tuple(getattr(ch, name).tolist()
+                            for name in Contraction_hierarchy._fields[2:]))
+        graph.graph['ch_lists'] = cached
+    return cached[1]
+
+
+def _ch_edge_middle(offsets: List[int], neighbours: List[int],
+                    middle: List[int], node: int, neighbour: int) -> int:
+    '''Returns the middle node of the edge between a node and one of its
+    neighbours in the upward or downward graph of a hierarchy.
+    '''
+    for e in range(offsets[node], offsets[node + 1]):
+        if neighbours[e] == neighbour:
+            return middle[e]
+    raise KeyError((node, neighbour))
+
+
+def _ch_unpack(lists: tuple, edges: list) -> list:
+    '''Replaces every shortcut in a list of (u, w, middle) edges of a
+    hierarchy by the edges it skips, and returns the nodes of the path.
+    '''
+    (up_offsets, up_targets, _, up_middle,
+     down_offsets, down_sources, _, down_middle) = lists
+    path = [edges[0][0]]
+    stack = list(reversed(edges))
+    while stack:
+        u, w, middle = stack.pop()
+        if middle < 0:
+            path.append(w)
+            continue
+        # The middle node has a lower rank than both ends of the shortcut,
+        # so u -> middle is in its downward edges and middle -> w in its
+        # upward ones.
+        stack.append((middle, w, _ch_edge_middle(
+            up_offsets, up_targets, up_middle, middle, w)))
+        stack.append((u, middle, _ch_edge_middle(
+            down_offsets, down_sources, down_middle, middle, u)))
+    return path
+
+
+def _ch_search(lists: tuple, source: int, target: int) -> Optional[list]:
+    '''Bidirectional search over a contraction hierarchy: a Dijkstra search
+    from the source over the upward graph and another from the target over
+    the downward graph reversed. Returns the list of node positions of the
+    path, or None if the target cannot be reached.
+    '''
+    if source == target:
+        return [source]
+    (up_offsets, up_targets, up_weights, up_middle,
+     down_offsets, down_sources, down_weights, down_middle) = lists
+    inf = float('inf')
+    dist = ({source: 0.0}, {target: 0.0})
+    pred = ({source: None}, {target: None})
+    heaps = ([(0.0, source)], [(0.0, target)])
+    best, meeting = inf, None
+    settled = 0
+    while heaps[0] or heaps[1]:
+        if not heaps[1] or (heaps[0] and heaps[0][0][0] <= heaps[1][0][0]):
+            side = 0
+        else:
+            side = 1
+        d, u = heapq.heappop(heaps[side])
+        if d > dist[side][u]:
+            continue
+        # A search can stop when it cannot improve the best path.
+        if d >= best:
+            heaps[side].clear()
+            continue
+        settled += 1
+        other = dist[1 - side].get(u)
+        if other is not None and d + other < best:
+            best, meeting = d + other, u
+        if side == 0:
+            edges = range(up_offsets[u], up_offsets[u + 1])
+            neighbours, weights, middle = up_targets, up_weights, up_middle
+        else:
+            edges = range(down_offsets[u], down_offsets[u + 1])
+            neighbours, weights = down_sources, down_weights
+            middle = down_middle
+        for e in edges:
+            v = neighbours[e]
+            nd = d + weights[e]
+            if nd < dist[side].get(v, inf):
+                dist[side][v] = nd
+                pred[side][v] = (u, middle[e])
+                heapq.heappush(heaps[side], (nd, v))
+    if metrics.enabled:
+        metrics.count('nodes_settled', settled)
+    if meeting is None:
+        return None
+    edges = list()
+    node = meeting
+    while pred[0][node] is not None:
+        u, middle = pred[0][node]
+        edges.append((u, node, middle))
+        node = u
+    edges.reverse()
+    node = meeting
+    while pred[1][node] is not None:
+        w, middle = pred[1][node]
+        edges.append((node, w, middle))
+        node = w
+    return _ch_unpack(lists, edges)
+
+
+# Directions (evenly spaced angles) and fractions of the nodes of a part
+# that '_dissect' tries to cut it at. The fractions go from the most
+# balanced cut, which is kept when separators are equally small.
+_DISSECTION_DIRECTIONS = 4
+_DISSECTION_FRACTIONS = (0.5, 0.45, 0.55)
+
+
+def _dissect(graph: graph_type, leaf_size: int = 8) -> list:
+    '''Returns an order of the nodes of the graph given by a nested
+    dissection: the nodes are split in two parts by their coordinates
+    along some direction, the nodes of one part that have edges to the
+    other part are a separator that goes last, and each part is ordered in
+    the same way. The order only depends on the graph, not on its weights.
+    '''
+    csr = _csr(graph)
+    n = len(csr.node_ids)
+    sources = np.repeat(np.arange(n), np.diff(csr.offsets))
+    edges = np.unique(np.sort(np.column_stack((sources, csr.targets)),
+                              axis=1), axis=0)
+    edges = edges[edges[:, 0] != edges[:, 1]]
+    coordinates = np.column_stack(
+        (np.asarray(csr.x) * math.cos(math.radians(np.mean(csr.y))),
+         np.asarray(csr.y)))
+    # The triangles of the hierarchy grow with the square of the size of
+    # the separators, so every part is cut along the one of these
+    # directions (the axes and the diagonals) and at the one of these
+    # fractions of its nodes that give the smallest separator.
+    angles = (np.arange(_DISSECTION_DIRECTIONS) * math.pi /
+              _DISSECTION_DIRECTIONS)
+    projections = coordinates @ np.vstack((np.cos(angles), np.sin(angles)))
+    part = np.zeros(n, dtype=np.int8)
+    order = list()
+    # Instead of recursion we use a stack of pending parts, in which a
+    # separator is pushed before the parts it separates, so that it is
+    # ordered after them.
+    stack = [(np.arange(n), edges, False)]
+    while stack:
+        nodes, edges, is_separator = stack.pop()
+        if is_separator or len(nodes) <= leaf_size:
+            order.extend(nodes.tolist())
+            continue
+        best = None
+        for direction in range(_DISSECTION_DIRECTIONS):
+            sorted_nodes = nodes[np.argsort(projections[nodes, direction],
+                                            kind='stable')]
+            for fraction in _DISSECTION_FRACTIONS:
+                cut = int(len(sorted_nodes) * fraction)
+                part[sorted_nodes[:cut]] = 0
+                part[sorted_nodes[cut:]] = 1
+                crossing = edges[part[edges[:, 0]] != part[edges[:, 1]]]
+                # The separator is taken from the part with the fewest
+                # boundary nodes.
+                boundary = np.unique(crossing.ravel())
+                first = boundary[part[boundary] == 0]
+                second = boundary[part[boundary] == 1]
+                separator = first if len(first) <= len(second) else second
+                if best is None or len(separator) < len(best[2]):
+                    best = (sorted_nodes, cut, separator)
+        sorted_nodes, cut, separator = best
+        part[sorted_nodes[:cut]] = 0
+        part[sorted_nodes[cut:]] = 1
+        part[separator] = 2
+        stack.append((separator, None, True))
+        for side in (1, 0):
+            side_nodes = nodes[part[nodes] == side]
+            side_edges = edges[(part[edges[:, 0]] == side) &
+                               (part[edges[:, 1]] == side)]
+            stack.append((side_nodes, side_edges, False))
+    return order
+
+
+def build_cch(graph: graph_type) -> Customizable_hierarchy:
+    '''Builds the customizable contraction hierarchy of the graph: the
+    nested dissection order, the shortcuts needed to contract the nodes in
+    that order for any itime, and the triangles the customization goes
+    through. This takes a while, but only needs to be done once per graph:
+    the triangles grow much faster than the graph (a 100 x 100 grid has
+    5.7 million and a 140 x 140 one 16.3 million, built in about 1.5 and
+    3.5 seconds) and take 16 bytes each, as all the node and edge indices
+    are int32.
+    '''
+    csr = _csr(graph)
+    n = len(csr.node_ids)
+    order = _dissect(graph)
+    rank = np.empty(n, dtype=np.int32)
+    rank[order] = np.arange(n, dtype=np.int32)
+    rank_list = rank.tolist()
+    sources = np.repeat(np.arange(n), np.diff(csr.offsets)).tolist()
+    targets = csr.targets.tolist()
+    up = [set() for _ in range(n)]
+    for u, v in zip(sources, targets):
+        if u != v:
+            low, high = (u, v) if rank_list[u] < rank_list[v] else (v, u)
+            up[low].add(high)
+    # Contracting a node joins all its higher-ranked neighbours, but it is
+    # enough to join them to the lowest of them (its parent in the
+    # elimination tree), whose contraction joins the rest.
+    parent = [-1] * n
+    for v in order:
+        if up[v]:
+            p = min(up[v], key=rank_list.__getitem__)
+            parent[v] = p
+            up[p] |= up[v] - {p}
+    neighbours = [sorted(up[v], key=rank_list.__getitem__) for v in range(n)]
+    degrees = np.array([len(ns) for ns in neighbours], dtype=np.int64)
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(degrees, out=offsets[1:])
+    heads = np.fromiter(chain.from_iterable(neighbours), dtype=np.int32,
+                        count=offsets[-1])
+    # The edge v -> w of the hierarchy is found by looking up v*n + w in
+    # the sorted keys of all its edges.
+    keys = np.repeat(np.arange(n, dtype=np.int64), degrees) * n + heads
+    key_order = np.argsort(keys).astype(np.int32)
+    keys = keys[key_order]
+
+    def edge_index(v: np.ndarray, w: np.ndarray) -> np.ndarray:
+        return key_order[np.searchsorted(keys, v.astype(np.int64) * n + w)]
+
+    tails = np.repeat(np.arange(n, dtype=np.int64), np.diff(csr.offsets))
+    edge_map = np.full(len(tails), -1, dtype=np.int32)
+    edge_direction = np.full(len(tails), -1, dtype=np.int8)
+    up_edge = rank[tails] < rank[csr.targets]
+    proper = tails != csr.targets
+    low = np.where(up_edge, tails, csr.targets)[proper]
+    high = np.where(up_edge, csr.targets, tails)[proper]
+    edge_map[proper] = edge_index(low, high)
+    edge_direction[proper] = np.where(up_edge[proper], 0, 1)
+    # The level of a node in the elimination tree is the length of the
+    # longest path from a leaf to it. The edges of the triangles of a node
+    # only depend on triangles of lower levels.
+    level = [0] * n
+    for v in order:
+        if parent[v] >= 0:
+            level[parent[v]] = max(level[parent[v]], level[v] + 1)
+    level = np.array(level, dtype=np.int64)
+    # The triangles v < a < b of every node v are its pairs of neighbours.
+    # They are written straight into int32 arrays, by level and then by
+    # node, which is the order the customization goes through them in.
+    counts = degrees * (degrees - 1) // 2
+    total = int(counts.sum())
+    tri_middle = np.empty(total, dtype=np.int32)
+    tri_low = np.empty(total, dtype=np.int32)
+    tri_high = np.empty(total, dtype=np.int32)
+    tri_top = np.empty(total, dtype=np.int32)
+    position = 0
+    for v in np.lexsort((np.arange(n), level)).tolist():
+        if counts[v] == 0:
+            continue
+        i, j = np.triu_indices(int(degrees[v]), 1)
+        start = int(offsets[v])
+        ns = heads[start:start + int(degrees[v])]
+        end = position + len(i)
+        tri_middle[position:end] = v
+        tri_low[position:end] = start + i
+        tri_high[position:end] = start + j
+        tri_top[position:end] = edge_index(ns[i], ns[j])
+        position = end
+    level_offsets = np.zeros(int(level.max(initial=0)) + 2, dtype=np.int64)
+    np.cumsum(np.bincount(level, weights=counts,
+                          minlength=len(level_offsets) - 1).astype(np.int64),
+              out=level_offsets[1:])
+    return Customizable_hierarchy(
+        _fingerprint(graph).hex(), rank, offsets, heads, edge_map,
+        edge_direction, tri_middle, tri_low, tri_high, tri_top,
+        level_offsets)
+
+
+def save_cch(cch: Customizable_hierarchy, filename: str) -> None:
+    '''Saves a customizable contraction hierarchy in the binary format of
+    graph files, usually next to the graph file itself.
+    '''
+    arrays = cch._asdict()
+    version = arrays.pop('version')
+    _save_arrays(filename, arrays, {'version': version})
+
+
+def load_cch(filename: str) -> Customizable_hierarchy:
+    '''Memory-maps a customizable contraction hierarchy saved by
+    'save_cch'.
+    '''
+    arrays, attributes = _load_arrays(filename)
+    return Customizable_hierarchy(version=attributes['version'], **arrays)
+
+
+def customizable_hierarchy(graph: graph_type,
+                           filename: Optional[str] = None
+                           ) -> Customizable_hierarchy:
+    '''Sets and returns the customizable contraction hierarchy of the
+    graph. It is loaded from the received file if it was built for the
+    graph, or otherwise built, and saved to the file if one is given. From
+    then on, build_igraph customizes it for every new traffic snapshot, so
+    that build_ipath can always use its 'ch' mode.
+    '''
+    version = _fingerprint(graph).hex()
+    cch = None
+    if filename is not None and os.path.exists(filename):
+        cch = load_cch(filename)
+        if cch.version != version:
+            cch = None
+    if cch is None:
+        cch = build_cch(graph)
+        if filename is not None:
+            save_cch(cch, filename)
+    graph.graph['cch'] = cch
+    if graph.graph.get('snapshot') is not None:
+        graph.graph['ch'] = customize(graph, cch)
+    return cch
+
+
+def _cch_runs(graph: graph_type, cch: Customizable_hierarchy) -> tuple:
+    '''Returns, for the customizable hierarchy of the graph, the runs of
+    consecutive triangles that share their edge v-a: where each of them
+    starts, its edge, its length and the first run of every level, along
+    with the lower node of every edge of the hierarchy. They are computed
+    once per hierarchy and kept in the graph.
+    '''
+    cached = graph.graph.get('cch_runs')
+    if cached is None or cached[0] is not cch:
+        # The triangles of a node are its pairs of neighbours in order, so
+        # those with the same edge v-a are next to each other.
+        starts = np.flatnonzero(np.diff(cch.tri_low, prepend=-1) != 0)
+        lengths = np.diff(np.append(starts, len(cch.tri_low)))
+        n = len(cch.offsets) - 1
+        cached = (cch, (starts, cch.tri_low[starts], lengths,
+                        np.searchsorted(starts, cch.level_offsets),
+                        np.repeat(np.arange(n), np.diff(cch.offsets))))
+        graph.graph['cch_runs'] = cached
+    return cached[1]
+
+
+@instrumented('customize')
+def customize(graph: graph_type, cch: Customizable_hierarchy,
+              snapshot: Optional[Traffic_snapshot] = None
+              ) -> Contraction_hierarchy:
+    '''Computes the weights of the edges of a customizable hierarchy for the
+    itime of the received traffic snapshot, or else the current one, and
+    returns the resulting contraction hierarchy. Every edge starts with the
+    lightest edge of the graph it stands for, and the triangles v < a < b
+    are then gone through by levels, improving a -> b with a -> v -> b
+    and b -> a with b -> v -> a, all the triangles of a level at once.
+    Finally, the edges the searches do not need are left out of the
+    returned hierarchy, which is why its searches are as fast as those of
+    a hierarchy built for the itime.
+    '''
+    if snapshot is None:
+        snapshot = current_snapshot(graph)
+    starts, run_edges, run_lengths, level_runs, tails = _cch_runs(graph,
+                                                                  cch)
+    inf = float('inf')
+    k = len(cch.neighbours)
+    weights = (np.full(k, inf), np.full(k, inf))
+    for direction in (0, 1):
+        mask = cch.edge_direction == direction
+        np.minimum.at(weights[direction], cch.edge_map[mask],
+                      snapshot.itime[mask])
+    up, down = weights
+    original_up, original_down = up.copy(), down.copy()
+    levels = range(len(cch.level_offsets) - 1)
+    for level in levels:
+        start, end = cch.level_offsets[level], cch.level_offsets[level + 1]
+        runs = slice(level_runs[level], level_runs[level + 1])
+        # The edge v-a of a run is read once and repeated for its
+        # triangles.
+        low, lengths = run_edges[runs], run_lengths[runs]
+        high = cch.tri_high[start:end]
+        top = cch.tri_top[start:end]
+        np.minimum.at(up, top, np.repeat(down[low], lengths) + up[high])
+        np.minimum.at(down, top, down[high] + np.repeat(up[low], lengths))
+    # An edge that is longer than some other path between its ends is never
+    # needed by the searches. Going through the triangles from the top
+    # down finds most of these paths, improving v -> a with v -> b -> a
+    # (the minimum over the run of v-a) and then v -> b with v -> a -> b.
+    perfect_up, perfect_down = up.copy(), down.copy()
+    for level in reversed(levels):
+        start, end = cch.level_offsets[level], cch.level_offsets[level + 1]
+        if start == end:
+            continue
+        runs = slice(level_runs[level], level_runs[level + 1])
+        low, lengths = run_edges[runs], run_lengths[runs]
+        first = starts[runs] - start
+        high = cch.tri_high[start:end]
+        top = cch.tri_top[start:end]
+        top_up, top_down = perfect_up[top], perfect_down[top]
+        perfect_up[low] = np.minimum(perfect_up[low], np.minimum.reduceat(
+            perfect_up[high] + top_down, first))
+        perfect_down[low] = np.minimum(perfect_down[low], np.minimum.reduceat(
+            top_up + perfect_down[high], first))
+        np.minimum.at(perfect_up, high,
+                      np.repeat(perfect_up[low], lengths) + top_up)
+        np.minimum.at(perfect_down, high,
+                      top_down + np.repeat(perfect_down[low], lengths))
+    keep_up = np.isfinite(up) & ~(perfect_up < up - 1e-6)
+    keep_down = np.isfinite(down) & ~(perfect_down < down - 1e-6)
+    # The middle node of a kept shortcut is that of a triangle that gives
+    # its weight, unless an edge of the graph already does. Unpacking it
+    # needs the two edges of that triangle, so they are kept too, which
+    # may in turn need the triangles of their own weights.
+    up_triangle = np.full(k, -1, dtype=np.int64)
+    down_triangle = np.full(k, -1, dtype=np.int64)
+    wanted_up = keep_up & (up < original_up)
+    wanted_down = keep_down & (down < original_down)
+    while wanted_up.any() or wanted_down.any():
+        chosen = np.flatnonzero((wanted_up | wanted_down)[cch.tri_top])
+        top = cch.tri_top[chosen]
+        low, high = cch.tri_low[chosen], cch.tri_high[chosen]
+        hit_up = wanted_up[top] & (down[low] + up[high] == up[top])
+        hit_down = wanted_down[top] & (down[high] + up[low] == down[top])
+        up_triangle[top[hit_up]] = chosen[hit_up]
+        down_triangle[top[hit_down]] = chosen[hit_down]
+        needed_up = np.zeros(k, dtype=bool)
+        needed_down = np.zeros(k, dtype=bool)
+        needed_up[high[hit_up]] = needed_up[low[hit_down]] = True
+        needed_down[low[hit_up]] = needed_down[high[hit_down]] = True
+        wanted_up = needed_up & ~keep_up & (up < original_up)
+        wanted_down = needed_down & ~keep_down & (down < original_down)
+        keep_up |= needed_up
+        keep_down |= needed_down
+    middles = list()
+    for keep, triangle in ((keep_up, up_triangle), (keep_down,
+                                                    down_triangle)):
+        middle = np.full(k, -1, dtype=np.int32)
+        chosen = keep & (triangle >= 0)
+        middle[chosen] = cch.tri_middle[triangle[chosen]]
+        middles.append(middle)
+    # The kept edges are packed into a CSR graph for every direction, as
+    # those of a contraction hierarchy.
+    arrays = list()
+    for keep, weight, middle in ((keep_up, up, middles[0]),
+                                 (keep_down, down, middles[1])):
+        offsets = np.zeros(len(cch.offsets), dtype=np.int64)
+        np.cumsum(np.bincount(tails[keep], minlength=len(offsets) - 1),
+                  out=offsets[1:])
+        arrays.extend((offsets, cch.neighbours[keep], weight[keep],
+                       middle[keep]))
+    return Contraction_hierarchy(metric_version(graph, snapshot), cch.rank,
+                                 *arrays)
+
+
+def _peripheral_nodes(csr: Csr_graph, count: int) -> np.ndarray:
+    '''Returns, for each of count equal angular sectors around the centre
+    of the graph, its node that is farthest from the centre, leaving out
+    dead ends. Landmarks behind the nodes of a path give the best bounds,
+    and those on the periphery are behind most paths.
+    '''
+    x0, y0 = csr.x.mean(), csr.y.mean()
+    # Degrees of longitude are shorter than those of latitude.
+    dx = (csr.x - x0) * math.cos(math.radians(y0))
+    dy = csr.y - y0
+    sector = ((np.arctan2(dy, dx) + math.pi) / (2*math.pi) * count) \
+        .astype(np.int64) % count
+    distance = np.hypot(dx, dy)
+    candidates = (np.diff(csr.offsets) > 0) & (np.diff(csr.r_offsets) > 0)
+    nodes = list()
+    for i in range(count):
+        members = np.flatnonzero(candidates & (sector == i))
+        if len(members):
+            nodes.append(members[np.argmax(distance[members])])
+    return np.array(nodes, dtype=np.int32)
+
+
+def build_landmarks(graph: graph_type, count: int = 8) -> Landmarks:
+    '''Chooses count landmarks on the periphery of the graph and computes
+    their tables of free-flow itime with one Dijkstra search over the graph
+    and another over the reversed graph for each of them.
+    '''
+    offsets, targets, r_offsets, r_sources, r_edges = _adjacency(graph)
+    weights = _free_flow_itime(graph).tolist()
+    r_weights = [weights[e] for e in r_edges]
+    nodes = _peripheral_nodes(_csr(graph), count)
+    shape = (len(nodes), len(offsets) - 1)
+    forward = np.full(shape, np.inf, dtype=np.float32)
+    backward = np.full(shape, np.inf, dtype=np.float32)
+    for i, node in enumerate(nodes.tolist()):
+        for table, adjacency in ((forward, (offsets, targets, weights)),
+                                 (backward, (r_offsets, r_sources,
+                                             r_weights))):
+            dist, _ = _dijkstra(*adjacency, node)
+            table[i, list(dist.keys())] = list(dist.values())
+    return Landmarks(_fingerprint(graph).hex(), nodes, forward, backward)
+
+
+def save_landmarks(landmarks: Landmarks, filename: str) -> None:
+    '''Saves the landmarks of a graph in the binary format of graph files,
+    usually next to the graph file itself.
+    '''
+    arrays = landmarks._asdict()
+    version = arrays.pop('version')
+    _save_arrays(filename, arrays, {'version': version})
+
+
+def load_landmarks(filename: str) -> Landmarks:
+    '''Memory-maps the landmarks saved by 'save_landmarks'.'''
+    arrays, attributes = _load_arrays(filename)
+    return Landmarks(version=attributes['version'], **arrays)
+
+
+def landmarks(graph: graph_type, filename: Optional[str] = None,
+              count: int = 8) -> Landmarks:
+    '''Sets and returns the landmarks build_ipath uses in its 'alt' mode.
+    They are loaded from the received file if they were computed for the
+    graph, or otherwise computed, and saved to the file if one is given.
+    They only depend on the graph, so they stay valid across traffic
+    snapshots.
+    '''
+    version = _fingerprint(graph).hex()
+    result = None
+    if filename is not None and os.path.exists(filename):
+        result = load_landmarks(filename)
+        if result.version != version:
+            result = None
+    if result is None:
+        result = build_landmarks(graph, count)
+        if filename is not None:
+            save_landmarks(result, filename)
+    graph.graph['landmarks'] = result
+    return result
+
+
+def _alt_factor(graph: graph_type, snapshot: Traffic_snapshot) -> float:
+    '''Returns the smallest ratio between the itime of an edge in the
+    traffic snapshot and its itime without congestion, that is, the
+    smallest congestion ponderation present in the snapshot. Every path
+    takes at least that many times its free-flow itime, so the free-flow
+    bounds of the landmarks multiplied by it are still lower bounds, and
+    much tighter ones when no edge is fluid. It is computed once per
+    snapshot.
+    '''
+    cached = graph.graph.get('alt_factor')
+    if cached is None or cached[0] != snapshot.version \
+            or snapshot.version == 0:
+        free_flow = _free_flow_itime(graph)
+        # Edges without length bound no path from below, and closed ones
+        # are in no path.
+        moving = (free_flow > 0) & np.isfinite(snapshot.itime)
+        factor = 1.0
+        if np.any(moving):
+            factor = float(np.min(snapshot.itime[moving] /
+                                  free_flow[moving]))
+        cached = (snapshot.version, max(factor, 0.0))
+        graph.graph['alt_factor'] = cached
+    return cached[1]
+
+
+def _alt_potential(landmarks: Landmarks, target: int,
+                   factor: float = 1.0) -> np.ndarray:
+    '''Returns, for every node, a lower bound of its itime to the target
+    by the triangle inequality: for every landmark L, d(v, t) is at least
+    d(L, t) - d(L, v) and d(v, L) - d(t, L), multiplied by the smallest
+    congestion factor of the snapshot (see '_alt_factor'). The bounds are
+    lowered by the rounding error of the float32 tables so they stay
+    admissible.
+    '''
+    forward = landmarks.forward.astype(np.float64)
+    backward = landmarks.backward.astype(np.float64)
+    to_target = forward[:, target:target + 1]
+    from_target = backward[:, target:target + 1]
+    error = np.finfo(np.float32).eps
+    with np.errstate(invalid='ignore'):
+        bounds = np.fmax(
+            to_target - forward - error*(to_target + forward),
+            backward - from_target - error*(backward + from_target))
+    # Both terms are undefined (inf - inf) when neither the node nor the
+    # target are connected to the landmark.
+    bound = np.fmax.reduce(bounds, axis=0)
+    bound = np.maximum(np.nan_to_num(bound, nan=0.0, posinf=np.inf), 0.0)
+    # Unreachable nodes keep their infinite bound even if the factor is 0
+    return np.where(np.isinf(bound), bound, bound*factor)
+
+
+def _alt_search(adjacency: tuple, weights: Sequence[float],
+                landmarks: Landmarks, source: int, target: int,
+                factor: float = 1.0) -> Optional[list]:
+    '''Runs an A* search from the source to the target guided by the
+    lower bounds of the landmarks, scaled by the received congestion
+    factor, which makes it settle far fewer nodes than Dijkstra. Returns
+    the list of node positions of the path, or None if the target cannot
+    be reached.
+    '''
+    offsets, targets = adjacency[0], adjacency[1]
+    potential = _alt_potential(landmarks, target, factor).tolist()
+    inf = float('inf')
+    dist = {source: 0.0}
+    pred = {source: -1}
+    heap = [(potential[source], 0.0, source)]
+    settled = 0
+    while heap:
+        _, d, u = heapq.heappop(heap)
+        if d > dist[u]:
+            continue
+        settled += 1
+        if u == target:
+            break
+        for e in range(offsets[u], offsets[u + 1]):
+            v = targets[e]
+            nd = d + weights[e]
+            # Nodes with an infinite bound cannot reach the target.
+            if nd < dist.get(v, inf) and potential[v] < inf:
+                dist[v] = nd
+                pred[v] = u
+                heapq.heappush(heap, (nd + potential[v], nd, v))
+    if metrics.enabled:
+        metrics.count('nodes_settled', settled)
+    if target not in dist:
+        return None
+    path = list()
+    node = target
+    while node != -1:
+        path.append(node)
+        node = pred[node]
+    path.reverse()
+    return path
+
+
+def normalize_query(query: str) -> str:
+    '''Returns the key under which a geocoding query is cached, so that
+    queries that only differ in case, accents or spacing share it.
+    '''
+    query = unicodedata.normalize('NFKD', query)
+    query = ''.join(c for c in query if not unicodedata.combining(c))
+    query = ','.join(' '.join(part.split()) for part in query.split(','))
+    return query.casefold().strip(', ')
+
+
+def _osmnx_geocode(query: str) -> Tuple[float, float]:
+    '''Utility function that geocodes a query with OSMnx, the default
+    backend of Geocoder.
+    '''
+    import osmnx as ox
+    return ox.geocode(query)
+
+
+class Geocoder:
+    '''Geocoding layer that caches the coordinates of the queries it
+    answers: in memory, in a LRU dictionary of at most 'size' entries, and
+    if a filename is given also in a sqlite database that survives
+    restarts. Entries older than 'ttl' seconds are asked again.
+
+    The backend is the function that actually geocodes a query, and must
+    return its coordinates as a (latitude, longitude) pair, as ox.geocode
+    does, which is the default.
+    '''
+
+    def __init__(
+            self, filename: Optional[str] = None,
+            backend: Optional[Callable[[str], Tuple[float, float]]] = None,
+            size: int = 1024, ttl: float = 30*24*3600) -> None:
+        self.backend = backend if backend is not None else _osmnx_geocode
+        self.size = size
+        self.ttl = ttl
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = self._disk_hits = self._misses = 0
+        self._store = None
+        if filename is not None:
+            self._store = sqlite3.connect(filename, check_same_thread=False)
+            self._store.execute('''CREATE TABLE IF NOT EXISTS geocodes (
+                query TEXT PRIMARY KEY, lat REAL, lon REAL, created REAL)''')
+            self._store.commit()
+
+    @instrumented('geocode')
+    def geocode(self, query: str) -> Tuple[float, float]:
+        '''Returns the (latitude, longitude) coordinates of the query.'''
+        key = normalize_query(query)
+        now = time.time()
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and entry[1] > now:
+                self._cache.move_to_end(key)
+                self._hits += 1
+                if metrics.enabled:
+                    metrics.count('geocoder_hits')
+                return entry[0]
+            row = None
+            if self._store is not None:
+                row = self._store.execute(
+                    'SELECT lat, lon, created FROM geocodes WHERE query = ?',
+                    (key,)).fetchone()
+            if row is not None and row[2] + self.ttl > now:
+                self._disk_hits += 1
+                if metrics.enabled:
+                    metrics.count('geocoder_disk_hits')
+                self._remember(key, (row[0], row[1]), row[2] + self.ttl)
+                return row[0], row[1]
+            self._misses += 1
+            if metrics.enabled:
+                metrics.count('geocoder_misses')
+        # The backend is called without holding the lock, so that a slow
+        # query does not block the ones that are already cached.
+        lat, lon = self.backend(query)
+        point = (float(lat), float(lon))
+        with self._lock:
+            self._remember(key, point, now + self.ttl)
+            if self._store is not None:
+                self._store.execute(
+                    'INSERT OR REPLACE INTO geocodes VALUES (?, ?, ?, ?)',
+                    (key, point[0], point[1], now))
+                self._store.commit()
+        return point
+
+    def _remember(self, key: str, point: Tuple[float, float],
+                  expires: float) -> None:
+        '''Keeps a point in the memory cache, evicting the least recently
+        used entry if it is full.
+        '''
+        self._cache[key] = (point, expires)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.size:
+            self._cache.popitem(last=False)
+
+    def stats(self) -> Geocoding_stats:
+        '''Returns the hit and miss counters of the geocoder.'''
+        return Geocoding_stats(self._hits, self._disk_hits, self._misses)
+
+    def close(self) -> None:
+        '''Closes the on-disk store, if any.'''
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+
+
+# Geocoder used by build_ipath. It only caches in memory unless it is
+# replaced by one with an on-disk store, as the bot does.
+geocoder = Geocoder()
+
+
+class RouteCache:
+    '''LRU cache of at most 'size' routes, indexed by origin node,
+    destination node and traffic snapshot version, with the maps of each
+    route indexed by their size. The routes of a snapshot are stale as
+    soon as a newer one is swapped in, so then the cache is emptied at
+    once. Routes of an older snapshot than the one of the cache, from
+    requests that started before the swap, are neither looked up nor kept.
+
+    Paths are kept as tuples and returned as new lists, so that a caller
+    that changes the path of a route does not change the cached one.
+    '''
+
+    def __init__(self, size: int = 256) -> None:
+        self.size = size
+        self._routes = OrderedDict()
+        self._version = 0
+        self._lock = threading.Lock()
+        self._hits = self._misses = self._invalidations = 0
+
+    def new_snapshot(self, version: int) -> None:
+        '''Empties the cache if the version is newer than that of its
+        routes.
+        '''
+        with self._lock:
+            self._advance(version)
+
+    def _advance(self, version: int) -> bool:
+        '''Utility function that empties the cache for a newer version and
+        returns whether the version is the one of the cache.
+        '''
+        if version > self._version:
+            if self._routes:
+                self._invalidations += 1
+            self._routes.clear()
+            self._version = version
+        return version == self._version
+
+    def get(self, origin: int, destination: int, version: int,
+            size: Optional[int] = None) -> Optional[Route]:
+        '''Returns the cached route between two nodes for the snapshot
+        with the given version, with its map of the given size if it has
+        been kept, or None if the route is not cached.
+        '''
+        with self._lock:
+            entry = None
+            if self._advance(version):
+                entry = self._routes.get((origin, destination))
+            if entry is None:
+                self._misses += 1
+            else:
+                self._routes.move_to_end((origin, destination))
+                self._hits += 1
+        if metrics.enabled:
+            metrics.count('route_cache_misses' if entry is None
+                          else 'route_cache_hits')
+        if entry is None:
+            return None
+        route, images = entry
+        return route._replace(
+            path=None if route.path is None else list(route.path),
+            image=images.get(size))
+
+    def put(self, route: Route, size: Optional[int] = None) -> None:
+        '''Keeps a route, replacing the one between the same nodes, if any,
+        and evicting the least recently used one if the cache is full. Its
+        map, if it has one, is kept as the map of the given size, along
+        with the maps of other sizes kept for the same route.
+        '''
+        with self._lock:
+            if not self._advance(route.version):
+                return
+            key = (route.origin, route.destination)
+            # Every cached route is of the version of the cache
+            images = self._routes[key][1] if key in self._routes \
+                else dict()
+            if route.image is not None:
+                images[size] = route.image
+            path = None if route.path is None else tuple(route.path)
+            self._routes[key] = (route._replace(path=path, image=None),
+                                 images)
+            self._routes.move_to_end(key)
+            while len(self._routes) > self.size:
+                self._routes.popitem(last=False)
+
+    def stats(self) -> Route_cache_stats:
+        '''Returns the counters of the cache.'''
+        lookups = self._hits + self._misses
+        return Route_cache_stats(
+            self._hits, self._misses, self._invalidations, len(self._routes),
+            self._hits / lookups if lookups else 0.0)
+
+
+def route_cache(graph: graph_type) -> RouteCache:
+    '''Returns the route cache of the graph, creating one with the default
+    size the first time. A cache of another size can be set beforehand as
+    graph.graph['route_cache'].
+    '''
+    return graph.graph.setdefault('route_cache', RouteCache())
+
+
+def _path_itime(graph: graph_type, path: list,
+                weights: Sequence[float]) -> float:
+    '''Returns the total itime of a path of OSM nodes, taking the fastest
+    edge between every two consecutive nodes.
+    '''
+    offsets, targets = _adjacency(graph)[:2]
+    index = np.searchsorted(_csr(graph).node_ids, path).tolist()
+    return sum(min(weights[e] for e in range(offsets[a], offsets[a + 1])
+                   if targets[e] == b)
+               for a, b in zip(index, index[1:]))
+
+
+def route(graph: graph_type, origin: int, destination: int,
+          snapshot: Optional[Traffic_snapshot] = None,
+          algorithm: str = 'dijkstra', size: Optional[int] = None) -> Route:
+    '''Returns the route with the least itime between two nodes of the
+    graph, searching it as '_shortest_path' does unless it is in the route
+    cache of the graph. A route from the cache comes with its map of the
+    given size, if it has been kept (see 'cache_image').
+    '''
+    if snapshot is None:
+        snapshot = current_snapshot(graph)
+    cache = route_cache(graph)
+    cached = cache.get(origin, destination, snapshot.version, size)
+    if cached is not None:
+        return cached
+    path = _shortest_path(graph, origin, destination, snapshot, algorithm)
+    itime = None if path is None else \
+        _path_itime(graph, path, snapshot.weights)
+    result = Route(origin, destination, snapshot.version, path, itime, None)
+    cache.put(result)
+    return result
+
+
+@instrumented('td_search')
+def route_at(graph: graph_type, origin: int, destination: int,
+             departure: datetime) -> Route:
+    '''Returns the route with the least itime between two nodes of the
+    graph leaving at the received time, with the itime of every edge taken
+    from the traffic profile of the graph (see 'traffic_profile') at the
+    time it is reached. These routes are not cached, and their version is
+    None.
+    '''
+    if 'profile' not in graph.graph:
+        raise ValueError('The graph has no traffic profile: '
+                         'traffic_profile has not been called for it')
+    csr = _csr(graph)
+    offsets, targets = _adjacency(graph)[:2]
+    path, itime = _td_dijkstra(offsets, targets, *_profile_lists(graph),
+                               _node_index(csr, origin),
+                               _node_index(csr, destination),
+                               _week_seconds(departure))
+    if path is not None:
+        path = csr.node_ids[path].tolist()
+    else:
+        itime = None
+    return Route(origin, destination, None, path, itime, None)
+
+
+def cache_image(graph: graph_type, route: Route, image: bytes,
+                size: Optional[int] = None) -> Route:
+    '''Keeps the PNG map of a route, of the given size, in the route cache
+    of the graph along with it, and returns the route with the image.
+    '''
+    route = route._replace(image=image)
+    route_cache(graph).put(route, size)
+    return route
+
+
+@instrumented('search')
+def _shortest_path(graph: graph_type, origin: int,
+                   destination: int,
+                   snapshot: Optional[Traffic_snapshot] = None,
+                   algorithm: str = 'dijkstra') -> Optional[list]:
+    '''Returns the list of OSM nodes of the path with the least itime
+    between two nodes of the graph, or None if there is no such path. The
+    itime is taken from the received traffic snapshot, or else from the
+    current one. The algorithm is either 'dijkstra' (bidirectional),
+    'ch', which uses the contraction hierarchy set by
+    'contraction_hierarchy', or customized for every snapshot after calling
+    'customizable_hierarchy', if it was built for the same itime, or
+    'alt', an A* search with the landmarks set by 'landmarks'. 'ch' and
+    'alt' fall back to 'dijkstra' when they cannot be used.
+    '''
+    if snapshot is None:
+        snapshot = current_snapshot(graph)
+    csr = _csr(graph)
+    origin = _node_index(csr, origin)
+    destination = _node_index(csr, destination)
+    if algorithm == 'ch' and 'ch' in graph.graph and \
+            graph.graph['ch'].version == metric_version(graph, snapshot):
+        path = _ch_search(_ch_lists(graph), origin, destination)
+    elif algorithm == 'alt' and 'landmarks' in graph.graph:
+        path = _alt_search(_adjacency(graph), snapshot.weights,
+                           graph.graph['landmarks'], origin, destination,
+                           _alt_factor(graph, snapshot))
+    elif algorithm in ('ch', 'alt', 'dijkstra'):
+        path = _bidirectional_dijkstra(_adjacency(graph), snapshot.weights,
+                                       origin, destination)
+    else:
+        raise ValueError('Unknown routing algorithm ' + algorithm)
+    if path is None:
+        return None
+    return csr.node_ids[path].tolist()
+
+
+def _snap_points(graph: graph_type, points: Sequence) -> np.ndarray:
+    '''Returns the positions in the CSR arrays of a list of points, given
+    either as OSM node ids or as (longitude, latitude) pairs, which are
+    all snapped at once.
+    '''
+    points = np.asarray(points)
+    if points.ndim == 2:
+        return _snap(graph, points[:, 0], points[:, 1])
+    node_ids = _csr(graph).node_ids
+    index = np.minimum(np.searchsorted(node_ids, points), len(node_ids) - 1)
+    missing = node_ids[index] != points
+    if np.any(missing):
+        raise KeyError(points[missing][0].item())
+    return index
+
+
+def _distances(offsets: List[int], heads: List[int],
+               weights: Sequence[float], source: int,
+               columns: List[int]) -> np.ndarray:
+    '''Returns the itime from a source to every column node, or inf for
+    those it cannot reach, with a single search that stops when all of
+    them are settled.
+    '''
+    dist, _ = _dijkstra(offsets, heads, weights, source, set(columns))
+    inf = float('inf')
+    return np.array([dist.get(column, inf) for column in columns])
+
+
+# Arguments of '_distances' shared by all the rows that a worker process
+# of 'travel_time_matrix' computes.
+_matrix_arguments: Optional[tuple] = None
+
+
+def _init_matrix_worker(offsets: List[int], heads: List[int],
+                        weights: Sequence[float], columns: List[int]) -> None:
+    '''Keeps the graph and the columns of the matrix in a worker process,
+    so that they are sent once instead of once per row.
+    '''
+    global _matrix_arguments
+    _matrix_arguments = (offsets, heads, weights, columns)
+
+
+def _matrix_row(source: int) -> np.ndarray:
+    '''Computes a row of the matrix in a worker process.'''
+    offsets, heads, weights, columns = _matrix_arguments
+    return _distances(offsets, heads, weights, source, columns)
+
+
+@instrumented('travel_time_matrix')
+def travel_time_matrix(graph: graph_type, origins: Sequence,
+                       destinations: Sequence,
+                       snapshot: Optional[Traffic_snapshot] = None,
+                       processes: Optional[int] = None) -> np.ndarray:
+    '''Returns the matrix of the least itime from every origin (rows) to
+    every destination (columns), or inf where there is no path. Origins
+    and destinations are given either as OSM node ids or as (longitude,
+    latitude) pairs, and the itime is that of the received traffic
+    snapshot, or else the current one.
+
+    Every row is a single search that stops when it has settled all the
+    destinations. If there are fewer destinations than origins, the
+    searches go backwards from the destinations instead. Repeated points
+    are only searched once, and with more than one process the searches
+    are spread across a pool of them.
+    '''
+    if snapshot is None:
+        snapshot = current_snapshot(graph)
+    rows = _snap_points(graph, origins)
+    columns = _snap_points(graph, destinations)
+    offsets, heads, r_offsets, r_sources, r_edges = _adjacency(graph)
+    weights = snapshot.weights
+    backward = len(columns) < len(rows)
+    if backward:
+        rows, columns = columns, rows
+        offsets, heads = r_offsets, r_sources
+        weights = [weights[e] for e in r_edges]
+    sources, inverse = np.unique(rows, return_inverse=True)
+    columns = columns.tolist()
+    if processes is None or processes < 2 or len(sources) < 2:
+        result = [_distances(offsets, heads, weights, source, columns)
+                  for source in sources.tolist()]
+    else:
+        with ProcessPoolExecutor(
+                processes, initializer=_init_matrix_worker,
+                initargs=(offsets, heads, weights, columns)) as executor:
+            result = list(executor.map(
+                _matrix_row, sources.tolist(),
+                chunksize=max(1, len(sources) // (4*processes))))
+    matrix = np.array(result, dtype=np.float64) \
+        .reshape(len(sources), len(columns))[inverse.reshape(-1)]
+    return matrix.T if backward else matrix
+
+
+@instrumented('isochrone')
+def isochrone(graph: graph_type, location: Union[int, Sequence[float]],
+              seconds: float,
+              snapshot: Optional[Traffic_snapshot] = None) -> Isochrone:
+    '''Returns the isochrone of the given seconds of itime around a
+    location, given as an OSM node id or a (longitude, latitude) pair,
+    which is snapped to the graph. The itime is that of the received
+    traffic snapshot, or else the current one. The search stops as soon as
+    the time is exhausted, so its cost depends on the size of the
+    isochrone rather than on the size of the graph.
+    '''
+    if snapshot is None:
+        snapshot = current_snapshot(graph)
+    csr = _csr(graph)
+    source = int(_snap_points(graph, [location])[0])
+    offsets, heads = _adjacency(graph)[:2]
+    dist, _ = _dijkstra(offsets, heads, snapshot.weights, source,
+                        limit=seconds)
+    index = np.fromiter(dist.keys(), dtype=np.int64, count=len(dist))
+    itime = np.fromiter(dist.values(), dtype=np.float64, count=len(dist))
+    from shapely.geometry import MultiPoint
+    polygon = MultiPoint(np.column_stack((csr.x[index], csr.y[index]))) \
+        .convex_hull
+    return Isochrone(csr.node_ids[source].item(), seconds,
+                     csr.node_ids[index], itime, polygon)
+
+
+def _geocode_in(graph: graph_type, query: str) -> Tuple[float, float]:
+    '''Utility function that geocodes a query in the city of the graph,
+    given by its 'city' attribute, or else in DEFAULT_CITY.
+    '''
+    return geocoder.geocode(query + ', ' +
+                            graph.graph.get('city', DEFAULT_CITY))
+
+
+def build_isochrone(igraph: graph_type, origin: str, seconds: float,
+                    snapshot: Optional[Traffic_snapshot] = None
+                    ) -> Isochrone:
+    ''' Returns the isochrone of the given seconds around a location in the
+    city of the graph given by its name. See 'isochrone'.
+    '''
+    lat, lon = _geocode_in(igraph, origin)
+    return isochrone(igraph, (lon, lat), seconds, snapshot)
+
+
+@instrumented('build_iroute')
+def build_iroute(igraph: graph_type, origin: str, destiny: str,
+                 snapshot: Optional[Traffic_snapshot] = None,
+                 algorithm: str = 'dijkstra',
+                 departure: Optional[datetime] = None,
+                 size: Optional[int] = None) -> Route:
+    ''' Returns the route between two locations in the city of the graph
+    given by their names (street, building name, etc.) The route is taken
+    from the route cache of the graph or otherwise searched with the itime
+    of the received traffic snapshot, or else the current one, and the
+    received algorithm (see '_shortest_path'). If a departure time is
+    given, it is searched instead with the traffic profile of the graph
+    (see 'route_at'). A cached route comes with its map of the received
+    size, if one has been kept.
+    '''
+    origin = _geocode_in(igraph, origin)
+    destiny = _geocode_in(igraph, destiny)
+    # Geocoded coordinates come reversed (latitude, longitude) so we
+    # invert them to be able to use them properly
+    nn_origin, nn_destiny = nearest_nodes(
+        igraph, [origin[1], destiny[1]], [origin[0], destiny[0]])
+
+    if departure is not None:
+        return route_at(igraph, int(nn_origin), int(nn_destiny), departure)
+    return route(igraph, int(nn_origin), int(nn_destiny), snapshot,
+                 algorithm, size)
+
+
+@instrumented('build_ipath')
+def build_ipath(igraph: graph_type, origin: str, destiny: str,
+                snapshot: Optional[Traffic_snapshot] = None,
+                algorithm: str = 'dijkstra',
+                departure: Optional[datetime] = None) -> list:
+    ''' Returns the shortest path between two locations in the city of the
+    graph given by their names (street, building name, etc.) as a list of
+    nodes. See 'build_iroute'.
+    '''
+    return build_iroute(igraph, origin, destiny, snapshot, algorithm,
+                        departure).path
+
+
+@instrumented('plot_path')
+def plot_path(igraph: graph_type, ipath: list,
+              filename: image_target = 'path_plot.png',
+              size: int = 800) -> Optional[bytes]:
+    ''' Plots the received shortest_path list into a map. The plot is not
+    shown but directly saved in a file, by default called 'path_plot.png',
+    or written to a binary buffer, or returned as PNG bytes if the
+    filename is None.
+    '''
+    from staticmap import CircleMarker, Line
+    city_map = new_map(size)
+    csr = _csr(igraph)
+    points = list()
+    if ipath:
+        index = np.searchsorted(csr.node_ids, ipath)
+        points = list(zip(csr.x[index].tolist(), csr.y[index].tolist()))
+    try:
+        origin_marker = CircleMarker(points[0], 'green', 9)
+        destiny_marker = CircleMarker(points[-1], 'red', 9)
+        city_map.add_marker(origin_marker)
+        city_map.add_marker(destiny_marker)
+
+    except IndexError:
+        print('There is no path!')
+    for i in range(0, len(points)):
+        if (i + 1 < len(points)):
+            line = Line((points[i], points[i+1]), '#0884ff', 3)
+            city_map.add_line(line)
+
+    return _save_image(city_map.render(), filename)
+
+
+@instrumented('plot_isochrone')
+def plot_isochrone(igraph: graph_type, iso: Isochrone,
+                   filename: image_target = 'isochrone_plot.png',
+                   size: int = 800) -> Optional[bytes]:
+    ''' Plots the area of the received isochrone into a map, with its
+    origin marked. The plot is not shown but directly saved in a file, by
+    default called 'isochrone_plot.png', or written to a binary buffer, or
+    returned as PNG bytes if the filename is None.
+    '''
+    import staticmap
+    city_map = new_map(size)
+    csr = _csr(igraph)
+    if iso.polygon.geom_type == 'Polygon':
+        city_map.add_polygon(staticmap.Polygon(
+            list(iso.polygon.exterior.coords), '#0884ff55', '#0884ff'))
+    index = np.searchsorted(csr.node_ids, iso.origin)
+    city_map.add_marker(staticmap.CircleMarker(
+        (csr.x[index].item(), csr.y[index].item()), 'green', 9))
+    return _save_image(city_map.render(), filename)
+
+
+@instrumented('plot_position')
+def plot_position(lon: float, lat: float,
+                  filename: image_target = 'position_plot.png',
+                  size: int = 800) -> Optional[bytes]:
+    ''' Plots a position into a map. The plot is not shown but directly
+    saved in a file, by default called 'position_plot.png', or written to
+    a binary buffer, or returned as PNG bytes if the filename is None.
+    '''
+    from staticmap import CircleMarker
+    city_map = new_map(size)
+    city_map.add_marker(CircleMarker((lon, lat), 'blue', 10))
+    return _save_image(city_map.render(), filename)
+
+
+# State of a worker process of a RoutePool: its graph, the directory of
+# the snapshot files and the routing algorithm.
+_pool_worker: Optional[tuple] = None
+
+
+def _init_pool_worker(graph_filename: str, snapshot_directory: str,
+                      algorithm: str, cch_filename: Optional[str],
+                      geocoding_filename: Optional[str],
+                      tiles_directory: Optional[str],
+                      tiles_source: str, measure: bool,
+                      city: str) -> None:
+    '''Loads the graph and the caches a worker process of a RoutePool
+    uses, and measures it if the metrics of the parent process are
+    enabled.
+    '''
+    global _pool_worker, geocoder, tile_cache
+    if measure:
+        metrics.enable()
+        metrics.record_events()
+    else:
+        metrics.disable()
+    graph = load_graph(graph_filename)
+    graph.graph['city'] = city
+    if cch_filename is not None:
+        customizable_hierarchy(graph, cch_filename)
+    if geocoding_filename is not None:
+        geocoder = Geocoder(filename=geocoding_filename)
+    if tiles_directory is not None:
+        tile_cache = TileCache(tiles_directory, tiles_source)
+    _pool_worker = (graph, snapshot_directory, algorithm)
+
+
+def _snapshot_filename(directory: str, version: int) -> str:
+    '''Returns the name of the file of a snapshot version in a snapshot
+    directory.
+    '''
+    return os.path.join(directory, '{v}.snapshot'.format(v=version))
+
+
+def _pool_snapshot(version: int) -> Traffic_snapshot:
+    '''Returns the traffic snapshot with the given version in a worker
+    process. A newer one than the worker has is loaded and swapped in as
+    build_igraph would, customizing the hierarchy for it if there is one.
+    An older one is only used for the request at hand.
+    '''
+    graph, directory, _ = _pool_worker
+    snapshot = current_snapshot(graph)
+    if snapshot.version == version:
+        return snapshot
+    snapshot = load_snapshot(_snapshot_filename(directory, version))
+    if version > current_snapshot(graph).version:
+        if 'cch' in graph.graph:
+            graph.graph['ch'] = customize(graph, graph.graph['cch'],
+                                          snapshot)
+        graph.graph['snapshot'] = snapshot
+        route_cache(graph).new_snapshot(version)
+    return snapshot
+
+
+def _pool_warm(version: int) -> None:
+    '''Task of a RoutePool that swaps in a new traffic snapshot in a
+    worker, customizing its hierarchy, before any request needs it.
+    '''
+    _pool_snapshot(version)
+
+
+def _pool_task(function: Callable, args: tuple) -> tuple:
+    '''Runs a task of a RoutePool in a worker process. Returns its result
+    together with the metrics events it recorded, if any.
+    '''
+    result = function(*args)
+    return result, metrics.take_events() if metrics.enabled else None
+
+
+def _pool_route(origin: str, destiny: str, version: int,
+                size: int) -> Route:
+    '''Task of a RoutePool that returns the route between two locations,
+    with its map.
+    '''
+    graph, _, algorithm = _pool_worker
+    snapshot = _pool_snapshot(version)
+    result = build_iroute(graph, origin, destiny, snapshot, algorithm,
+                          size=size)
+    if result.image is None:
+        result = cache_image(graph, result,
+                             plot_path(graph, result.path, None, size), size)
+    return result
+
+
+def _pool_isochrone(location: Sequence[float], seconds: float, version: int,
+                    size: int) -> Tuple[Isochrone, bytes]:
+    '''Task of a RoutePool that returns an isochrone and its map.'''
+    graph = _pool_worker[0]
+    iso = isochrone(graph, location, seconds, _pool_snapshot(version))
+    return iso, plot_isochrone(graph, iso, None, size)
+
+
+class RoutePool:
+    '''Pool of worker processes that search and render routes and
+    isochrones, so that a slow request does not stall the others.
+
+    Every worker memory-maps the graph file, so they all share its pages,
+    and gets the traffic snapshot of every request by its version: the
+    pool saves the snapshots it is given with 'publish' to files of the
+    snapshot directory, which workers load the first time they see them.
+    Workers keep their own route caches, and share the on-disk geocoding
+    and tile caches if they are given. If the metrics of the module are
+    enabled when the pool is created, the workers measure their tasks too
+    and their measures are added to those of this process.
+
+    At most 'queue_size' requests are pending at a time. Further ones are
+    refused, returning None instead of a future, so that the caller can
+    ask the user to try again later. Cancelling a future gives its place
+    back right away, and the request is dropped if no worker has started
+    it yet. The file of a snapshot is kept while pending requests use it,
+    even if it is older than the last 'keep_snapshots'. If a worker dies,
+    the requests it had fail and the workers are started again.
+    '''
+
+    def __init__(self, graph_filename: str, snapshot_directory: str,
+                 processes: int = 2, queue_size: int = 16,
+                 algorithm: str = 'dijkstra',
+                 cch_filename: Optional[str] = None,
+                 geocoding_filename: Optional[str] = None,
+                 tiles_directory: Optional[str] = None,
+                 tiles_source: str = OSM_TILES,
+                 keep_snapshots: int = 3,
+                 city: str = DEFAULT_CITY) -> None:
+        self.snapshot_directory = snapshot_directory
+        self.processes = processes
+        self.queue_size = queue_size
+        self.keep_snapshots = keep_snapshots
+        self._lock = threading.Lock()
+        self._pending = 0
+        # The futures of the tasks that hold a place in the queue
+        self._queued = set()
+        self._published = list()
+        # Tasks pending for every snapshot version, and the versions whose
+        # files are deleted when their last task finishes
+        self._in_use = dict()
+        self._retired = set()
+        os.makedirs(snapshot_directory, exist_ok=True)
+        # The snapshots of a previous pool are never used again.
+        for name in os.listdir(snapshot_directory):
+            if name.endswith('.snapshot'):
+                os.remove(os.path.join(snapshot_directory, name))
+        if cch_filename is not None:
+            # The workers load the customizable hierarchy from its file,
+            # which is built here, once, if it is not there yet.
+            graph = load_graph(graph_filename)
+            if not os.path.exists(cch_filename) or \
+                    load_cch(cch_filename).version != \
+                    _fingerprint(graph).hex():
+                save_cch(build_cch(graph), cch_filename)
+        self._initargs = (graph_filename, snapshot_directory, algorithm,
+                          cch_filename, geocoding_filename, tiles_directory,
+                          tiles_source, metrics.enabled, city)
+        self._executor = self._start_workers()
+
+    def _start_workers(self) -> ProcessPoolExecutor:
+        '''Utility function that starts the worker processes.'''
+        executor = ProcessPoolExecutor(self.processes,
+                                       initializer=_init_pool_worker,
+                                       initargs=self._initargs)
+        # The workers are started right away, before the caller starts
+        # other threads, and load the graph meanwhile.
+        executor.submit(int)
+        return executor
+
+    def _restart_workers(self, broken: ProcessPoolExecutor) -> None:
+        '''Utility function that replaces the executor of the workers if
+        it is still the broken one, and has the new workers load the last
+        published snapshot.
+        '''
+        with self._lock:
+            if self._executor is not broken:
+                return
+            self._executor = self._start_workers()
+            version = self._published[-1] if self._published else None
+        broken.shutdown(wait=False)
+        if version is not None:
+            self._warm(version)
+
+    def publish(self, snapshot: Traffic_snapshot) -> None:
+        '''Makes a traffic snapshot available to the workers, deleting the
+        files of the oldest ones but the last 'keep_snapshots', or, for
+        those that pending tasks use, when the last of them finishes. The
+        workers then load it, and customize their hierarchy for it, before
+        the first request for it arrives.
+        '''
+        save_snapshot(snapshot, _snapshot_filename(self.snapshot_directory,
+                                                   snapshot.version))
+        with self._lock:
+            self._published.append(snapshot.version)
+            old = self._published[:-self.keep_snapshots]
+            del self._published[:-self.keep_snapshots]
+            self._retired.update(version for version in old
+                                 if version in self._in_use)
+            old = [version for version in old if version not in self._in_use]
+        for version in old:
+            self._remove_snapshot(version)
+        self._warm(snapshot.version)
+
+    def _warm(self, version: int) -> None:
+        '''Utility function that sends every worker a task that loads a
+        snapshot. Each of them keeps a worker busy for a while, so the
+        idle workers take the others. They take places in the queue like
+        requests, and are not sent if there are none left.
+        '''
+        for _ in range(self.processes):
+            self._submit(version, _pool_warm, (version,))
+
+    def _remove_snapshot(self, version: int) -> None:
+        '''Utility function that deletes the file of a snapshot.'''
+        try:
+            os.remove(_snapshot_filename(self.snapshot_directory, version))
+        except FileNotFoundError:
+            pass
+
+    def submit(self, function: Callable, *args) -> Optional[Future]:
+        '''Sends a task to the workers and returns its future, or None if
+        there are already 'queue_size' pending tasks.
+        '''
+        return self._submit(None, function, args)
+
+    def _submit(self, version: Optional[int], function: Callable,
+                args: tuple) -> Optional[Future]:
+        '''Utility function that submits a task, which uses the snapshot
+        with the given version if it is not None.
+        '''
+        result = Future()
+        with self._lock:
+            if self._pending >= self.queue_size:
+                return None
+            self._pending += 1
+            self._queued.add(result)
+            if version is not None:
+                self._in_use[version] = self._in_use.get(version, 0) + 1
+        executor = self._executor
+        try:
+            task = executor.submit(_pool_task, function, args)
+        except BrokenProcessPool:
+            # A worker died since the last task finished.
+            self._restart_workers(executor)
+            executor = self._executor
+            try:
+                task = executor.submit(_pool_task, function, args)
+            except Exception:
+                self._release(result, version)
+                raise
+        except Exception:
+            self._release(result, version)
+            raise
+        task.add_done_callback(
+            lambda task: self._finish(task, result, version, executor))
+        result.add_done_callback(
+            lambda result: self._cancelled(task, result))
+        return result
+
+    def _cancelled(self, task: Future, result: Future) -> None:
+        '''Utility function that, if the caller cancelled the future of a
+        task, drops the task if no worker has started it, or else gives
+        its place in the queue back. Its snapshot is kept until it ends.
+        '''
+        if result.cancelled() and not task.cancel():
+            self._free_place(result)
+
+    def _free_place(self, result: Future) -> None:
+        '''Utility function that gives back the place in the queue of the
+        task with the received future, if it still has it.
+        '''
+        with self._lock:
+            if result in self._queued:
+                self._queued.discard(result)
+                self._pending -= 1
+
+    def _release(self, result: Future, version: Optional[int]) -> None:
+        '''Utility function that frees the place of a finished task, and
+        deletes the file of its snapshot if it was the last task to use a
+        retired one.
+        '''
+        self._free_place(result)
+        with self._lock:
+            if version is None:
+                return
+            self._in_use[version] -= 1
+            if self._in_use[version] > 0:
+                return
+            del self._in_use[version]
+            if version not in self._retired:
+                return
+            self._retired.discard(version)
+        self._remove_snapshot(version)
+
+    def _finish(self, task: Future, result: Future, version: Optional[int],
+                executor: ProcessPoolExecutor) -> None:
+        '''Utility function that passes the result of a finished task to
+        the future returned by 'submit', and its measures to the metrics.
+        Starts the workers again if the task failed because one of them
+        died.
+        '''
+        self._release(result, version)
+        if not task.cancelled() and \
+                isinstance(task.exception(), BrokenProcessPool):
+            self._restart_workers(executor)
+        if not result.set_running_or_notify_cancel():
+            return
+        try:
+            value, events = task.result()
+        except BaseException as e:
+            result.set_exception(e)
+            return
+        if events:
+            metrics.replay(events)
+        result.set_result(value)
+
+    def route(self, origin: str, destiny: str, version: int,
+              size: int = 800) -> Optional[Future]:
+        '''Asks for the Route between two locations in the city for the
+        traffic snapshot with the given version, with its map rendered.
+        See 'submit'.
+        '''
+        return self._submit(version, _pool_route,
+                            (origin, destiny, version, size))
+
+    def isochrone(self, location: Sequence[float], seconds: float,
+                  version: int, size: int = 800) -> Optional[Future]:
+        '''Asks for the isochrone of a (longitude, latitude) location for
+        the traffic snapshot with the given version, together with its
+        map. See 'submit'.
+        '''
+        return self._submit(version, _pool_isochrone,
+                            (tuple(location), seconds, version, size))
+
+    def pending(self) -> int:
+        '''Returns the number of tasks that have not finished.'''
+        return self._pending
+
+    def close(self) -> None:
+        '''Stops the workers once they finish their tasks.'''
+        self._executor.shutdown(wait=False)
+
+
+def _memory_size(value: Any, seen: Optional[set] = None) -> int:
+    '''Returns an estimate of the bytes an object takes with everything it
+    holds: the bytes of the arrays, memory-mapped or not, and the sizes of
+    the containers and their elements, where those of a list or tuple of
+    numbers are estimated from its first one. networkx graphs count the
+    dictionaries of their nodes and edges, and ball trees their arrays.
+    Objects of other types only count their own size.
+    '''
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        return size + sum(_memory_size(key, seen) + _memory_size(item, seen)
+                          for key, item in value.items())
+    # Named tuples, such as snapshots, hold fields of different types,
+    # so only the other tuples and lists are estimated from their first
+    # element.
+    if isinstance(value, (list, tuple)) and value:
+        if isinstance(value[0], (int, float)) and \
+                not hasattr(value, '_fields'):
+            return size + len(value)*sys.getsizeof(value[0])
+        return size + sum(_memory_size(item, seen) for item in value)
+    # The nodes and edges of a networkx graph are dictionaries in its
+    # '_node' and '_adj' (or '_succ' and '_pred') attributes, which share
+    # the dictionaries of the attributes of the edges.
+    if isinstance(value, (nx.Graph, RouteCache, TrafficStore)):
+        return size + _memory_size(vars(value), seen)
+    # sklearn is not imported to check for its BallTree, which keeps the
+    # points and the nodes of the tree as arrays.
+    if callable(getattr(value, 'get_arrays', None)):
+        return size + sum(_memory_size(array, seen)
+                          for array in value.get_arrays())
+    return size
+
+
+class CityRegistry:
+    '''Registry of the cities a process routes in, by place. The graph of a
+    city is loaded the first time it is asked for (see 'get'), from its
+    warm start if it has one or else from its graph file, which is
+    downloaded first if it does not exist yet. Every graph keeps its own
+    traffic snapshots and caches, and its traffic is refreshed from the
+    feeds of its city with 'refresh'.
+
+    When the loaded graphs take more than 'memory_budget' bytes, the least
+    recently used ones are evicted, and loaded again if they are asked for
+    later. The one just asked for is never evicted, even if it alone takes
+    more than the budget. The bytes of a graph are measured when it is
+    loaded and when its traffic is refreshed (see '_memory_size').
+
+    A city is loaded without holding the lock of the registry, so that the
+    other cities can be used meanwhile (even if its graph is downloaded
+    first), and the threads that ask for it at the same time wait for the
+    same load.
+    '''
+
+    def __init__(self, memory_budget: int = 2*2**30) -> None:
+        self.memory_budget = memory_budget
+        self._lock = threading.RLock()
+        self._cities = dict()
+        self._graphs = OrderedDict()
+        self._loading = dict()
+        self._bytes = dict()
+        self._feeds = dict()
+        self._counters = dict()
+
+    def register(self, place: str, graph_filename: str,
+                 highways_url: Optional[str] = None,
+                 congestions_url: Optional[str] = None,
+                 name: Optional[str] = None,
+                 assignment_filename: Optional[str] = None,
+                 warm_start_filename: Optional[str] = None) -> City:
+        '''Registers a city, or replaces the one with the same place, which
+        is evicted. Its name is the first part of the place if none is
+        given.
+        '''
+        if name is None:
+            name = place.split(',')[0].strip()
+        city = City(place, name, graph_filename, highways_url,
+                    congestions_url, assignment_filename,
+                    warm_start_filename)
+        with self._lock:
+            self.evict(place)
+            self._cities[place] = city
+            self._counters.setdefault(place, [0, 0.0, 0, 0])
+        return city
+
+    def places(self) -> List[str]:
+        '''Returns the places of the registered cities.'''
+        return list(self._cities)
+
+    def city(self, place: str) -> City:
+        '''Returns a registered city by its place.'''
+        return self._cities[place]
+
+    def get(self, place: str) -> graph_type:
+        '''Returns the graph of a city, loading it if it is not loaded, or
+        waiting for it if another thread is loading it, and evicting other
+        ones if the budget is exceeded then.
+        '''
+        with self._lock:
+            graph = self._graphs.get(place)
+            if graph is not None:
+                self._graphs.move_to_end(place)
+                self._counters[place][2] += 1
+                return graph
+            city = self._cities[place]
+            future = self._loading.get(place)
+            loading = future is None
+            if loading:
+                future = self._loading[place] = Future()
+        if not loading:
+            return future.result()
+        try:
+            start = time.perf_counter()
+            graph = self._load(city)
+            seconds = time.perf_counter() - start
+            size = _memory_size(graph)
+        except BaseException as e:
+            with self._lock:
+                del self._loading[place]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._loading[place]
+            # The city may have been registered again while it was loaded
+            if self._cities.get(place) is city:
+                counters = self._counters[place]
+                counters[0] += 1
+                counters[1] += seconds
+                self._graphs[place] = graph
+                self._bytes[place] = size
+                self.trim()
+        future.set_result(graph)
+        return graph
+
+    @instrumented('city_load')
+    def _load(self, city: City) -> graph_type:
+        '''Utility function that loads the graph of a city.'''
+        if city.warm_start_filename is not None and \
+                os.path.exists(city.warm_start_filename):
+            graph = load_warm_start(city.warm_start_filename)
+        else:
+            if not exists_graph(city.graph_filename):
+                save_graph(download_graph(city.place), city.graph_filename)
+            graph = load_graph(city.graph_filename)
+        graph.graph['city'] = city.name
+        return graph
+
+    def refresh(self, place: str) -> Optional[Traffic_snapshot]:
+        '''Downloads the traffic feeds of a city and builds a new traffic
+        snapshot of its graph if they have changed since the last refresh,
+        saving its warm start if it has one. Returns the new snapshot, or
+        None if the feeds have not changed or the city has none.
+        '''
+        city = self._cities[place]
+        if city.highways_url is None or city.congestions_url is None:
+            return None
+        graph = self.get(place)
+        feeds = (download_highways(city.highways_url),
+                 download_congestions(city.congestions_url))
+        previous = self._feeds.get(place)
+        # Unchanged feeds are returned as the very same objects, but a
+        # graph loaded again after an eviction has no snapshot for them.
+        if previous is not None and previous[0] is graph and \
+                previous[1] is feeds[0] and previous[2] is feeds[1]:
+            return None
+        build_igraph(graph, build_complete_traffic_data(*feeds),
+                     assignment_filename=city.assignment_filename)
+        if city.warm_start_filename is not None:
+            save_warm_start(graph, city.warm_start_filename)
+        self._feeds[place] = (graph,) + feeds
+        size = _memory_size(graph)
+        with self._lock:
+            if self._graphs.get(place) is graph:
+                self._bytes[place] = size
+                self.trim()
+        return current_snapshot(graph)
+
+    def evict(self, place: str) -> bool:
+        '''Drops the graph of a city, if it is loaded. Returns whether it
+        was.
+        '''
+        with self._lock:
+            if self._graphs.pop(place, None) is None:
+                return False
+            self._bytes.pop(place, None)
+            self._feeds.pop(place, None)
+            self._counters[place][3] += 1
+            return True
+
+    def memory(self) -> int:
+        '''Returns the bytes the loaded graphs took when they were last
+        measured.
+        '''
+        with self._lock:
+            return sum(self._bytes.values())
+
+    def trim(self) -> None:
+        '''Evicts the least recently used graphs while the loaded ones
+        take more than the budget, keeping at least the last one used.
+        '''
+        with self._lock:
+            total = self.memory()
+            while total > self.memory_budget and len(self._graphs) > 1:
+                place = next(iter(self._graphs))
+                total -= self._bytes[place]
+                self.evict(place)
+
+    def stats(self) -> List[City_stats]:
+        '''Returns the counters of every registered city.'''
+        with self._lock:
+            return [City_stats(place, place in self._graphs,
+                               self._bytes.get(place, 0), *counters)
+                    for place, counters in self._counters.items()
+                    if place in self._cities]